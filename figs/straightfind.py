@@ -1,9 +1,13 @@
 #!/usr/bin/python3
 
+import os
 import numpy as np
 import sys
 import re
 
+from hitfinder import findhits,derivatives
+from ramptable import ramptable # src/ on the PYTHONPATH
+
 global nsamples 
 global dt
 
@@ -20,7 +24,8 @@ def getheader(infile):
     line = infile.readline()
     #(dummy1,dummy2,dummy3) = [x.strip for x in line.split(',')]
     #(dummy1,dummy2,dummy3) = [x.strip for x in line.split(',')]
-    line = infile.readline()
+    while line.startswith('#'): # one trigger line per segment
+        line = infile.readline()
     (xlabel,ylabel) = [x.strip() for x in line.split(',')]
     return (scopename,scopemodel,arraytype,nsegments,nsamples,xlabel,ylabel)
 
@@ -30,37 +35,14 @@ def c2(freq,bwd):
     csqr[inds] = np.power(np.cos(freq[inds]/bwd*np.pi/2.),int(2))
     return csqr
 
-def sampleandhold(y,thresh,dead,e):
-    result = np.zeros(y.shape,dtype=float)
-    i = 0
-    while i < e.shape[0]:
-        ramp = e[i]
-        result[i] = ramp
-        if y[i] < thresh:
-            while i<e.shape[0] and y[i]<0:
-                if i<e.shape[0]:
-                    ramp = e[i]
-                    result[i] = ramp
-                    hold = ramp
-                    i += 1
-            if i+int(dead+.5) < e.shape[0]:
-                result[i:i+int(dead+.5)] = hold
-                i += int(dead+.5)
-        if i<e.shape[0]:
-            ramp = e[i]
-            result[i] = ramp
-            i += 1
-    return result
-
 #def processfiles(filelist,c2,en,jac,b):
-def processfiles(filelist,c2):
+def processfiles(filelist,c2,bwd=2.4,cachepath='./ramptables/'):
     dirlist = []
     filecounter = int(0)
     #nbins = jac.shape[0]
     nbins=1024
     hist = np.zeros(nbins,dtype=float)
     jac = np.zeros(nbins,dtype=float)
-    en = np.zeros((0,),dtype=float)
     (en_low,en_high) = (0.25,11.25)
     for filename in filelist:
         m = re.search('(^.+/)(C\d--C\d.+).txt$',filename)
@@ -74,37 +56,24 @@ def processfiles(filelist,c2):
                 continue
             d = np.loadtxt(infile,dtype=float,delimiter=',')
             t0=d[0,0]
-            t=(d[:,0]-t0)*1e9
-            y=d[:,1]
+            t=(d[:nsamples_chk,0]-t0)*1e9
+            y=d[:,1].reshape((-1,nsamples_chk)) # one row per segment
             dt = t[1]-t[0]
             infile.close()
-            f = np.fft.fftfreq(y.shape[0],dt)
-            #BOX = 1.*(np.abs(f)<0.24)
-            Y = np.fft.fft(y)*c2
-            DY = 1j*f*Y
-            DDY = -1*f*f*Y
+            (dy,ddy) = derivatives(y,dt,bwd)
             #outfile = dirstr + fileheadstr + '.fft'
             #np.savetxt(outfile,np.column_stack((f,np.abs(Y),np.abs(DY))),fmt='%.3e')
-            dy = np.fft.ifft(DY).real
-            ddy = np.fft.ifft(DDY).real
             #num = np.fft.ifft(np.fft.fft(dy*t)*BOX).real
             #denom = np.fft.ifft(DY*BOX).real
             #inds = np.where(np.abs(denom)>0)
             #result = np.zeros(y.shape,dtype=float)
             #result[inds] = num[inds]/denom[inds]
-            if en.shape[0] < t.shape[0]:
-                en = np.zeros(t.shape[0],dtype=float)
-                (ramp0,rampstart,rampstop) = (250,300,1300)
-                inds = np.where((t>rampstart)*(t<rampstop))
-                en[inds] = 2e4 * float(rampstart-ramp0)*np.power(t[inds]-t[ramp0],int(-2))
-                (jac,_) = np.histogram(en,bins = nbins,range=(en_low,en_high))
-            result_hold = sampleandhold(dy,-.0025,.5/dt,en)
+            table = ramptable(nsamples_chk,dt,250,300,1300,np.linspace(en_low,en_high,nbins+1),cachepath=cachepath)
+            (jac,b) = (table.jac,table.edges)
+            (hits,indptr) = findhits(dy,-.0025,int(.5/dt+.5))
+            hist += table.heldhist(hits,indptr,int(.5/dt+.5))
             #outfile = dirstr + fileheadstr + '.expect'
             #np.savetxt(outfile,np.column_stack((t,y,dy,ddy,result_hold)),fmt='%.6e')
-            (h,b) = np.histogram(result_hold,bins = nbins,range=(en_low,en_high))
-            h = (h-jac)
-            inds = np.where(h>0)
-            hist[inds] += 1
             #hist += (h-jac)
 
             
@@ -119,11 +88,19 @@ def processfiles(filelist,c2):
 
 
 def main():
-    if len(sys.argv)<2:
-        print("I need a list of files to process")
+    # --cache=<dir> is where the ramp tables are kept, ./ramptables/ by default, never the scope data directories
+    cachepath = './ramptables/'
+    filelist = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--cache='):
+            cachepath = os.path.join(arg[len('--cache='):],'')
+        else:
+            filelist += [arg]
+    if len(filelist)<1:
+        print("I need a list of files to process, optionally --cache=<ramp table directory>")
         return
 
-    checkfile = sys.argv[1]
+    checkfile = filelist[0]
     m = re.search('(^.+/)(C\d--C\d.+).txt$',checkfile)
     if m:
         infile = open(m.group(0),'rt')
@@ -137,7 +114,7 @@ def main():
     cos2 = c2(f,bwd)
     data = np.zeros((nsamples,),dtype=float)
     nbins = 1024
-    (dirlist,bins,hist,jac) = processfiles(sys.argv[1:],cos2)
+    (dirlist,bins,hist,jac) = processfiles(filelist,cos2,bwd,cachepath)
     if m:
         headerStr = "\t".join(dirlist)
         outfilename = dirlist[-1] + 'hist.out'
@@ -1,6 +1,4 @@
 #!/usr/bin/bash
-nfiles=100
-for ((i=0;i<$nfiles;i++))
-do 
-	./src/generate_sinogram_imgseg.py ./data_sinograms/streaking.${i}.${HOSTNAME} 100 &
-done
+nimages=10000
+nworkers=$(( $(nproc)*3/4 ))
+./src/generate_sinogram_imgseg.py -j ${nworkers} ./data_sinograms/streaking.${HOSTNAME}/ ${nimages}
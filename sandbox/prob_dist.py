@@ -9,40 +9,85 @@ import re
 import multiprocessing as mp
 import os
 
+try:
+    from shardwriter import mergeshards # src/ on the PYTHONPATH
+except ImportError:
+    mergeshards = None
+
 def cossq(x,w,c):
     inds = np.where(np.abs(x.astype(float)-c)<w)
     y = np.zeros(x.shape)
     y[inds] = 0.5*(1+np.cos(np.pi*(x[inds].astype(float)-c)/w))
     return y
 
+def cossqcdf(x,w,c):
+    # running integral of cossq(x,w,c), total area w
+    u = np.clip((np.asarray(x,dtype=float)-c)/w,-1.,1.)
+    return 0.5*w*(u + 1. + np.sin(np.pi*u)/np.pi)
+
 def gauss(x,w,c):
     return np.exp(-((x.astype(float)-c)/w)**2)
 
-def build_XY(nenergies=128,nangles=64,drawscale = 10):
+def stackbins(imginds,e,vals,shape):
+    # sums vals[center,angle,j] into the (nimages x nenergies x nangles) stack at (imginds[center],e[center,angle,j],angle)
+    (nimages,nenergies,nangles) = shape
+    m = (e>=0) * (e<nenergies)
+    flat = np.broadcast_to((imginds[:,None,None]*nenergies + e)*nangles + np.arange(nangles)[None,:,None],vals.shape)
+    return np.bincount(flat[m],weights=vals[m],minlength=nimages*nenergies*nangles).reshape(shape)
+
+def build_XYs(nimages=1,nenergies=128,nangles=64,drawscale = 10,mode='sample',rng=None):
+    # a batch of images at once, ymats is (nimages x nenergies x nangles)
+    # hits come back CSR over (image,angle) rows, hits[offsets[i*nangles+a]:offsets[i*nangles+a+1]], sorted within each row
+    # mode='density' returns the (nimages x nenergies x nangles) poisson histograms on unit bins in place of hits,offsets,
+    # the expected counts are drawscale times the cossq area in each bin, so no electrons are drawn
+    if rng is None:
+        rng = np.random.default_rng()
     x = np.arange(nenergies,dtype=float)
     w = 5.
     amp = 30.
-    rng = np.random.default_rng()
-    ncenters = rng.poisson(3)
-    phases = rng.normal(np.pi,2,ncenters)
-    centers = rng.random(ncenters)*x.shape[0]
-    ymat = np.zeros((x.shape[0],nangles),dtype=float)
-    for i in range(len(centers)):
-        for a in range(nangles):
-            kick = amp*np.cos(a*2.*np.pi/nangles + phases[i])
-            ymat[:,a] += cossq(x,w,centers[i]+kick) # this produces the 2D PDF
-    cmat = np.cumsum(ymat,axis=0)
+    ncenters = rng.poisson(3,nimages)
+    imginds = np.repeat(np.arange(nimages),ncenters)
+    phases = rng.normal(np.pi,2,imginds.shape[0])
+    centers = rng.random(imginds.shape[0])*x.shape[0]
+    kicks = amp*np.cos(np.arange(nangles)[None,:]*2.*np.pi/nangles + phases[:,None]) # (ncenters x nangles)
+    # every bump only covers the 2w energies around its center, so the stack is built by one bincount over the
+    # flattened (image,energy,angle) index of those few points rather than over the full grid for every center
+    c = (centers[:,None] + kicks)[:,:,None] # (ncenters x nangles x 1)
+    j = np.arange(int(2*w)+2)[None,None,:]
+    shape = (nimages,nenergies,nangles)
+    e = np.ceil(c-w).astype(int) + j
+    d = e - c
+    ymats = stackbins(imginds,e,(np.abs(d)<w) * 0.5*(1+np.cos(np.pi*d/w)),shape) # this produces the 2D PDFs
+    if mode == 'density':
+        e = np.floor(c-w).astype(int) + j
+        areas = cossqcdf(e+1.,w,c) - cossqcdf(e,w,c)
+        return rng.poisson(np.maximum(drawscale*stackbins(imginds,e,areas,shape),0.)),ymats
+
     # the number of draws for each angle should be proportional to the total sum of that angle
-    hits = []
-    for a in range(nangles):
-        cum = cmat[-1,a]
-        draws = int(drawscale*cum)
-        drawpoints = np.sort(rng.random(draws))
-        if cum>0:
-            hits.append(list(np.interp(drawpoints,cmat[:,a]/cum,x)))
-        else:
-            hits.append([])
-    return hits,ymat
+    cmat = np.cumsum(ymats,axis=1).transpose((0,2,1)).reshape((nimages*nangles,nenergies)) # one row per (image,angle)
+    cum = cmat[:,-1]
+    draws = (drawscale*cum).astype(int)
+    offsets = np.concatenate(([0],np.cumsum(draws)))
+    rows = np.repeat(np.arange(cum.shape[0]),draws)
+    u = np.sort(rows + rng.random(rows.shape[0])) - rows # sorted within each row
+    cdf = cmat/np.where(cum>0,cum,1.)[:,None]
+    # one searchsorted for every row, shifting row r by r keeps the flattened cdf nondecreasing
+    # k is the first energy with cdf > u, the same segment np.interp(u,cdf,x) would use
+    k = np.searchsorted((np.arange(cum.shape[0])[:,None] + cdf).ravel(),rows + u,side='right') - rows*nenergies
+    k = np.clip(k,0,nenergies-1)
+    flat = rows*nenergies
+    lo = cdf.ravel()[flat + np.maximum(k-1,0)]
+    hi = cdf.ravel()[flat + k]
+    hits = np.where(k>0,(k-1) + (u-lo)/np.where(hi>lo,hi-lo,1.),0.)
+    return hits,offsets,ymats
+
+def build_XY(nenergies=128,nangles=64,drawscale = 10,mode='sample'):
+    # single image, hits as a list of per angle lists
+    if mode == 'density':
+        (hists,ymats) = build_XYs(1,nenergies,nangles,drawscale,mode=mode)
+        return hists[0],ymats[0]
+    (hits,offsets,ymats) = build_XYs(1,nenergies,nangles,drawscale)
+    return [list(hits[offsets[a]:offsets[a+1]]) for a in range(nangles)],ymats[0]
 
 class Params:
     def __init__(self,name,n):
@@ -51,6 +96,9 @@ class Params:
         self.nenergies = 128
         self.nangles = 64
         self.drawscale = 10
+        self.mode = 'sample'
+        self.batchsize = 256
+        self.shard = 0
 
     def setnenergies(self,n):
         self.nenergies = int(n)
@@ -61,6 +109,15 @@ class Params:
     def setdrawscale(self,n):
         self.drawscale = int(n)
         return self
+    def setmode(self,m):
+        self.mode = m
+        return self
+    def setshard(self,n):
+        self.shard = int(n)
+        return self
+    def setbatchsize(self,n):
+        self.batchsize = int(n)
+        return self
     def setofname(self,name):
         self.ofname = name
         return self
@@ -74,63 +131,93 @@ class Params:
         return self.nangles 
     def getdrawscale(self):
         return self.drawscale
+    def getmode(self):
+        return self.mode
+    def getshard(self):
+        return self.shard
+    def getbatchsize(self):
+        return self.batchsize
     def getofname(self):
         return self.ofname
     def getnimages(self):
         return self.nimages
 
+## one shard per worker, every dataset stacked along axis 0 so the shards merge into one virtual file
+##   keys                 (nimages,) sha256 image keys, the labels
+##   Ypdf                 (nimages x nenergies x nangles) float32
+##   Xhits, Xhits_offsets CSR over (image,angle) rows, image i angle a is row i*nangles+a
+##   Xhist                (nimages x nenergies x nangles) uint16, replaces Xhits in density mode
+
+def shardname(ofname,shard):
+    m = re.search('(^.*)\.h5',ofname)
+    return '%s.shard%03i.h5'%(m.group(1),shard)
+
 def runprocess(params):
     m = re.search('(^.*)\.h5',params.ofname)
     #print(params.ofname)
     if not m:
         print('failed filename match')
         return
-    ofname = '%s.pid%i.h5'%(m.group(1),os.getpid())
+    ofname = shardname(params.ofname,params.shard)
     nimages = params.nimages
     tstring = '%s%.9f'%(ofname,time.clock_gettime(time.CLOCK_REALTIME))
     keyhash = hashlib.sha256(bytearray(map(ord,tstring)))
-    with h5py.File(ofname,'a') as f:
-        for i in range(nimages):
-            bs = bytearray(map(ord,'shot_%i_'%i))
-            keyhash.update(bs)
-            key = keyhash.hexdigest()
-            grp = f.create_group(key)
-            nenergies = params.nenergies #128
-            nangles = params.nangles #64
-            drawscale = params.drawscale #10
-            X,Y = build_XY(nenergies = nenergies, nangles = nangles, drawscale = drawscale)
-            grp.create_dataset('Ypdf',data=Y,dtype=np.float32)
-            hitsvec = []
-            nedges = [0]
-            addresses = []
-            for h in X:
-                if len(h)==0:
-                    nedges += [0]
-                    addresses += [0]
-                else:
-                    nedges += [len(h)]
-                    addresses += [len(hitsvec)]
-                    hitsvec += h
-            grp.create_dataset('Xhits',data=hitsvec,dtype=np.float32)
-            grp.create_dataset('Xaddresses',data=addresses,dtype=int)
-            grp.create_dataset('Xnedges',data=nedges,dtype=int)
-            grp.attrs.create('nangles',nangles)
-            grp.attrs.create('nenergies',nenergies)
-            grp.attrs.create('drawscale',drawscale)
-    return
+    nenergies = params.nenergies #128
+    nangles = params.nangles #64
+    drawscale = params.drawscale #10
+    rng = np.random.default_rng()
+    chunks = (min(64,max(nimages,1)),nenergies,nangles)
+    with h5py.File(ofname + '.tmp','w') as f:
+        for k,v in (('nangles',nangles),('nenergies',nenergies),('drawscale',drawscale),('mode',params.mode),('nimages',nimages)):
+            f.attrs[k] = v
+        keys = f.create_dataset('keys',shape=(nimages,),dtype='S64')
+        Ypdf = f.create_dataset('Ypdf',shape=(nimages,nenergies,nangles),dtype=np.float32,chunks=chunks,compression='gzip')
+        if params.mode == 'density':
+            Xhist = f.create_dataset('Xhist',shape=(nimages,nenergies,nangles),dtype=np.uint16,chunks=chunks,compression='gzip')
+        else:
+            Xhits = f.create_dataset('Xhits',shape=(0,),maxshape=(None,),dtype=np.float32,chunks=(2**14,),compression='gzip')
+            Xoffsets = f.create_dataset('Xhits_offsets',shape=(nimages*nangles+1,),dtype=np.int64)
+        for b in range(0,nimages,params.batchsize):
+            nb = min(params.batchsize,nimages-b)
+            batchkeys = []
+            for i in range(nb):
+                bs = bytearray(map(ord,'shot_%i_'%(b+i)))
+                keyhash.update(bs)
+                batchkeys += [keyhash.hexdigest()]
+            keys[b:b+nb] = batchkeys
+            if params.mode == 'density':
+                (Xs,Ys) = build_XYs(nb,nenergies,nangles,drawscale,mode=params.mode,rng=rng)
+                Xhist[b:b+nb] = Xs
+                Ypdf[b:b+nb] = Ys
+                continue
+            (hits,offsets,Ys) = build_XYs(nb,nenergies,nangles,drawscale,rng=rng)
+            Ypdf[b:b+nb] = Ys
+            start = Xhits.shape[0]
+            Xhits.resize((start+hits.shape[0],))
+            Xhits[start:] = hits
+            Xoffsets[b*nangles:(b+nb)*nangles+1] = start + offsets
+    os.replace(ofname + '.tmp',ofname)
+    return ofname
 
 
 def main():
     if len(sys.argv)<5:
-        print('syntax: %s <outfilename.h5> <nimages> <nchannels> <nthreads>'%sys.argv[0])
+        print('syntax: %s <outfilename.h5> <nimages> <nchannels> <nthreads> <sample|density optional>'%sys.argv[0])
         return
 
-    paramslist = [Params('%s'%(sys.argv[1]),int(sys.argv[2])) for i in range(int(sys.argv[4]))]
+    paramslist = [Params('%s'%(sys.argv[1]),int(sys.argv[2])).setshard(i) for i in range(int(sys.argv[4]))]
     for p in paramslist:
         p.setnangles(int(sys.argv[3])).setdrawscale(2)
+        if len(sys.argv)>5:
+            p.setmode(sys.argv[5])
 
     with mp.Pool(processes=len(paramslist)) as pool:
-        pool.map(runprocess,paramslist)
+        shards = pool.map(runprocess,paramslist)
+
+    if mergeshards is None:
+        print('shards written, merge them with src/shardwriter.py %s %s'%(sys.argv[1],' '.join(shards)))
+        return
+    mergeshards(sys.argv[1],shards)
 
 
     return
@@ -1,44 +1,92 @@
 #!/usr/bin/python3
 
-import numpy
 import h5py
 import sys
 import re
 import numpy as np
 import multiprocessing as mp
 
-def sparse2dense(h5name,split=0.1):
-    rng = np.random.default_rng()
-    Y_train = []
-    X_train = []
-    Y_test = []
-    X_test = []
-    with h5py.File(h5name,'r') as f:
-        for i,k in enumerate(f.keys()):
-            grp = f[k]
-            headstr = str(k)
-            headstr += '\t%i_drawscale\t%i_nangles\t%i_nenergies'%(grp.attrs['drawscale'],grp.attrs['nangles'],grp.attrs['nenergies'])
-            hbins = np.arange(grp.attrs['nenergies']+1)
-            img = np.zeros((grp.attrs['nangles'],grp.attrs['nenergies']),dtype=np.uint16)
+def hitimage(grp,nangles,nenergies):
+    # one read of each dataset, Xnedges is [0,n_0,n_1,...] so its cumsum gives the per angle offsets into Xhits
+    if 'Xhist' in grp: # written by prob_dist in density mode, already histogrammed
+        return grp['Xhist'][()].T.astype(np.uint16)
+    hits = grp['Xhits'][()]
+    offsets = np.cumsum(grp['Xnedges'][()])
+    angleinds = np.repeat(np.arange(nangles),np.diff(offsets[:nangles+1]))
+    einds = np.floor(hits[:angleinds.shape[0]]).astype(int)
+    einds[einds==nenergies] = nenergies-1 # last histogram edge is inclusive
+    m = (einds>=0) * (einds<nenergies)
+    return np.bincount(angleinds[m]*nenergies + einds[m],minlength=nangles*nenergies).reshape((nangles,nenergies)).astype(np.uint16)
+
+def shardimages(f,b,nb,nangles,nenergies):
+    # images b:b+nb of a prob_dist shard (or merged shards), one read of their hits and one bincount for the block
+    if 'Xhist' in f:
+        return f['Xhist'][b:b+nb].transpose((0,2,1)).astype(np.uint16)
+    offsets = f['Xhits_offsets'][b*nangles:(b+nb)*nangles+1]
+    hits = f['Xhits'][offsets[0]:offsets[-1]]
+    rows = np.repeat(np.arange(nb*nangles),np.diff(offsets))
+    einds = np.floor(hits).astype(int)
+    einds[einds==nenergies] = nenergies-1 # last histogram edge is inclusive
+    m = (einds>=0) * (einds<nenergies)
+    return np.bincount(rows[m]*nenergies + einds[m],minlength=nb*nangles*nenergies).reshape((nb,nangles,nenergies)).astype(np.uint16)
+
+def readimages(f,chunkrows=64):
+    # (key, headstr, image, pdf) for every image, from either the per image groups or the stacked shard layout
+    if 'Ypdf' in f:
+        (nangles,nenergies,nimages) = (int(f.attrs['nangles']),int(f.attrs['nenergies']),f['Ypdf'].shape[0])
+        tail = '\t%i_drawscale\t%i_nangles\t%i_nenergies'%(f.attrs['drawscale'],nangles,nenergies)
+        for b in range(0,nimages,chunkrows):
+            nb = min(chunkrows,nimages-b)
+            imgs = shardimages(f,b,nb,nangles,nenergies)
+            pdfs = f['Ypdf'][b:b+nb].transpose((0,2,1))
+            keys = f['keys'][b:b+nb]
+            for i in range(nb):
+                yield (keys[i].decode(),keys[i].decode() + tail,imgs[i],pdfs[i])
+        return
+    for k in f.keys():
+        grp = f[k]
+        headstr = str(k)
+        headstr += '\t%i_drawscale\t%i_nangles\t%i_nenergies'%(grp.attrs['drawscale'],grp.attrs['nangles'],grp.attrs['nenergies'])
+        yield (k,headstr,hitimage(grp,int(grp.attrs['nangles']),int(grp.attrs['nenergies'])),grp['Ypdf'][()].T)
+
+def imageshape(f):
+    if 'Ypdf' in f:
+        return (f['Ypdf'].shape[0],int(f.attrs['nangles']),int(f.attrs['nenergies']))
+    keys = list(f.keys())
+    if len(keys)==0:
+        return (0,0,0)
+    return (len(keys),int(f[keys[0]].attrs['nangles']),int(f[keys[0]].attrs['nenergies']))
 
-            for a in range(grp.attrs['nangles']):
-                offset = grp['Xaddresses'][()][a]
-                nhits = grp['Xnedges'][()][a]
-                img[a,:] += np.histogram(grp['Xhits'][()][offset:offset+nhits],hbins)[0].astype(np.uint16)
+def createrows(f,name,nrows,shape,chunkrows=64):
+    return f.create_dataset(name,shape=(nrows,)+shape,maxshape=(None,)+shape,dtype=np.float32,chunks=(min(chunkrows,max(nrows,1)),)+shape)
 
-            if rng.uniform()<split:
-                X_test += [img]
-                Y_test += [f[k]['Ypdf'][()].T]
-            else:
-                X_train += [img]
-                Y_train += [f[k]['Ypdf'][()].T]
+def sparse2dense(h5name,trainname,testname,split=0.1,chunkrows=64):
+    # images stream straight into the X/Y datasets, sized for every image up front and trimmed at the end
+    rng = np.random.default_rng()
+    with h5py.File(h5name,'r') as f, h5py.File(trainname,'w') as ftrain, h5py.File(testname,'w') as ftest:
+        (nimages,nangles,nenergies) = imageshape(f)
+        if nimages==0:
+            return (0,0)
+        out = {}
+        for (fo,tag) in ((ftrain,'train'),(ftest,'test')):
+            out[tag] = [createrows(fo,'X_%s'%tag,nimages,(nangles,nenergies),chunkrows)
+                    ,createrows(fo,'Y_%s'%tag,nimages,(nangles,nenergies),chunkrows),0]
+        for i,(k,headstr,img,pdf) in enumerate(readimages(f,chunkrows)):
+            rows = out['test' if rng.uniform()<split else 'train']
+            rows[0][rows[2]] = img
+            rows[1][rows[2]] = pdf
+            rows[2] += 1
 
             if (i%5000==0):
                 ofname = '%s.shot_%i.dat'%(h5name,i)
                 oYname = '%s.pdf_%i.dat'%(h5name,i)
                 np.savetxt(ofname,img,fmt='%i',header=headstr)
-                np.savetxt(oYname,f[k]['Ypdf'][()].T,fmt='%.3f',header=headstr)
-    return X_train,Y_train,X_test,Y_test
+                np.savetxt(oYname,pdf,fmt='%.3f',header=headstr)
+        for tag in out.keys():
+            (X,Y,n) = out[tag]
+            X.resize((n,nangles,nenergies))
+            Y.resize((n,nangles,nenergies))
+    return (out['train'][2],out['test'][2])
 
 class Params:
     def __init__(self,iname,split=0.1):
@@ -53,13 +101,7 @@ class Params:
         return
 
 def runprocess(params):
-    X_train,Y_train,X_test,Y_test = sparse2dense(params.infname,split=params.testsplit)
-    with h5py.File(params.trainname,'a') as f:
-        f.create_dataset('Y_train',data=Y_train,dtype=np.float32)
-        f.create_dataset('X_train',data=X_train,dtype=np.float32)
-    with h5py.File(params.testname,'a') as f:
-        f.create_dataset('Y_test',data=Y_test,dtype=np.float32)
-        f.create_dataset('X_test',data=X_test,dtype=np.float32)
+    sparse2dense(params.infname,params.trainname,params.testname,split=params.testsplit)
 
 def main():
     if len(sys.argv)<3:
@@ -5,47 +5,61 @@ import sys
 import re   
 import glob
 from timeit import default_timer as timer
+from functools import lru_cache
 
 from utilities import gauss,sigmoid,highpass,lowpass
 
 from deconvolve_test import gauss
+from spectral import rfft,irfft,freqs,readonly,filterkernel,registerkernel,fftfilter,hermitianabs,cos2window
+
+## analog processing filters, f is normalized to the bandwidth and everything is zero outside |f| < 1
+## the kernels are registered with spectral so they are built once per (length, dt, bwd) and reused for every waveform
+
+def fpow(f,p):
+    # |f|**p with the DC bin left at zero
+    out = np.zeros(f.shape,dtype=float)
+    np.power(np.abs(f),p,out=out,where=(f!=0))
+    return out
+
+def logf(f,logscale=5e3):
+    out = np.zeros(f.shape,dtype=float)
+    np.log(np.abs(f)*logscale,out=out,where=(f!=0))
+    return np.maximum(out,0.)
+
+def logband(f):
+    return (np.abs(f) < 1.)*np.cos(f*np.pi/2.)*logf(f)*fpow(f,-0.2)
+
+ANALOGKERNELS = {
+        'theory_i' : lambda f,bwd: cos2window(f/bwd,1.)*fpow(f/bwd,-1),
+        'theory_ids' : lambda f,bwd: cos2window(f/bwd,1.),
+        'theory_ds' : lambda f,bwd: 1j*(f/bwd)*cos2window(f/bwd,1.),
+        'theory_dds' : lambda f,bwd: -np.power(f/bwd,int(2))*cos2window(f/bwd,1.),
+        'theory_smooth' : lambda f,bwd: cos2window(f/bwd,1.)*gauss(f/bwd,0,.1),
+        'log_i' : lambda f,bwd: logband(f/bwd)*fpow(f/bwd,-1),
+        'log_ids' : lambda f,bwd: logband(f/bwd),
+        'log_ds' : lambda f,bwd: 1j*np.sin(f/bwd*np.pi)*logband(f/bwd),
+        'log_dds' : lambda f,bwd: -np.sin(f/bwd*np.pi)*logband(f/bwd)*(f/bwd),
+        }
+for (kind,func) in ANALOGKERNELS.items():
+    registerkernel(kind,func)
+
+def filterbranches(invec,bwd,dt,kinds):
+    # spectrum, the filtered spectra and their real waveforms for each kernel kind
+    n = invec.shape[-1]
+    S = rfft(invec)
+    spectra = [S*filterkernel(n,float(dt),float(bwd),k) for k in kinds]
+    return (S,spectra,[irfft(X,n) for X in spectra])
+
+def filterresponses(n,bwd,dt,kinds,shift=100):
+    # impulse responses of the kernels, real since the kernels are hermitian
+    return [np.roll(irfft(filterkernel(n,float(dt),float(bwd),k),n),shift) for k in kinds]
 
 def analogprocess_theory(invec,bwd=2.4e9,dt=1):
-    f = np.fft.fftfreq(invec.shape[0],dt)/bwd
-    s = np.copy(invec)
-    S = np.fft.fft(s) 
-    I = np.zeros(S.shape,dtype = complex)
-    DS = np.zeros(S.shape,dtype = complex)
-    IDS = np.zeros(S.shape,dtype = complex)
-    DS = np.zeros(S.shape,dtype = complex)
-    DDS = np.zeros(S.shape,dtype = complex)
-    inds = np.where(np.abs(f) < 1.)
-    c2 = np.zeros(S.shape,dtype = float)
-    c2[inds] = np.power(np.cos(np.abs(f[inds])*np.pi/2.),int(2))
-    fpow1 = np.zeros(S.shape,dtype = float)
-    fpow2 = np.zeros(S.shape,dtype = float)
-    fpowm1 = np.zeros(S.shape,dtype = float)
-    fpow2 = np.power(f,int(2))
-    fpowm1[1:] = np.power(np.abs(f[1:]),-1)
-    FILT_I = np.zeros(S.shape,dtype = complex)
-    FILT_IDS = np.zeros(S.shape,dtype = complex)
-    FILT_DS = np.zeros(S.shape,dtype = complex)
-    FILT_DDS = np.zeros(S.shape,dtype = complex)
-    FILT_I[inds] = c2[inds]*fpowm1[inds] + 0j
-    FILT_IDS[inds] = c2[inds] + 0j
-    FILT_DS[inds] = 0. + 1j * f[inds]*c2[inds]
-    FILT_DDS[inds] = -fpow2[inds] * c2[inds] 
-    I[inds] = np.copy(S[inds]) * FILT_I[inds] 
-    IDS[inds] = np.copy(S[inds]) * FILT_IDS[inds]
-    DS[inds] = np.copy(S[inds]) * FILT_DS[inds] 
-    DDS[inds] = np.copy(S[inds]) * FILT_DDS[inds]
-
-    dds = np.fft.ifft(DDS).real
-    ds = np.fft.ifft(DS).real
-    ids = np.fft.ifft(IDS).real
-    i = np.fft.ifft(I).real
-
-    thresh = np.zeros(ids.shape,dtype = float)
+    n = invec.shape[0]
+    f = freqs(n,float(dt))/bwd
+    kinds = ('theory_i','theory_ids','theory_ds','theory_dds')
+    (S,(I,IDS,DS,DDS),(i,ids,ds,dds)) = filterbranches(invec,bwd,dt,kinds)
+
     thresh = ids * dds
     t = np.arange(invec.shape[0])
     capacitor = np.exp(-t/(invec.shape[0]/5))
@@ -54,72 +68,96 @@ def analogprocess_theory(invec,bwd=2.4e9,dt=1):
     #deltas = np.zeros(ids.shape,dtype = float)
     #inds = np.where(thresh < -5e-4)
     #deltas[inds] = np.abs(1./(ds[inds]))
-    NUM = np.fft.fft(sqrtitor * thresh)*c2*gauss(f,0,.1)
-    DENOM = np.fft.fft(thresh)*c2*gauss(f,0,.1)
-    deltas = np.fft.ifft(NUM).real/np.fft.ifft(DENOM).real
+    smooth = filterkernel(n,float(dt),float(bwd),'theory_smooth')
+    deltas = irfft(rfft(sqrtitor * thresh)*smooth,n)/irfft(rfft(thresh)*smooth,n)
     (h,bins) = np.histogram(deltas,2**8,range=(0.45,1.))
 
-    filt_i = np.roll(np.fft.ifft(FILT_I),100)
-    filt_ids = np.roll(np.fft.ifft(FILT_IDS),100)
-    filt_ds = np.roll(np.fft.ifft(FILT_DS),100)
-    filt_dds = np.roll(np.fft.ifft(FILT_DDS),100)
-
-    return ( np.column_stack(( f , np.abs(S), np.abs(I), np.abs(IDS), np.abs(DS), np.abs(DDS) , invec, i, ids,ds,dds,thresh,deltas,filt_i.real,filt_ids.real,filt_ds.real,filt_dds.real,filt_i.imag,filt_ids.imag,filt_ds.imag,filt_dds.imag)) , h )
-
-def analogprocess(invec,bwd=2.4e9,dt=1):
-    f = np.fft.fftfreq(invec.shape[0],dt)/bwd
-    s = np.copy(invec)
-    S = np.fft.fft(s)
-    I = np.zeros(S.shape,dtype = complex)
-    DS = np.zeros(S.shape,dtype = complex)
-    IDS = np.zeros(S.shape,dtype = complex)
-    DS = np.zeros(S.shape,dtype = complex)
-    DDS = np.zeros(S.shape,dtype = complex)
-    inds = np.where(np.abs(f) < 1.)
-    logscale = 5e3
-    logf = np.zeros(S.shape,dtype = float)
-    logf[1:] = np.log(np.abs(f[1:])*logscale)
-    linds = np.where( logf < 0 ) 
-    logf[linds] = 0.
-    fpowm1p2 = np.zeros(S.shape,dtype = float)
-    fpowm0p2 = np.zeros(S.shape,dtype = float)
-    fpowm1p2[1:] = np.power(np.abs(f[1:]),-1.2).real
-    fpowm0p2[1:] = np.power(np.abs(f[1:]),-0.2).real
-    FILT_I = np.zeros(S.shape,dtype = complex)
-    FILT_IDS = np.zeros(S.shape,dtype = complex)
-    FILT_DS = np.zeros(S.shape,dtype = complex)
-    FILT_DDS = np.zeros(S.shape,dtype = complex)
-    FILT_I[inds] = np.cos(np.abs(f[inds])*np.pi/2.)*logf[inds]*fpowm1p2[inds] + 0.j
-    FILT_IDS[inds] = np.cos(f[inds]*np.pi/2.)*logf[inds]*fpowm0p2[inds] + 0.j# already is leaving the 0th element zero via definition of logf and fpowm0p2
-    FILT_DS[inds] = 0. + 1j * np.sin(f[inds]*np.pi) * np.cos(f[inds]*np.pi/2.) * logf[inds] * fpowm0p2[inds]
-    FILT_DDS[inds] = -np.sin(f[inds]*np.pi) * np.cos(f[inds]*np.pi/2.) * logf[inds] * fpowm0p2[inds] * f[inds]  + 0.j
-    I[inds] = np.copy(S[inds]) * FILT_I[inds] 
-    IDS[inds] = np.copy(S[inds]) * FILT_IDS[inds]
-    DS[inds] = np.copy(S[inds]) * FILT_DS[inds] 
-    DDS[inds] = np.copy(S[inds]) * FILT_DDS[inds]
-    dds = np.fft.ifft(DDS).real
-    ds = np.fft.ifft(DS).real
-    ids = np.fft.ifft(IDS).real
-    i = np.fft.ifft(I).real
-
-    filt_i = np.roll(np.fft.ifft(FILT_I),100)
-    filt_ids = np.roll(np.fft.ifft(FILT_IDS),100)
-    filt_ds = np.roll(np.fft.ifft(FILT_DS),100)
-    filt_dds = np.roll(np.fft.ifft(FILT_DDS),100)
-
-    thresh = np.zeros(ids.shape,dtype = float)
-    thresh = ids * dds
-    deltas = np.zeros(ids.shape,dtype = float)
-    inds = np.where(thresh < -.1)
-    deltas[inds] = np.abs(1./(ds[inds]))
-    return np.column_stack(( f , np.abs(S), np.abs(I), np.abs(IDS), np.abs(DS), np.abs(DDS) , invec, i, ids,ds,dds,thresh,deltas,filt_i.real,filt_ids.real,filt_ds.real,filt_dds.real,filt_i.imag,filt_ids.imag,filt_ds.imag,filt_dds.imag))
+    filts = filterresponses(n,bwd,dt,kinds)
+    zero = np.zeros(n,dtype=float)
+    return ( np.column_stack(( f , *[hermitianabs(X,n) for X in (S,I,IDS,DS,DDS)] , invec, i, ids,ds,dds,thresh,deltas,*filts,zero,zero,zero,zero)) , h )
+
+## FilterBank holds the analog branch kernels of one (length, bwd, dt) as a (nbranches x nfreq) stack.
+## a (nwaveforms x nsamples) batch goes through one rfft and one irfft over every needed branch at once, only the
+## requested outputs are written, into caller supplied buffers if given. waveforms are processed in blocks so the
+## (nbranches x nblock x nfreq) complex temporary stays under maxbytes
+
+class FilterBank:
+    BRANCHES = ('i','ids','ds','dds')
+    OUTPUTS = ('i','ids','ds','dds','thresh','deltas')
+
+    def __init__(self,n,bwd=2.4e9,dt=1,kinds=('log_i','log_ids','log_ds','log_dds'),threshold=-.1):
+        self.n = int(n)
+        self.bwd = float(bwd)
+        self.dt = float(dt)
+        self.kinds = tuple(kinds)
+        self.threshold = threshold
+        self.kernels = np.stack([filterkernel(self.n,self.dt,self.bwd,k) for k in self.kinds])
+        self._responses = {}
+
+    def branches(self,outputs):
+        need = set(outputs)
+        if 'deltas' in need:
+            need |= {'thresh','ds'}
+        if 'thresh' in need:
+            need |= {'ids','dds'}
+        return [b for b in self.BRANCHES if b in need]
+
+    def buffers(self,nwaveforms,outputs=('ids','dds','thresh','deltas'),dtype=float):
+        return {name:np.empty((nwaveforms,self.n),dtype=dtype) for name in outputs}
+
+    def responses(self,shift=100):
+        # impulse responses of the branches, (nbranches x n), computed once per shift and read only
+        if shift not in self._responses:
+            self._responses[shift] = readonly(np.roll(irfft(self.kernels,self.n,axis=1),shift,axis=1))
+        return self._responses[shift]
+
+    def __call__(self,waveforms,outputs=('ids','dds','thresh','deltas'),out=None,maxbytes=2**28):
+        waveforms = np.atleast_2d(waveforms)
+        if out is None:
+            out = self.buffers(waveforms.shape[0],outputs)
+        branches = self.branches(outputs)
+        kernels = self.kernels[[self.BRANCHES.index(b) for b in branches]]
+        nblock = max(1,int(maxbytes//(len(branches)*self.kernels.shape[1]*16)))
+        for w in range(0,waveforms.shape[0],nblock):
+            block = slice(w,min(w+nblock,waveforms.shape[0]))
+            S = rfft(waveforms[block],axis=1)
+            y = dict(zip(branches,irfft(kernels[:,None,:]*S[None,:,:],self.n,axis=2)))
+            if 'thresh' in outputs or 'deltas' in outputs:
+                y['thresh'] = y['ids']*y['dds']
+            if 'deltas' in outputs:
+                deltas = np.zeros(y['ds'].shape,dtype=float)
+                np.divide(1.,y['ds'],out=deltas,where=(y['thresh'] < self.threshold))
+                y['deltas'] = np.abs(deltas)
+            for name in outputs:
+                out[name][block] = y[name]
+        return out
+
+def filterbank(n,bwd=2.4e9,dt=1):
+    return cachedfilterbank(int(n),float(bwd),float(dt))
+
+@lru_cache(maxsize=16)
+def cachedfilterbank(n,bwd,dt):
+    return FilterBank(n,bwd,dt)
+
+def analogprocess(invec,bwd=2.4e9,dt=1,y=None):
+    # single waveform with every intermediate, for the .analogprocess.out files, batches go through filterbank() directly
+    # y is this waveform's row of a batch already run through the bank, {name: (1 x n)} for every name in OUTPUTS
+    n = invec.shape[0]
+    f = freqs(n,float(dt))/bwd
+    bank = filterbank(n,bwd,dt)
+    if y is None:
+        y = bank(invec,outputs=bank.OUTPUTS)
+    S = rfft(invec)
+    spectra = [hermitianabs(S*k,n) for k in bank.kernels]
+    zero = np.zeros(n,dtype=float)
+    return np.column_stack(( f , hermitianabs(S,n), *spectra , invec, *[y[name][0] for name in bank.OUTPUTS], *bank.responses(), zero,zero,zero,zero))
 
 def althomomorphic(invec,ir,bwd=2.4e9,dt=1.):
-    f = np.fft.fftfreq(invec.shape[0],dt) 
+    n = invec.shape[0]
     ir_roll = np.copy(ir)
     i = np.argmin(ir_roll)
     ir_roll = np.roll(ir_roll,-i)
-    y = np.fft.ifft( np.fft.fft(np.copy(invec))*gauss(f,0,bwd) ).real
+    y = fftfilter(invec,dt,bwd,'gauss',pad=True)
     ys = np.sign(y)
     #dy = np.fft.ifft( np.fft.fft(np.copy(y))*1j*f*gauss(f,0,bwd)  )
     #y = y.real + 1j*dy.real
@@ -140,26 +178,28 @@ def althomomorphic(invec,ir,bwd=2.4e9,dt=1.):
     inds = np.where(ra<lowlim)
     ra[inds] += 1j*1e-15
     rla = np.log(ra)
+    # the log magnitudes are complex, these transforms stay on the full grid
+    lowfilt = filterkernel(n,float(dt),float(bwd),'gauss',full=True)
     Y = np.fft.fft(yla)
-    Ylow = np.copy(Y)*gauss(f,0,bwd)
-    Yhigh = np.copy(Y)*highpass(f,2*bwd,bwd/2)
+    Ylow = Y*lowfilt
+    Yhigh = Y*filterkernel(n,float(dt),float(bwd),'highpass',full=True)
     R = np.fft.fft(rla)
-    Rlow = np.copy(R)*gauss(f,0,bwd)
-    RES = (Ylow-Yhigh)*gauss(f,0,bwd)
+    Rlow = R*lowfilt
+    RES = (Ylow-Yhigh)*lowfilt
     result = np.exp(np.fft.ifft(RES))*ys*rs
     return (result.real,result.imag)
 
 def homomorphic(invec,ir,bwd=3.2e9,dt=1.):
-    f = np.fft.fftfreq(invec.shape[0],dt) 
+    lowfilt = filterkernel(invec.shape[0],float(dt),float(bwd),'gauss',full=True)
     ir_roll = np.copy(ir)
     i = np.argmin(ir_roll)
     ir_roll = np.roll(ir_roll,-i)
     y = np.copy(invec)
     Y = np.fft.fft(y)
     R = np.fft.fft(ir_roll)
-    YA = np.abs(np.copy(Y))*gauss(f,0,bwd)
+    YA = np.abs(Y)*lowfilt
     YS = np.angle(Y)
-    RA = np.abs(np.copy(R))*gauss(f,0,bwd)
+    RA = np.abs(R)*lowfilt
     RS = np.angle(R)
     qya = np.fft.fft(YA)
     qra = np.fft.fft(RA)
@@ -245,7 +285,7 @@ def main(runAve=False):
     timesnames = 'data_fs/raw/CookieBox_waveforms.times.dat'
     times = np.loadtxt(timesnames)*1e-9
     dt = times[1]-times[0]
-    freqs = np.fft.fftfreq(len(times),dt)
+    fvec = np.fft.fftfreq(len(times),dt)
     if runAve:
         dfiltfull = np.zeros(len(times),dtype=float)
         dfiltfull[:len(dfilt)] = np.copy(dfilt)
@@ -257,12 +297,13 @@ def main(runAve=False):
             image = int(m.group(4))
             waveformsnames = m.group(0) 
             waveforms = np.loadtxt(waveformsnames)
-            WAVEFORMS = np.fft.fft(np.copy(waveforms),axis=1)
             waveforms_deconv = np.zeros(waveforms.shape,dtype=float)
             waveforms_homodeconv = np.zeros(waveforms.shape,dtype=float)
             waveforms_homodeconv_imag = np.zeros(waveforms.shape,dtype=float)
+            bank = filterbank(waveforms.shape[1],2.4e9,dt)
+            analog = bank(waveforms,outputs=bank.OUTPUTS)
             c = 4
-            outresult = analogprocess(waveforms[c,:],bwd=2.4e9,dt=dt)
+            outresult = analogprocess(waveforms[c,:],bwd=2.4e9,dt=dt,y={name:analog[name][c:c+1] for name in bank.OUTPUTS})
             (theoryresult,h) = analogprocess_theory(waveforms[c,:],bwd=2.4e9,dt=dt)
 
             energiesfile = m.group(1) + 'raw/CookieBox_Energies.' + m.group(3) + 'pulses.image' + m.group(4) + '.dat'
@@ -272,9 +313,8 @@ def main(runAve=False):
 # Now, build a histogram of the energies file CookieBox_Energies.4pulses.image101.dat with also 2**10 bins, then plot the two histograms against each other
 # Plot them as you used to with the coincidence method, e.g. <h1 h2> / <h1><h2>
             for c in range(waveforms.shape[0]):
-                #wf_filt = np.fft.ifft(WAVEFORMS[c,:] * gauss(freqs,0,3.2e9)).real
                 if runAve:
-                    waveforms_deconv[c,:] = altconv(freqs,waveforms[c,:],dfiltfull)*1e-36
+                    waveforms_deconv[c,:] = altconv(fvec,waveforms[c,:],dfiltfull)*1e-36
                     (waveforms_homodeconv[c,:],waveforms_homodeconv_imag[c,:]) = homomorphic(waveforms[c,:],dfiltfull,2.4e9,dt)
             if runAve:
                 outname = m.group(1)+'processed/'+m.group(2)+'.deconv.out'
@@ -293,6 +333,9 @@ def main(runAve=False):
             #print(out.shape)
             #outname = m.group(1)+'processed/'+m.group(2)+'.analogtheory.cormat'
             #np.savetxt(outname,out,fmt='%.3e') 
+            for name in ('thresh','deltas'):
+                outname = m.group(1)+'processed/'+m.group(2)+'.analogprocess.'+name+'.out'
+                np.savetxt(outname,analog[name],fmt='%.4e')
             outname = m.group(1)+'processed/'+m.group(2)+'.analogprocess.out'
             np.savetxt(outname,outresult,fmt='%.4e') 
             print('printed {}'.format(outname))
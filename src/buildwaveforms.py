@@ -1,11 +1,13 @@
 #!/usr/bin/python3
 
+import os
 from os import getpid
 from hashlib import sha1,sha256
 from multiprocessing import Process,cpu_count,Pool
 from ctypes import Structure,c_double,c_int,c_uint,c_wchar_p
 from multiprocessing.sharedctypes import Value,Array
 from time import time
+from functools import lru_cache
 from timeit import timeit
 from timeit import default_timer as timer
 import sys
@@ -28,7 +30,7 @@ from numpy.random import choice, shuffle, gamma, randn,rand,random_integers,perm
 from random import randrange, randint
 from numpy.fft import fft as FFT
 from numpy.fft import ifft as IFFT
-from numpy.fft import fftfreq as FREQ
+from spectral import freqs as FREQ
 from scipy.constants import c
 from scipy.constants import physical_constants as pc
 from scipy.stats import gengamma
@@ -43,117 +45,127 @@ e_mc2 *= 1e6 # eV now
 re *= 1e2 # in centimeters now
 
 
-from generate_distribution import fillcollection
+from generate_distribution import fillcollections
+from waveformsynth import synthshot,StampBank,stampaccuracy,colorednoise
 
-from cmath import rect
-nprect = vectorize(rect)
+from phasors import rect,phaseramp
+from shardwriter import ShardWriter,appendindex
+from simdriver import runchunks
+from tofkernel import energy2time,energy2time_full
+from wfkernels import stamphits,stamphits_csr,holdhist
+from ramptable import RampTable
+from irlibrary import readtrace,inputhash,librarypath,latestlibrary,writelibrary,readlibrary,readnoisepsd
 
-def waveform2hist(wf):
-    result = [0]*(2**12)
-    for i in range(2,len(wf)):
-        if wf[i] == wf[i-1] == wf[i-2]:
-            if (wf[i]>0) * (wf[i]<len(result)):
-                result[int(wf[i])] = 1
-    return result
+irfilematch = './data_fs/ave1/C1--LowPulseHighRes-in-100-out1700-an2100--*.txt'
+
+def waveform2hist(wf,backend='numpy'):
+    return holdhist(wf,2**12,backend)
 
 def multidischarge(t,amps,alphas,t0s):
-    result = int(0)
+    t = np.asarray(t,dtype=float)
+    result = np.zeros(t.shape,dtype=int)
     for i in range(len(t0s)):
-        if t<=t0s[i]:
-            result += amps[i]
-        if t>t0s[i]:
-            result += int(amps[i]*np.exp(-alphas[i]*(t-t0s[i])))
+        result += np.where(t<=t0s[i],int(amps[i]),np.trunc(amps[i]*np.exp(-alphas[i]*(t-t0s[i]))).astype(int))
     return result
 
 def discharge(a,alpha,t,t0):
-    return int(a*np.exp(-alpha*(t-t0)))
+    return np.trunc(a*np.exp(-alpha*(np.asarray(t)-t0))).astype(int)
 
 def charge(a,alpha,t,t0):
-    return int( a - discharge(a,alpha,t,t0) )
-
-def map2chargedischarge(toflist,times,ramp):
-    tvec = np.arange(0,1.e3,step=1./6.4,dtype=float)
-    sz = len(tvec)
-    alpha = [6e-3]
-    amp = [2**12]
-    istart = int(250)
-    t0 = [tvec[istart]]
-    i = int(0);
-    tlist = np.sort(toflist)
-    result = np.zeros(tvec.shape[0],dtype=float)
-    for t in tlist:
-        while t>tvec[i]:
-            i += 1
-            if i > len(tvec)-1:
-                return result
-        for j in range(3):
-            t-t0
-            result[i+j] = ((t-tvec[istart])< tvec[sz//2]? )
-            HREE HERE HERE HERE
-        i += j
-        if i > (tvec.shape[0] - 1): 
-            return result
-        return
-
-    '''
-    f(x)=((int(x)%1000)<500?2**12*exp(-alpha*(int(x)%1000)):2**12*(1-exp(-alpha*(( int(x)%1000)-500)))+2**12*exp(-alpha*(int(500)%1000)))
-    f(x+period - t0)
-    '''
-
-def map2multiwaveform(toflist):
-    tvec = np.arange(0,1.e3,step=1./6,dtype=float)
-    sz = len(tvec)
-    alphas = [6.e-3,6.e-3,2.e-3]
-    amps = [2**10 *3,2**10]
+    return np.trunc( a - discharge(a,alpha,t,t0) ).astype(int)
+
+def chargedischarge(t,amp,alpha,halfperiod):
+    # periodic ramp, discharging from amp over the first half period then charging back up to amp
+    # f(x)=((int(x)%1000)<500?2**12*exp(-alpha*(int(x)%1000)):2**12*(1-exp(-alpha*(( int(x)%1000)-500)))+2**12*exp(-alpha*(int(500)%1000)))
+    x = np.mod(np.asarray(t,dtype=float),2.*halfperiod)
+    low = amp*np.exp(-alpha*halfperiod)
+    return np.trunc(np.where(x < halfperiod,amp*np.exp(-alpha*x),amp*(1.-np.exp(-alpha*(x-halfperiod)))+low)).astype(int)
+
+@lru_cache(maxsize=8)
+def cachedramp(tvecbytes,istart,alpha,amp):
+    tvec = np.frombuffer(tvecbytes,dtype=float)
+    (t0,halfperiod) = (tvec[istart],tvec[tvec.shape[0]//2]-tvec[0])
+    func = lambda t: chargedischarge(np.asarray(t)-t0,amp,alpha,halfperiod)
+    return RampTable(func(tvec),np.arange(amp+1)-.5,func=func)
+
+def buildramp(tvec,istart=250,alpha=6e-3,amp=2**12):
+    # the hit free charge/discharge ramp on tvec, starting its discharge at tvec[istart] with a period of the
+    # first half of tvec, computed once per (tvec, istart, alpha, amp) and shared read only, bin k holds the value k
+    return cachedramp(np.ascontiguousarray(tvec,dtype=float).tobytes(),int(istart),float(alpha),int(amp))
+
+def map2chargedischarge(toflist,times,ramp,backend='numpy'):
+    # ramp from buildramp(times), every hit holds the ramp value at its time for 3 samples
+    result = np.array(ramp.ramp,dtype=int)
+    return stamphits(result,times,toflist,lambda t,pos: ramp.valueat(t),backend=backend)
+
+def chargedischargehist(wfs,ramp):
+    # 1 in every bin a hit put more samples in than the hit free ramp has, the ramp's slow stretches hold values
+    # for 3 samples on their own so waveform2hist would mark them without any hit
+    return (ramp.tracecounts(wfs) > 0).astype(int)
+
+def map2chargedischarge_shot(toflists,times,ramp):
+    # map2chargedischarge for all channels of a shot at once, (nchannels x len(times))
+    counts = [len(toflist) for toflist in toflists]
+    indptr = np.concatenate(([0],np.cumsum(counts))).astype(int)
+    tofs = np.concatenate([np.asarray(toflist,dtype=float) for toflist in toflists]) if indptr[-1] > 0 else np.zeros((0,))
+    result = np.tile(np.asarray(ramp.ramp,dtype=int),(len(toflists),1))
+    return stamphits_csr(result,times,tofs,indptr,lambda t,pos: ramp.valueat(t))
+
+@lru_cache(maxsize=8)
+def multiwaveformbase(step,amps,alphas,istart,isecond):
+    # the hit free waveform, computed once per parameter set, callers copy it
+    tvec = np.arange(0,1.e3,step=step,dtype=float)
+    t0s = (tvec[istart], tvec[isecond])
+    result = np.zeros(tvec.shape[0],dtype=int)
+    result[:istart] = sum(amps)
+    result[istart:] = multidischarge(tvec[istart:],amps,alphas,t0s)
+    tvec.flags.writeable = False
+    result.flags.writeable = False
+    return (tvec,t0s,result)
+
+def map2multiwaveform(toflist,backend='numpy'):
+    alphas = (6.e-3,6.e-3,2.e-3)
+    amps = (2**10 *3,2**10)
     istart=int(250)
-    t0s = [tvec[istart], tvec[2000]]#,tvec[istart+2500]]
-    result = [sum(amps)]*istart + [multidischarge(tvec[i],amps,alphas,t0s) for i in range(istart,sz)]
-    i = 0
-    for t in toflist:
-        while t>tvec[i]:
-            i += 1
-            if i > len(tvec)-1:
-                return result
-        for j in range(3):
-            result[i+j] = multidischarge(t,amps,alphas,t0s)
-        i += j
-        if i > len(tvec)-1:
-            return result
-    return result
-
-def map2waveform(toflist):
+    (tvec,t0s,base) = multiwaveformbase(1./6,amps,alphas,istart,2000)#,tvec[istart+2500]]
+    result = base.copy()
+    return stamphits(result,tvec,toflist,lambda t,pos: multidischarge(t,amps,alphas,t0s),backend=backend)
+
+@lru_cache(maxsize=8)
+def waveformbase(step,amp,alpha,istart):
+    # the hit free waveform, computed once per parameter set, callers copy it
+    tvec = np.arange(0,1.e3,step=step,dtype=float)
+    sz = len(tvec)
+    result = np.zeros(sz,dtype=int)
+    result[:istart] = -discharge(amp,alpha,tvec[sz//2+istart],tvec[istart]) - charge(amp,alpha,tvec[:istart],tvec[istart]-tvec[sz//2])
+    result[istart:sz//2+istart] = discharge(amp,alpha,tvec[istart:sz//2+istart],tvec[istart])
+    result[sz//2+istart:] = -discharge(amp,alpha,tvec[sz//2+istart],tvec[istart]) - charge(amp,alpha,tvec[sz//2+istart:],tvec[istart+sz//2])
+    tvec.flags.writeable = False
+    result.flags.writeable = False
+    return (tvec,result)
+
+def map2waveform(toflist,backend='numpy'):
     alpha = 3.e-3
     amp = np.power(float(2),int(11))
-    tvec = np.arange(0,1.e3,step=1./6,dtype=float)
-    sz = len(tvec)
     istart = int(250)
-    result = [-discharge(amp,alpha,tvec[sz//2+istart],tvec[istart]) - charge(amp,alpha,tvec[i],tvec[istart]-tvec[sz//2]) for i in range(istart)]
-    result += [discharge(amp,alpha,tvec[i],tvec[istart]) for i in range(istart,sz//2+istart)]
-    result += [-discharge(amp,alpha,tvec[sz//2+istart],tvec[istart]) - charge(amp,alpha,tvec[i],tvec[istart+sz//2]) for i in range(sz//2+istart,sz)]
-    i = 0
-    for t in toflist:
-        while t>tvec[i]:
-            i += 1
-            if i > len(tvec)-1:
-                return result
-        for j in range(3):
-            if (i+j) < len(result)//2+istart:
-                result[i+j] = discharge(amp,alpha,t,tvec[istart])
-            if (i+j) >= len(result)//2+istart and (i+j) < len(result):
-                result[i+j] = -discharge(amp,alpha,tvec[sz//2+istart],tvec[istart]) - charge(amp,alpha,t,tvec[istart+len(result)//2])
-        i += j
-        if i > len(tvec)-1:
-            return result
+    (tvec,base) = waveformbase(1./6,amp,alpha,istart)
+    sz = len(tvec)
+    result = base.copy()
+    def hitvalues(t,pos):
+        return np.where(pos < sz//2+istart
+                , discharge(amp,alpha,t,tvec[istart])
+                , -discharge(amp,alpha,tvec[sz//2+istart],tvec[istart]) - charge(amp,alpha,t,tvec[istart+sz//2]))
+    return stamphits(result,tvec,toflist,hitvalues,backend=backend)
+
+def padrows(values,offsets):
+    # CSR rows values[offsets[i]:offsets[i+1]] into a zero padded dense (nrows x longest row)
+    counts = diff(offsets)
+    result = zeros((counts.shape[0],max(npmax(counts),0)),dtype=float)
+    rows = np.repeat(arange(counts.shape[0]),counts)
+    inds = arange(offsets[0],offsets[-1])
+    result[rows,inds-np.repeat(offsets[:-1],counts)] = values[inds]
     return result
 
-def energy2time(e,r=0,d1=3.75,d2=5,d3=35):
-    #distances are in centimiters and energies are in eV and times are in ns
-    C_cmPns = c*100.*1e-9
-    t = 1.e3 + zeros(e.shape,dtype=float);
-    if r==0:
-        return nparray([ (d1+d2+d3)/C_cmPns * npsqrt(e_mc2/(2.*en)) for en in e if en > 0])
-    return nparray([d1/C_cmPns * npsqrt(e_mc2/(2.*en)) + d3/C_cmPns * npsqrt(e_mc2/(2.*(en-r))) + d2/C_cmPns * npsqrt(2)*(e_mc2/r)*(npsqrt(en/e_mc2) - npsqrt((en-r)/e_mc2)) for en in e if en>r])
-
 def Weiner(f,s,n,cut,p):
     w=zeros(f.shape[0])
     #print(w.shape)
@@ -167,18 +179,14 @@ def fourier_delay(f,dt):
     ## int f(t) exp(i*w*t) dt
     ## int f(t+tau) exp(i*w*t) dt --> int f(t)exp(i*w*t)exp(-i*w*tau) dt
     ## IFFT{ F(w) exp(-i*w*tau) }
-    return nprect(ones(f.shape),-f*2.*pi*dt)
+    return phaseramp(f,dt)
 
 def fourier_delay_matrix(f,t):
-    fmat = np.tile(f,(t.shape[0],1)).T
-    tmat = np.tile(t,(f.shape[0],1))
-    return nprect(ones((f.shape[0],t.shape[0])),-2.*pi*fmat*tmat)
+    return phaseramp(f,t)
 
-def fillimpulseresponses(printfiles = True,samplefiles = False):
-    (s_collection_ft,n_collection_ft) = (nparray([0,0,0],dtype=complex),nparray([0,0,0],dtype=complex))
-    filepath = './data_fs/ave1/'
-    filematch = filepath + 'C1--LowPulseHighRes-in-100-out1700-an2100--*.txt'
-    filelist = glob.glob(filematch)
+def fillimpulseresponses(printfiles = True,samplefiles = False,filematch = irfilematch,outpath = './data_fs/extern/'):
+    (s_collection_ft,n_collection_ft) = ([],[])
+    filelist = sorted(glob.glob(filematch))
 
 
     print('filling impulse response files\n\tnum files = %i' % len(filelist))
@@ -193,17 +201,7 @@ def fillimpulseresponses(printfiles = True,samplefiles = False):
             outname_time = m.group(1) + '.time.dat'
             outname_simTOF = m.group(1) + '.simTOF.dat'
 
-        fi = open(f, "r")
-        for passline in range(6):
-            headline = '# ' + fi.readline()
-        (t,v) = fi.readline().split()
-        v_vec=nparray(float(v),dtype=float)
-        t_vec=nparray(float(t)*1.e9,dtype=float)
-        for line in fi:
-            (t,v) = line.split()
-            v_vec = row_stack((v_vec,float(v)))
-            t_vec = row_stack((t_vec,float(t)*1.e9))
-        fi.close()
+        (t_vec,v_vec) = readtrace(f)
         #Get the mean time-step for sake of frequencies
         dt = mean(diff(t_vec,n=1,axis=0))
         #FFT the vector
@@ -211,7 +209,7 @@ def fillimpulseresponses(printfiles = True,samplefiles = False):
         f = FREQ(v_vec_ft.shape[0],dt)
         m_extend = 10
         f_extend = FREQ(v_vec_ft.shape[0]*m_extend,dt)
-        t_extend = arange(0,((t_vec[-1]-t_vec[0])+dt)*m_extend,dt)
+        t_extend = arange(0,((t_vec[-1,0]-t_vec[0,0])+dt)*m_extend,dt)
         # deep copy for the noise extimation 
         n_vec_ft = npcopy(v_vec_ft)
         # find indices where there is only noise in the power, and indices with predominantly signal
@@ -226,14 +224,8 @@ def fillimpulseresponses(printfiles = True,samplefiles = False):
         inds = argsort(f)
         n_vec_extend_ft_r = interp(f_extend,f[inds],npabs(n_vec_ft[inds,0]))
         n_vec_extend_ft_phi = choice(npangle(n_vec_ft[:,0]),f_extend.shape[0])
-        n_vec_extend_ft = nprect(n_vec_extend_ft_r,n_vec_extend_ft_phi)
-        n_vec_extend_ft.shape = (n_vec_extend_ft.shape[0],1)
-        
-        if n_collection_ft.shape[0] < n_vec_extend_ft.shape[0]:
-            n_collection_ft = npcopy(n_vec_extend_ft)
-           # s_collection_ft.shape = (s_collection_ft.shape[0],1)
-        else:
-            n_collection_ft = column_stack((n_collection_ft,n_vec_extend_ft))
+        n_vec_extend_ft = rect(n_vec_extend_ft_r,n_vec_extend_ft_phi)
+        n_collection_ft += [n_vec_extend_ft]
 
         ## build signal vector and add to n_collection_ft
         noiseamp = nppower(mean(npabs(values)),int(2))
@@ -250,38 +242,107 @@ def fillimpulseresponses(printfiles = True,samplefiles = False):
         s_vec_extend[:s_vec.shape[0],0] = s_vec[:,0]
         s_vec_extend_ft = FFT(s_vec_extend,axis=0)
 
-        if s_collection_ft.shape[0] < s_vec_extend_ft.shape[0]:
-            s_collection_ft = npcopy(s_vec_extend_ft)
-           # s_collection_ft.shape = (s_collection_ft.shape[0],1)
-        else:
-            s_collection_ft = column_stack((s_collection_ft,s_vec_extend_ft))
+        s_collection_ft += [s_vec_extend_ft[:,0]]
 
         # first sum all the Weiner filtered and foureir_delay() signals, then add the single noise vector back
+    s_collection_ft = column_stack(s_collection_ft)
+    n_collection_ft = column_stack(n_collection_ft)
     if printfiles:
-        outpath = './data_fs/extern/'
-        filename = outpath + 'signal_collection_ft'
-        npsave(filename,s_collection_ft)
-        filename = outpath + 'noise_collection_ft'
-        npsave(filename,n_collection_ft)
-        filename = outpath + 'frequencies_collection'
-        npsave(filename,f_extend)
-        filename = outpath + 'times_collection'
-        npsave(filename,t_extend)
+        hashstring = inputhash(filelist)
+        writelibrary(librarypath(outpath,hashstring),s_collection_ft,n_collection_ft,f_extend,t_extend,hashstring,filelist)
 
     return (s_collection_ft,n_collection_ft,f_extend,t_extend)
 
-def readimpulseresponses(filepath='./data_fs/extern/'):
-    name = filepath + 'signal_collection_ft.npy'
-    s = npload(name)
-    name = filepath + 'noise_collection_ft.npy'
-    n = npload(name)
-    name = filepath + 'times_collection.npy'
-    t = npload(name)
-    name = filepath + 'frequencies_collection.npy'
-    f = npload(name)
-    return (s,n,f,t)
-
-def simulate_timeenergy(timeenergy,nchannels=16,e_retardation=0,energywin=(590,610),max_streak=20,printfiles = False):
+def impulselibrary(filepath='./data_fs/extern/'):
+    # filepath is either a library directory or the extern directory holding libraries, in which case the newest is used
+    if not os.path.exists(filepath + 'signal_collection_ft.npy'):
+        libpath = latestlibrary(filepath)
+        if libpath is None:
+            raise FileNotFoundError('no impulse response library in {}, build one with updateimpulselibrary()'.format(filepath))
+        filepath = libpath
+    return filepath
+
+@lru_cache(maxsize=4)
+def updateimpulselibrary(filematch = irfilematch,outpath = './data_fs/extern/'):
+    # only rebuilds the library if no library exists for the current content of the scope traces
+    # cached, the scope traces are globbed and hashed once per process rather than once per shot
+    libpath = librarypath(outpath,inputhash(glob.glob(filematch)))
+    if not os.path.exists(libpath + 'inputs.sha256'):
+        fillimpulseresponses(printfiles=True,filematch=filematch,outpath=outpath)
+    return libpath
+
+def readimpulseresponses(filepath='./data_fs/extern/',mmap_mode='r'):
+    return readlibrary(impulselibrary(filepath),mmap_mode=mmap_mode)
+
+def loadimpulseresponses(filematch = irfilematch,outpath = './data_fs/extern/',mmap_mode='r'):
+    return readlibrary(updateimpulselibrary(filematch,outpath),mmap_mode=mmap_mode)
+
+def stampbankname(libpath,nphases):
+    # banks live in the library directory, which is named for the hash of its inputs
+    return '%sstampbank.p%05i.npy'%(libpath,nphases)
+
+def stampchoicename(libpath,tol,maxbytes):
+    return '%sstampbank.tol%.1e.max%i.txt'%(libpath,tol,maxbytes)
+
+def buildstampbank(libpath,nphases,s_collection_ft,dt):
+    fname = stampbankname(libpath,nphases)
+    bank = StampBank(s_collection_ft,dt,nphases=nphases)
+    bank.save(fname)
+    return bank
+
+def choosestampphases(libpath,tol=1e-3,maxbytes=2**28):
+    # the bank error depends on the library's bandwidth and falls as 1/nphases, so it is measured with stampaccuracy()
+    # at 64 phases, the bank is built at the predicted count and doubled while still above tol. the bank has to fit
+    # maxbytes, when that caps nphases the error reached is reported. the choice is kept next to the library
+    choicename = stampchoicename(libpath,tol,maxbytes)
+    if os.path.exists(choicename):
+        with open(choicename,'r') as fi:
+            return int(fi.readline().split()[0])
+    (s_collection_ft,n_collection_ft,f_extend,t_extend) = readlibrary(libpath)
+    dt = t_extend[1]-t_extend[0]
+    perphase = StampBank(s_collection_ft,dt,nphases=1).bank.nbytes
+    maxphases = int(2**np.floor(np.log2(max(maxbytes//perphase,1))))
+    nphases = min(64,maxphases)
+    bank = buildstampbank(libpath,nphases,s_collection_ft,dt)
+    (rms,peak) = stampaccuracy(bank,s_collection_ft,f_extend,rng=np.random.default_rng(0))
+    if rms > tol:
+        nphases = min(maxphases,int(nphases*2**np.ceil(np.log2(rms/tol))))
+    while nphases != bank.nphases:
+        bank = buildstampbank(libpath,nphases,s_collection_ft,dt)
+        (rms,peak) = stampaccuracy(bank,s_collection_ft,f_extend,rng=np.random.default_rng(0))
+        if rms > tol and 2*nphases <= maxphases:
+            nphases *= 2
+    if rms > tol:
+        print('stamp bank for {} capped at {} phases ({} bytes) by maxbytes {}, relative rms error {:.2e} is above tol {:.1e}, peak {:.2e}'.format(
+            libpath,nphases,bank.bank.nbytes,maxbytes,rms,tol,peak))
+    else:
+        print('stamp bank for {} with {} phases, relative rms error {:.2e}, peak {:.2e}'.format(libpath,nphases,rms,peak))
+    tmpname = '%s.%i.tmp'%(choicename,os.getpid())
+    with open(tmpname,'w') as fo:
+        fo.write('{}\t{:.3e}\t{:.3e}\n'.format(nphases,rms,peak))
+    os.replace(tmpname,choicename)
+    return nphases
+
+@lru_cache(maxsize=4)
+def loadstampbank(libpath,nphases=None,tol=1e-3,maxbytes=2**28):
+    # polyphase impulse response bank for method='stamp', built once and saved in the library directory, every
+    # process memory maps the same file. without nphases it is chosen for tol by choosestampphases()
+    if nphases is None:
+        nphases = choosestampphases(libpath,tol,maxbytes)
+    fname = stampbankname(libpath,nphases)
+    if not os.path.exists(fname):
+        (s_collection_ft,n_collection_ft,f_extend,t_extend) = readlibrary(libpath)
+        buildstampbank(libpath,nphases,s_collection_ft,t_extend[1]-t_extend[0])
+    return StampBank.load(fname,mmap_mode='r')
+
+@lru_cache(maxsize=4)
+def loadnoisepsd(libpath):
+    return readnoisepsd(libpath)
+
+def simulate_timeenergy(timeenergy,nchannels=16,e_retardation=0,energywin=(590,610),max_streak=20,printfiles = False,maxbytes=2**28,rng=None,method='fourier',nphases=None):
+    # method='fourier' synthesizes every hit exactly in the frequency domain, method='stamp' adds short time domain
+    # impulse responses from a polyphase bank, much faster for sparse shots at a sub sample delay error of order 1/nphases,
+    # nphases=None picks it for 1e-3 relative rms error on this library (loadstampbank)
     # d1-3 based on CookieBoxLayout_v2.3.dxf
     d1 = 7.6/2.
     d2 = 17.6/2.
@@ -289,69 +350,53 @@ def simulate_timeenergy(timeenergy,nchannels=16,e_retardation=0,energywin=(590,6
     d3 -= d2
     d2 -= d1
 
+    if rng is None:
+        rng = np.random.default_rng()
     s_collection_ft = nparray([0],dtype=complex)
     n_collection_ft = nparray([0],dtype=complex)
     (tinds,einds,nelectrons)=find(timeenergy)
     if printfiles:
-        (s_collection_ft,n_collection_ft,f_extend,t_extend) = fillimpulseresponses(printfiles=printfiles)
+        libpath = updateimpulselibrary()
     else:
         infilepath = './data_fs/extern/'
-        (s_collection_ft,n_collection_ft,f_extend,t_extend) = readimpulseresponses(infilepath)
+        libpath = impulselibrary(infilepath)
+    (s_collection_ft,n_collection_ft,f_extend,t_extend) = readlibrary(libpath)
 
     dt = t_extend[1]-t_extend[0]
-    tvec = nparange[0,t_extend[-1]-t_extend[0],dt]
-    carrier_phase = 2.*pi*rand()
-    sim_times = nparray([0],dtype=float)
+    tvec = np.arange(0,t_extend[-1]-t_extend[0],dt)
     waveforms=np.zeros((nchannels,len(t_extend)),dtype=float)
-    ToFs=nparray([],dtype=float)
-    Ens=nparray([],dtype=float)
-    for pulse in range(tinds.shape[0]):
-        #loop on pulse
-        carrier_phase += 2.*pi*(tinds[pulse]/timeenergy.shape[0]) # Check this... may be accumulatinig when you don't want to
-        photon_energy = energywin[0] + (energywin[1]-energywin[0])*einds[pulse]/timeenergy.shape[1]
-        tdata=nparray([],dtype=float)
-        edata=nparray([],dtype=float)
-        trowinds=nparray([],dtype=int)
-        erowinds=nparray([],dtype=int)
-        tindptr=nparray([0],int)
-        eindptr=nparray([0],int)
-        for chan in range(nchannels):
-            #loop on channels
-            angle = 2.*pi*chan/nchannels
-            nphotos = int(1.+ float(nelectrons[pulse]) # Add this (cos^2 distribution) back after things are final ## * nppower(sin(angle+0.0625),int(2)))
-            evec = fillcollection(e_photon = photon_energy,nphotos=nphotos,npistars=0,nsigstars=0,nvalence=0,angle = carrier_phase + angle,max_streak = max_streak)
-            sim_times = energy2time(evec,r=15.,d1=d1,d2=d2,d3=d3) # HERE HERE HERE HERE This is wehere Naoufal is correcting iwht his interpolator
-            edata = npconcatenate((edata,evec),axis=None)
-            tdata = npconcatenate((tdata,sim_times),axis=None)
-            trowinds = npconcatenate((trowinds,np.arange(sim_times.shape[0])),axis=None)
-            erowinds = npconcatenate((erowinds,np.arange(evec.shape[0])),axis=None)
-            tindptr = npconcatenate((tindptr,trowinds.shape[0]),axis=None)
-            eindptr = npconcatenate((eindptr,erowinds.shape[0]),axis=None)
-
-            #sim_times = append(sim_times,0.) # adds a prompt
-            s_collection_colinds = choice(s_collection_ft.shape[1],sim_times.shape[0]) # HERE HERE HERE HERE Jack, this is in Fourier, choosing impulse responses
-            n_collection_colinds = choice(n_collection_ft.shape[1],sim_times.shape[0]) # I also choose noise this way too.
-
-            v_simsum_ft = zeros(s_collection_ft.shape[0],dtype=complex)
-        
-            for i,t in enumerate(sim_times):
-                #samplestring = 'enumerate sim_times returns\t%i\t%f' % (i,t)
-                #print(samplestring)
-                v_simsum_ft += s_collection_ft[:,s_collection_colinds[i]] * fourier_delay(f_extend,t) # Here is the accumulation of waveforms.
-                v_simsum_ft += n_collection_ft[:,n_collection_colinds[i]] 
-
-            v_simsum = real(IFFT(v_simsum_ft,axis=0))
-            waveforms[chan,:] += v_simsum
-        if (ToFs.shape[0] < nchannels):
-            ToFs = csr_matrix((tdata,trowinds,tindptr),shape=(nchannels,max(trowinds)+1)).toarray()
-            Ens = csr_matrix((edata,erowinds,eindptr),shape=(nchannels,max(erowinds)+1)).toarray()
-        else:
-            ToFs = column_stack((ToFs,csr_matrix((tdata,trowinds,tindptr),shape=(nchannels,max(trowinds)+1)).toarray()))
-            Ens = column_stack((Ens,csr_matrix((edata,erowinds,eindptr),shape=(nchannels,max(erowinds)+1)).toarray()))
+    npulses = tinds.shape[0]
+    carrier_phases = 2.*pi*rng.random() + np.cumsum(2.*pi*(tinds/timeenergy.shape[0])) # Check this... may be accumulatinig when you don't want to
+    photon_energies = energywin[0] + (energywin[1]-energywin[0])*einds/timeenergy.shape[1]
+    angles = 2.*pi*np.arange(nchannels)/nchannels
+    nphotos = (1.+ nelectrons.astype(float)).astype(int) # Add this (cos^2 distribution) back after things are final ## * nppower(sin(angle+0.0625),int(2)))
+
+    # every pulse x channel of the shot in one draw, row = pulse*nchannels + chan
+    (evec,eoffsets) = fillcollections(e_photon = photon_energies[:,None],nphotos=nphotos[:,None],npistars=0,nsigstars=0,nvalence=0,angle = carrier_phases[:,None] + angles[None,:],max_streak = max_streak,rng=rng)
+    erows = np.repeat(np.arange(npulses*nchannels),np.diff(eoffsets))
+    tfull = energy2time_full(evec,r=15.,d1=d1,d2=d2,d3=d3) # HERE HERE HERE HERE This is wehere Naoufal is correcting iwht his interpolator
+    tmask = ~np.isnan(tfull)
+    (sim_times,trows) = (tfull[tmask],erows[tmask])
+    toffsets = npconcatenate(([0],np.cumsum(np.bincount(trows,minlength=npulses*nchannels))))
+    ToFs = column_stack([padrows(sim_times,toffsets[p*nchannels:(p+1)*nchannels+1]) for p in range(npulses)]+[zeros((nchannels,0))])
+    Ens = column_stack([padrows(evec,eoffsets[p*nchannels:(p+1)*nchannels+1]) for p in range(npulses)]+[zeros((nchannels,0))])
+
+    # all hits of the shot, CSR over channels, are synthesized in one batch with a single IFFT per channel
+    chans = trows % nchannels
+    order = argsort(chans,kind='stable')
+    sim_times = sim_times[order]
+    sim_indptr = npconcatenate(([0],np.cumsum(np.bincount(chans,minlength=nchannels))))
+    s_collection_colinds = rng.integers(s_collection_ft.shape[1],size=sim_times.shape[0]) # HERE HERE HERE HERE Jack, this is in Fourier, choosing impulse responses
+    if method == 'stamp':
+        waveforms += loadstampbank(libpath,nphases).synthshot(s_collection_colinds,sim_times,sim_indptr,maxbytes=maxbytes)
+    else:
+        waveforms += synthshot(s_collection_ft,s_collection_colinds,sim_times,sim_indptr,f_extend,maxbytes=maxbytes)
+    # one digitizer noise realization per channel, independent of the number of hits
+    waveforms += colorednoise(loadnoisepsd(libpath),waveforms.shape[1],nchannels,rng)
 
     return (tvec,waveforms,ToFs,Ens)
 
-def computeImages():
+def computeImages(nchannels=16,rng=None,method='fourier'):
         nelectronsrange = (50,100)
         ntbins=8
         nebins=8
@@ -360,88 +405,35 @@ def computeImages():
         einds = [randrange(nebins) for i in range(npulses)]
         nelectrons = [randrange(nelectronsrange[0]//npulses,nelectronsrange[1]//npulses) for i in range(npulses)]
         timeenergy = coo_matrix((nelectrons, (tinds,einds)),shape=(ntbins,nebins),dtype=int)
-        (tvec,WaveForms,ToFs,Energies) = simulate_timeenergy(timeenergy,nchannels=nchannels,e_retardation=0,energywin=(600,610),max_streak=50,printfiles = True)
+        (tvec,WaveForms,ToFs,Energies) = simulate_timeenergy(timeenergy,nchannels=nchannels,e_retardation=0,energywin=(600,610),max_streak=50,printfiles = True,rng=rng,method=method)
         return (nchannels,ntbins,nebins,npulses,tvec,WaveForms,ToFs,Energies,timeenergy.toarray())
 
 #def spawnprocess(nchannels=16,nimages=2,nchunks=2,tfrecordpath = './data_fs/raw/tf_record_files/'):
-def spawnprocess(t):
-    for c in range(nchunks):
-        hashstring = sha1(str.encode( '{}{}{}'.format(time(), getpid(), c) )).hexdigest()
-        ensshardfilename = '{}ens.{}'.format(datapath,hashstring)
-        tofsshardfilename = '{}tofs.{}'.format(datapath,hashstring)
-        wfshardfilename = '{}wf.{}'.format(datapath,hashstring)
-        histshardfilename = '{}hist.{}'.format(datapath,hashstring)
-        #shardfilename = '{}tfrecord.{}'.format(tfrecordpath,hashstring)
-        metafilename = '{}meta.{}'.format(datapath,hashstring)
-        #metafilename = '{}meta.{}'.format(tfrecordpath,hashstring)
-        #writer = tf.io.TFRecordWriter(shardfilename)
-        ensshardout = open(ensshardfilename,'w')
-        tofsshardout = open(tofsshardfilename,'w')
-        wfshardout = open(wfshardfilename,'w')
-        histshardout = open(histshardfilename,'w')
-        metafileout = open(metafilename,'w')
-        strengtharray = np.zeros((nimages,),dtype=int)
-        invpurityarray = np.zeros((nimages,),dtype=int)
-        npulsesarray = np.zeros((nimages,),dtype=int)
-        times = np.array((0),dtype=float)
+def spawnprocess(c,nimages,rng,datapath,nchannels,method='fourier'):
+    # one chunk of nimages shots into one shard, written under a temporary name so a killed chunk leaves no shard behind
+    hashstring = sha1(str.encode( '{}{}{}'.format(time(), getpid(), c) )).hexdigest()
+    shardfilename = '{}shard.{:06d}.h5'.format(datapath,c)
+    times = np.array((0),dtype=float)
+    with ShardWriter(shardfilename + '.tmp',nchannels,attrs={'hash':hashstring,'pid':getpid(),'chunk':c}) as writer:
         for i in range(nimages):
             print("processing image {} chunk {} inside pid {}".format(i,c,getpid()))
-            (nchannels,ntbins,nebins,npulses,times,WaveForms,ToFs,Energies,timeenergy) = computeImages()
-            '''
-            strengtharray[i] = npsum(timeenergy)
-            invpurityarray[i] = npsum(timeenergy)*100//npmax(timeenergy)
-            npulsesarray[i] = npulses
-            waveforms_tf = WaveForms.tostring()
-            ToFs_tf = ToFs.tostring()
-            Energies_tf = Energies.tostring()
-            simsample_tf = tf.train.Example(features = tf.train.Features(feature={
-                'nangles': tf.train.Feature(int64_list=tf.train.Int64List(value = [nchannels])),
-                'ntbins': tf.train.Feature(int64_list=tf.train.Int64List(value = [ntbins])),
-                'nebins': tf.train.Feature(int64_list=tf.train.Int64List(value = [nebins])),
-                'npulses': tf.train.Feature(int64_list=tf.train.Int64List(value = [npulses])),
-                'waveforms': tf.train.Feature(bytes_list=tf.train.BytesList(value = [WaveForms.tostring()])),
-                'tofs': tf.train.Feature(bytes_list=tf.train.BytesList(value = [ToFs.tostring()])),
-                'energies': tf.train.Feature(bytes_list=tf.train.BytesList(value = [Energies.tostring()])),
-                'timeenergy': tf.train.Feature(bytes_list=tf.train.BytesList(value = [timeenergy.tostring()]))
-                }
-                ))
-                '''
-            #writer.write(simsample_tf.SerializeToString())
-            #enfilename = '{}energies_pid{}chunk{}img{}.dat'.format(datapath,getpid(),c,i)
-            #toffilename = '{}tofs_pid{}chunk{}img{}.dat'.format(datapath,getpid(),c,i)
-            #headstring = 'npulses\t{}\t{}\t{}\n#{}\t{}'.format(npulses,enfilename,toffilename,i,hashstring)
-            #np.savetxt(enfilename,Energies,fmt='%.3f',header=headstring)
-            #headstring = 'npulses\t{}\t{}\t{}\n#{}\t{}'.format(npulses,enfilename,toffilename,i,hashstring)
-            #np.savetxt(toffilename,ToFs,fmt='%.3f',header=headstring)
+            (nchannels,ntbins,nebins,npulses,times,WaveForms,ToFs,Energies,timeenergy) = computeImages(nchannels,rng,method)
             ramp = buildramp(times,250)
-            HERE HERE HERE HERE
-            for chan in range(Energies.shape[0]):
-                toflist = [t for t in ToFs[chan,:] if t>0]
-                toflist.sort()
-                wf = map2chargedischarge(toflist,times,ramp)
-                tofsshardout.write( ' '.join(format(t,'0.3f') for t in toflist) + '::')
-                #wf = map2waveform(toflist)
-                #wf = map2multiwaveform(toflist)
-                wfshardout.write( ' '.join(format(int(w),'d') for w in wf) + '::')
-                #wfshardout.write( ' '.join(format(int(w),'d') for w in wf) + '\n')
-                hst = waveform2hist(wf)
-                histshardout.write(' '.join(format(int(h),'d') for h in hst) + '::')
-                #histshardout.write(' '.join(format(int(h),'d') for h in hst) + '\n')
-                enlist = [e for e in Energies[chan,:] if e>0]
-                enlist.sort()
-                ensshardout.write( ' '.join(format(e,'0.3f') for e in enlist) + '::')
-            tofsshardout.write('\n')
-            ensshardout.write('\n')
-            wfshardout.write('\n')
-            histshardout.write('\n')
-            metafileout.write('{}\t{}\t{}\n'.format(npulses,npsum(timeenergy)*100//npmax(timeenergy),npsum(timeenergy)))
-        #writer.close()
-        headstring = 'npulsesarray\tinverse purityarray*100\tstrengtharray'
-        np.savetxt(metafilename,np.column_stack((npulsesarray,invpurityarray,strengtharray)),fmt='%i',header=headstring)
-        ensshardout.close()
-        tofsshardout.close()
-        wfshardout.close()
-        histshardout.close()
+            toflists = [np.sort(ToFs[chan,ToFs[chan,:]>0]) for chan in range(Energies.shape[0])]
+            enlists = [np.sort(Energies[chan,Energies[chan,:]>0]) for chan in range(Energies.shape[0])]
+            wfs = map2chargedischarge_shot(toflists,times,ramp)
+            #wfs = [map2waveform(toflist) for toflist in toflists]
+            #wfs = [map2multiwaveform(toflist) for toflist in toflists]
+            hsts = chargedischargehist(wfs,ramp)
+            writer.append(toflists,enlists,wfs,hsts,npulses,npsum(timeenergy)*100//npmax(timeenergy),npsum(timeenergy))
+        writer.f.attrs['ntbins'] = ntbins
+        writer.f.attrs['nebins'] = nebins
+    os.replace(shardfilename + '.tmp',shardfilename)
+    return '{}\t{}'.format(os.path.basename(shardfilename),','.join(['%i'%n for n in writer.npulses]))
+
+def indexshard(output):
+    (shardfilename,npulses) = output.split('\t')
+    appendindex('{}shards.index'.format(datapath),shardfilename,[int(n) for n in npulses.split(',') if len(n)])
 
 '''
         ############
@@ -457,23 +449,25 @@ class MetaData(Structure):
 
 	
 def main():
-    #argslist = [(nchannels,nimages,nchunks,tfrecordpath,) for i in range(nthreads)]
-    argslist = [(i,) for i in range(nthreads)]
+    # total budget of nimages*nchunks*nthreads shots in chunks of nimages, rerunning with the same arguments resumes from the manifest
+    nshots = nimages*nchunks*nthreads
+    manifestname = '{}manifest'.format(datapath)
     start = timer()
-    pool = Pool(nthreads)
-    pool.starmap(spawnprocess, argslist)
-    pool.close()
+    if synthmethod == 'stamp':
+        loadstampbank(updateimpulselibrary()) # built once here, the workers memory map it
+    runchunks(spawnprocess,nshots,nimages,nthreads,manifestname,args=(datapath,nchannels,synthmethod),collect=indexshard)
     stop = timer()
-    print('### Whole loop of %i images took %.3f s' % (nimages*nchunks*nthreads,stop-start))
+    print('### Whole loop of %i images took %.3f s' % (nshots,stop-start))
     return
 
 if __name__ == '__main__':
     tfrecordpath = './data_fs/raw/tf_record_files/'
-    datapath = './data_fs/raw/ascii_record_files/'
+    datapath = './data_fs/raw/h5_record_files/'
     nchannels = int(16)
     nthreads = cpu_count()*3//4
     nchunks = int(4)
     nimages = int(4)
+    synthmethod = 'fourier'
     if len(sys.argv)>1:
         nimages = int(sys.argv[1])
         if len(sys.argv)>2:
@@ -482,4 +476,6 @@ if __name__ == '__main__':
                 nthreads = min(cpu_count(),int(sys.argv[3]))
                 if len(sys.argv)>4:
                     nchannels = int(sys.argv[4])
+                    if len(sys.argv)>5:
+                        synthmethod = sys.argv[5] # fourier or stamp
     main()
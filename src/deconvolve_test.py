@@ -3,6 +3,8 @@
 import numpy as np
 import sys
 
+from spectral import rfft,irfft,rfreqs,filterkernel
+
 def gauss(x,c,w):
     return np.exp(-np.power((x-c)/w,int(2)))
 
@@ -29,37 +31,39 @@ def main():
             if 3< len(sys.argv):
                 ufscale = int(sys.argv[3])
     x = np.arange(667,dtype=int)
+    n = x.shape[0]
     nscale=3e-1
-    n = np.random.normal(0,nscale,len(x))
-    f = np.fft.fftfreq(x.shape[0])
-    F = gauss(f,0,1./5.)
+    noise = np.random.normal(0,nscale,len(x))
+    # every signal here is real, the filters are applied on the rfft half
+    f = rfreqs(n)
     y = np.zeros(x.shape,dtype=float)
     inds = np.random.choice(x,nhits)
     y[inds] = [np.abs(np.random.normal(1,.5,len(inds)))]
     s = sig(x,20,3,1)
-    S = np.fft.fft(s)
+    S = rfft(s)
     DS = 1j*f*S
     SDS = S+DS
     W = weiner(S,nscale)
     df = f[1]-f[0]
-    OF = gauss(f,0,ofscale*df)
-    Y = np.fft.fft(y)
-    yg = np.fft.ifft(Y*(SDS))+nscale*n
-    YG = np.fft.fft(yg.real)
-    yd = np.fft.ifft(YG/(SDS))
-    yf = np.fft.ifft(YG*W)
-    yof = np.fft.ifft(YG*OF)
-    yc = np.fft.ifft(YG*(-S))
-    ycof = np.fft.ifft(YG*(-S)*OF)
+    OF = filterkernel(n,1.,ofscale*df,'gauss')
+    Y = rfft(y)
+    yg = irfft(Y*(SDS),n)+nscale*noise
+    YG = rfft(yg)
+    yd = irfft(YG/(SDS),n)
+    yf = irfft(YG*W,n)
+    yof = irfft(YG*OF,n)
+    yc = irfft(YG*(-S),n)
+    ycof = irfft(YG*(-S)*OF,n)
     yfinal = yc*np.abs(ycof)
     boxaverage = np.zeros(len(yfinal),dtype=float)
     boxaverage[-1] = 1.
     boxaverage[0:2] = 1.
-    BA=np.fft.fft(boxaverage)
-    weightedinds = np.fft.ifft(np.fft.fft(x*yc)*BA)/np.fft.ifft(np.fft.fft(yc)*BA)
-    gaussweightedinds = np.fft.ifft(np.fft.fft(x*yc)*gauss(f,0,df*ufscale))/np.fft.ifft(np.fft.fft(yc)*gauss(f,0,df*ufscale))
+    BA=rfft(boxaverage)
+    weightedinds = irfft(rfft(x*yc)*BA,n)/irfft(rfft(yc)*BA,n)
+    UF = filterkernel(n,1.,ufscale*df,'gauss')
+    gaussweightedinds = irfft(rfft(x*yc)*UF,n)/irfft(rfft(yc)*UF,n)
 
-    np.savetxt('data_fs/processed/deconvolve.out',np.column_stack((x,y,s,yg.real,yd.real,yf.real,yof.real,yc.real,ycof.real,yfinal.real,gaussweightedinds.real,weightedinds.real)),fmt='%.6f')
+    np.savetxt('data_fs/processed/deconvolve.out',np.column_stack((x,y,s,yg,yd,yf,yof,yc,ycof,yfinal,gaussweightedinds,weightedinds)),fmt='%.6f')
     np.savetxt('data_fs/processed/deconvolve.fft',np.column_stack((f,np.abs(Y),np.abs(SDS),np.abs(YG),np.abs(YG*W))),fmt='%.6f')
     return
 
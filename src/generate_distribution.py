@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import numpy as np
 from scipy.stats import gengamma as gamma
 from numpy import row_stack
 from numpy import concatenate as npconcatenate
@@ -17,19 +18,21 @@ def samplegamma(a,c,loc,scale,n):
     #v = gamma.rvs(a=a,c=c,loc=loc,scale=scale,size=n)
     return gamma.rvs(a=a,c=c,loc=loc,scale=scale,size=n)
 
+## line shapes, energies in eV, every population is e0 + a - gamma(a,scale) (gengamma with c=1, loc=0)
+ph_a = 2.
+ph_scale = 1.
+ph_ip = 540. #Ionization Potential for photo electrons
+v_ip = 22. # Ionixation pot for valence electrons
+v_scale = 1.
+v_a = 2.
+sigstar_a = 5.
+sigstar_e=542.
+sigstar_scale = 0.5
+pistar_a = 2.
+pistar_e=532.
+pistar_scale = 0.5
+
 def fillcollection(e_photon = 600., nphotos=10,nvalence=1,nsigstars=10,npistars=20,angle = 0.,max_streak=0):
-    ph_a = 2.
-    ph_scale = 1.
-    ph_ip = 540. #Ionization Potential for photo electrons
-    v_ip = 22. # Ionixation pot for valence electrons
-    v_scale = 1.
-    v_a = 2.
-    sigstar_a = 5.
-    sigstar_e=542.
-    sigstar_scale = 0.5
-    pistar_a = 2.
-    pistar_e=532.
-    pistar_scale = 0.5
     c , loc = 1. , 0.
     e = e_photon - ph_ip + ph_a - samplegamma(a=ph_a,c=c,loc=loc,scale=ph_scale,n=nphotos) + max_streak * cos(angle)
     v = nparray([val for val in e if val >0])
@@ -45,6 +48,35 @@ def fillcollection(e_photon = 600., nphotos=10,nvalence=1,nsigstars=10,npistars=
     shuffle(v)
     return v
 
+def fillcollections(e_photon = 600., nphotos=10,nvalence=1,nsigstars=10,npistars=20,angle = 0.,max_streak=0,rng=None):
+    ## batched fillcollection(), every argument broadcasts over rows (e.g. pulses x channels of a shot, flattened)
+    ## all rows of a population are drawn in one rng.gamma call
+    ## returns CSR style (values,offsets), row i is values[offsets[i]:offsets[i+1]], shuffled within the row
+    if rng is None:
+        rng = np.random.default_rng()
+    (e_photon,nphotos,nvalence,nsigstars,npistars,angle,max_streak) = [np.ravel(v) for v in np.broadcast_arrays(e_photon,nphotos,nvalence,nsigstars,npistars,angle,max_streak)]
+    nrows = e_photon.shape[0]
+    rowinds = np.arange(nrows)
+    r = np.repeat(rowinds,nphotos.astype(int))
+    photos = e_photon[r] - ph_ip + ph_a - rng.gamma(ph_a,ph_scale,r.shape[0]) + max_streak[r] * cos(angle[r])
+    rows = [r]
+    r = np.repeat(rowinds,nvalence.astype(int))
+    valence = e_photon[r] - v_ip + v_a - rng.gamma(v_a,v_scale,r.shape[0])
+    rows += [r]
+    r = np.repeat(rowinds,nsigstars.astype(int))
+    sigstars = sigstar_e + sigstar_a - rng.gamma(sigstar_a,sigstar_scale,r.shape[0])
+    rows += [r]
+    r = np.repeat(rowinds,npistars.astype(int))
+    pistars = pistar_e + pistar_a - rng.gamma(pistar_a,pistar_scale,r.shape[0])
+    rows += [r]
+    values = npconcatenate((photos,valence,sigstars,pistars))
+    rows = npconcatenate(rows)
+    keep = values > 0
+    (values,rows) = (values[keep],rows[keep])
+    order = np.lexsort((rng.random(values.shape[0]),rows))
+    offsets = npconcatenate(([0],np.cumsum(np.bincount(rows,minlength=nrows))))
+    return (values[order],offsets)
+
 def main():
     ## Treating energies as in eV
     nphotos = int(10)
@@ -4,19 +4,30 @@ import sys
 import numpy as np
 import h5py
 
+from linedensity import gaussbins,poissonhist
+
+def expectedlines(energies,group,nlines,ndraws,streak):
+    # nlines picks of a uniformly chosen line from the group, ndraws electrons each, expected counts per energy bin
+    centers = np.array([float(c) for c in group.attrs.keys()])
+    widths = np.array([float(group.attrs[c]) for c in group.attrs.keys()])
+    return nlines*ndraws/centers.shape[0] * np.sum(gaussbins(energies,centers+float(streak),widths),axis=1)
+
 def main():
     if len(sys.argv)<2:
-        print('syntax:\t%s <outputfilehead> <nimages> <streakamp optional> <nelectrons scale optional>'%(sys.argv[0]))
+        print('syntax:\t%s <outputfilehead> <nimages> <streakamp optional> <nelectrons scale optional> <sample|density optional>'%(sys.argv[0]))
         return
     streakamp = 20.
     nimages = 10
     scale = 10
+    mode = 'sample' # density skips the electrons, the histogram is a poisson draw around the expected counts and hits are left empty
     if len(sys.argv)>2:
         nimages = int(sys.argv[2])
     if len(sys.argv)>3:
         streakamp = float(sys.argv[3])
     if len(sys.argv)>4:
         scale = int(sys.argv[4])
+    if len(sys.argv)>5:
+        mode = sys.argv[5]
 
     outhead = sys.argv[1]
     nangles = 16 
@@ -30,6 +41,7 @@ def main():
     energies = np.linspace(emin,emax,nenergies+1)
 
     h5f = h5py.File('%s.simdata.h5'%(outhead),'w')
+    h5f.attrs['mode'] = mode
     
     for i in range(nimages):
         img = h5f.create_group('img%05i'%i)
@@ -71,6 +83,7 @@ def main():
         ens = []
         for a in range(nangles):
             ens.append([])
+        expected = np.zeros((nenergies,nangles),dtype=float)
 
         for p in range(img.attrs['npulses']):
             c0 = 1.
@@ -83,6 +96,11 @@ def main():
                 augercounts = int(scale)
                 if ncounts > 0:
                     streak = img.attrs['streakamp']*np.cos(angles[a]-img.attrs['ephases'][p]+img.attrs['carrier'])
+                    if mode == 'density':
+                        expected[:,a] += expectedlines(energies,img['photos'],int(np.sqrt(ncounts)),int(np.sqrt(ncounts)),streak)
+                        expected[:,a] += expectedlines(energies,img['augers'],int(np.sqrt(augercounts)),int(np.sqrt(augercounts)),streak)
+                        expected[:,a] += expectedlines(energies,img['valencephotos'],int(np.sqrt(ncounts//10)),int(np.sqrt(ncounts//10)),streak)
+                        continue
                     centers = list(np.random.choice(list(img['photos'].attrs.keys()),int(np.sqrt(ncounts))))
                     for c in centers:
                         ens[a] += list(np.random.normal(float(c)+float(streak),float(img['photos'].attrs[c]),int(np.sqrt(ncounts))))
@@ -95,6 +113,8 @@ def main():
         h = np.zeros((nenergies,nangles),dtype=int)
         for a in range(nangles):
             h[:,a] = np.histogram(ens[a],energies)[0]
+        if mode == 'density':
+            h = poissonhist(np.random,expected)
         img.create_dataset('hist',data=h)
         img.create_dataset('energies',data=energies[:-1])
 
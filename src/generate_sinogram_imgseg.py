@@ -1,117 +1,242 @@
 #!/usr/bin/python3
 
+import os
 import sys
 import numpy as np
 import h5py
-
-def main():
-    if len(sys.argv)<2:
-        print('syntax:\t%s <outputfilehead> <nimages> <streakamp optional> <nelectrons scale optional>'%(sys.argv[0]))
-        return
-    streakamp = 50.
-    nimages = 10
-    scale = 10
-    if len(sys.argv)>2:
-        nimages = int(sys.argv[2])
-    if len(sys.argv)>3:
-        streakamp = float(sys.argv[3])
-    if len(sys.argv)>4:
-        scale = int(sys.argv[4])
-
-    outhead = sys.argv[1]
+from warnings import warn
+
+from simdriver import runchunks,readmanifest
+from shardwriter import appendrows,appendcounts,appendcsr,mergeshards
+from linedensity import gaussbins,poissonhist
+from forwardop import ForwardOperator
+
+# using dictionary to hold the list of [width,crossection]
+oxygencenters = {-541.5 : [0.5,1.]}
+nitrogencenters = {-409.9 : [1.5,2.]}
+carboncenters = {-284.2 : [2.5,4.]}
+ECENTRAL = 600. # esase ~ N(ECENTRAL,ETOTALWIDTH)
+ETOTALWIDTH = 20.
+HISTDTYPE = np.uint16 # density mode at scale 1000 reaches several hundred counts per bin
+
+def histcounts(h):
+    # per pulse histogram as HISTDTYPE, counts past its range are clipped with a warning rather than wrapped
+    top = np.iinfo(HISTDTYPE).max
+    if np.max(h,initial=0) > top:
+        warn('{} histogram bins above {} clipped'.format(np.sum(h > top),top))
+    return np.minimum(h,top).astype(HISTDTYPE)
+
+def samplepulse(rng,esase,ewidth,poldist,streaks,scale,photocenters,photowidths,photoxsecs,energies,mode='sample'):
+    ## every angle of a pulse in one draw
+    ## angle a gets int(sqrt(ncounts)) photo lines picked at random, each contributing int(sqrt(ncounts)*crosssection) hits
+    ## returns the hits as CSR over angles (hits[offsets[a]:offsets[a+1]]) and the (nenergies x nangles) histogram
+    ## mode='density' skips the electrons, the histogram is a poisson draw around the expected counts and hits come back empty
+    nangles = poldist.shape[0]
+    ncounts = (poldist * scale).astype(int)
+    ncounts[ncounts<0] = 0
+    ncenters = np.sqrt(ncounts).astype(int)
+    if mode == 'density':
+        # every line is picked with probability 1/nlines for each of the ncenters draws of an angle
+        ndraws = np.floor(np.sqrt(ncounts)[:,None]*photoxsecs[None,:])
+        expected = ncenters[:,None]/photocenters.shape[0] * ndraws
+        widths = np.sqrt( np.power(float(ewidth),int(2)) + np.power(photowidths,int(2)) )
+        probs = gaussbins(energies,esase + photocenters[None,:] + streaks[:,None],widths[None,:])
+        pulsehist = histcounts(poissonhist(rng,np.sum(probs*expected[None,:,:],axis=2)))
+        return (np.zeros((0,),dtype=float),np.zeros((nangles+1,),dtype=int),pulsehist)
+    drawangles = np.repeat(np.arange(nangles),ncenters)
+    drawcenters = rng.integers(photocenters.shape[0],size=drawangles.shape[0])
+    ndraws = (np.sqrt(ncounts[drawangles])*photoxsecs[drawcenters]).astype(int)
+    hitangles = np.repeat(drawangles,ndraws)
+    hitcenters = np.repeat(drawcenters,ndraws)
+    widths = np.sqrt( np.power(float(ewidth),int(2)) + np.power(photowidths[hitcenters],int(2)) )
+    hits = rng.normal(esase + photocenters[hitcenters] + streaks[hitangles],widths)
+    offsets = np.concatenate(([0],np.cumsum(np.bincount(hitangles,minlength=nangles))))
+    pulsehist = histcounts(np.histogram2d(hits,hitangles,bins=(energies,np.arange(nangles+1)))[0])
+    return (hits,offsets,pulsehist)
+
+## shard layout, every dataset is stacked along axis 0 so shards merge into one virtual file (shardwriter.mergeshards)
+##   image, npulses, carrier             one row per image, pulses of image i are rows pulses_offsets[i]:pulses_offsets[i+1]
+##   esase, phase, ewidth, legcoeffs     one row per pulse
+##   hist                                (npulses x nenergies x nangles) HISTDTYPE (uint16)
+##   hits, hits_offsets                  CSR over (pulse,angle) rows, pulse p angle a is row p*nangles+a
+## the line tables are file attrs, photos and valencephotos as (center,width,crosssection) rows, augers as (center,width)
+
+def pulsehits(f,p,a):
+    offsets = f['hits_offsets']
+    i = p*f.attrs['nangles'] + a
+    return f['hits'][offsets[i]:offsets[i+1]]
+
+def imagepulses(f,i):
+    (a,b) = f['pulses_offsets'][i:i+2]
+    return np.arange(a,b)
+
+def flushpulses(h5f,images,pulses):
+    appendrows(h5f,'image',[im[0] for im in images],np.int64,chunkrows=2**10)
+    appendrows(h5f,'npulses',[im[1] for im in images],np.int32,chunkrows=2**10)
+    appendrows(h5f,'carrier',[im[2] for im in images],np.float64,chunkrows=2**10)
+    appendcounts(h5f,'pulses',[im[1] for im in images],target='esase')
+    for k,name in enumerate(('esase','phase','ewidth')):
+        appendrows(h5f,name,[pl[k] for pl in pulses],np.float64,chunkrows=2**10)
+    appendrows(h5f,'legcoeffs',[pl[3] for pl in pulses],np.float64,chunkrows=2**10)
+    appendrows(h5f,'hist',[pl[6] for pl in pulses],HISTDTYPE,chunkrows=64)
+    hits = [pl[4] for pl in pulses]
+    appendcsr(h5f,'hits',np.concatenate(hits) if len(hits) else np.zeros((0,)),np.concatenate([np.diff(pl[5]) for pl in pulses]) if len(pulses) else [])
+
+def writefile(fname,nimages,streakamp=50.,scale=10,rng=None,firstimage=0,mode='sample',chunkimages=256):
+    if rng is None:
+        rng = np.random.default_rng()
     nangles = 64 
     nenergies = 64 
     emin = 0
     emax = 128 
     maxpulses = 3
 
-    etotalwidth = 20.
-    ecentral = 600.
+    (ecentral,etotalwidth) = (ECENTRAL,ETOTALWIDTH)
     angles = np.linspace(0,np.pi*2.,nangles+1)
     energies = np.linspace(emin,emax,nenergies+1)
 
-    h5f = h5py.File('%s.ImgSegSim.h5'%(outhead),'w')
+    h5f = h5py.File(fname,'w')
+    h5f.attrs['mode'] = mode
+    h5f.attrs['nangles'] = nangles
+    h5f.attrs['nenergies'] = nenergies
+    h5f.attrs['angles'] = angles
+    h5f.attrs['energies'] = energies
+    h5f.attrs['streakamp'] = streakamp
+    h5f.attrs['scale'] = scale
+    h5f.attrs['firstimage'] = firstimage
+    h5f.attrs['nimages'] = nimages
 
-    # using dictionary to hold the list of [width,crossection]
-    oxygencenters = {-541.5 : [0.5,1.]}
-    nitrogencenters = {-409.9 : [1.5,2.]}
-    carboncenters = {-284.2 : [2.5,4.]}
     nvalencecenters = {-37.3 : [0.5,.2]}
     ovalencecenters = {-41.6 : [0.5,1.]}
 
-    h5f.create_group('augers')
     naugerfeatures = {365:1.5,369:1.5,372:1.5}
     caugerfeatures = {250.:3.,255.:2.5,260.:2.5}
     oaugerfeatures = {505:2.5,497:1.,492:1.}
     augerfeatures = {**naugerfeatures,**caugerfeatures,**oaugerfeatures}
-    for center in list(augerfeatures.keys()):
-        h5f['augers'].attrs['%.2f'%center] = float(augerfeatures[center])
-        #print('%.2f'%center)
-        #print(img['augers'].attrs['%.2f'%center])
+    h5f.attrs['augers'] = [[float(c),float(augerfeatures[c])] for c in augerfeatures.keys()]
 
     photofeatures = {**carboncenters,**nitrogencenters,**oxygencenters}
-    h5f.create_group('photos')
-    for center in list(photofeatures.keys()):
-        h5f['photos'].attrs['%.2f'%center] = [photofeatures[center][0],photofeatures[center][1]]
+    h5f.attrs['photos'] = [[float(c)] + photofeatures[c] for c in photofeatures.keys()]
 
     valencefeatures = {**nvalencecenters,**ovalencecenters}
-    h5f.create_group('valencephotos')
-    for center in list(valencefeatures.keys()):
-        h5f['valencephotos'].attrs['%.2f'%center] = valencefeatures[center]
+    h5f.attrs['valencephotos'] = [[float(c)] + valencefeatures[c] for c in valencefeatures.keys()]
 
-    
-    for i in range(nimages):
-        img = h5f.create_group('img%05i'%i)
+    (photocenters,photowidths,photoxsecs) = np.array(h5f.attrs['photos']).T
 
-        img.attrs['npulses'] = int(np.random.uniform(1,maxpulses+1))
+    images = []
+    pulses = []
+    for i in range(nimages):
+        npulses = int(rng.uniform(1,maxpulses+1))
         # rather than this, let's eventually switch to using a dict for the Auger features and then for every ncounts photoelectron, we pick from this distribution an Auger electron.
-        img.attrs['carrier'] = np.random.uniform(0.,2.*np.pi)
-        img.attrs['streakamp'] = streakamp
-
-        ens = []
-        for p in range(img.attrs['npulses']):
-            ens.append([])
-            for a in range(nangles):
-                ens[-1].append([])
-
+        carrier = rng.uniform(0.,2.*np.pi)
+        images += [(firstimage+i,npulses,carrier)]
 
-        for p in range(img.attrs['npulses']):
-            pulsegrp = img.create_group('pulse%02i'%p)
-            pulsegrp.attrs['phase'] = np.random.normal(0.,np.pi/8)
-            pulsegrp.attrs['esase'] = np.random.normal(ecentral,etotalwidth)
-            pulsegrp.attrs['ewidth'] = np.random.gamma(1.5,.125)+.5
+        for p in range(npulses):
+            phase = rng.normal(0.,np.pi/8)
+            esase = rng.normal(ecentral,etotalwidth)
+            ewidth = rng.gamma(1.5,.125)+.5
             c0 = 1.
-            c2 = -1.0 #np.random.uniform(-1,1) 
-            c4 = 0 #np.random.uniform(-(c0+c2),c0+c2)
-            pulsegrp.create_dataset('legcoeffs',data=[c0, 0., c2, 0., c4])
-            poldist = np.polynomial.legendre.Legendre(pulsegrp['legcoeffs'])(np.cos(angles[:-1]))
-            pulsehist = np.zeros((nenergies,nangles),dtype=np.uint8)
-            for a in range(nangles):
-                ncounts = int(poldist[a] * scale)
-                augercounts = int(scale)
-                if ncounts > 0:
-                    streak = img.attrs['streakamp']*np.cos(angles[a]-pulsegrp.attrs['phase']+img.attrs['carrier'])
-                    centers = list(np.random.choice(list(h5f['photos'].attrs.keys()),int(np.sqrt(ncounts))))
-                    for c in centers:
-                        ens[p][a] = list(np.random.normal(pulsegrp.attrs['esase'] + float(c) + float(streak)
-                            , np.sqrt( np.power(float(pulsegrp.attrs['ewidth']),int(2)) + np.power(float(h5f['photos'].attrs[c][0]),int(2)) )
-                            , int(np.sqrt(ncounts)*h5f['photos'].attrs[c][1])))
-                        '''
-                    centers = list(np.random.choice(list(h5f['valencephotos'].attrs.keys()),int(np.sqrt(ncounts//10))))
-                    for c in centers:
-                        ens[p][a] += list(np.random.normal(img.attrs['esase'][p] + float(c) + float(streak),float(h5f['valencephotos'].attrs[c]),int(np.sqrt(ncounts//10))))
-                    centers = list(np.random.choice(list(h5f['augers'].attrs.keys()),int(np.sqrt(augercounts))))
-                    for c in centers:
-                        ens[p][a] += list(np.random.normal(img.attrs['esase'][p] + float(c) + float(streak),float(h5f['augers'].attrs[c]),int(np.sqrt(augercounts))))
-                        '''
-                    pulsehist[:,a] = np.histogram(ens[p][a],energies)[0]
-                pulsegrp.create_dataset('hits_ang%02i'%a,data=ens[p][a])
-            pulsegrp.create_dataset('hist',data=pulsehist)
+            c2 = -1.0 #rng.uniform(-1,1) 
+            c4 = 0 #rng.uniform(-(c0+c2),c0+c2)
+            legcoeffs = [c0, 0., c2, 0., c4]
+            poldist = np.polynomial.legendre.Legendre(legcoeffs)(np.cos(angles[:-1]))
+            streaks = streakamp*np.cos(angles[:-1]-phase+carrier)
+            (hits,offsets,pulsehist) = samplepulse(rng,esase,ewidth,poldist,streaks,scale,photocenters,photowidths,photoxsecs,energies,mode=mode)
+            pulses += [(esase,phase,ewidth,legcoeffs,hits,offsets,pulsehist)]
+
+        if len(images) == chunkimages or i == nimages-1:
+            flushpulses(h5f,images,pulses)
+            (images,pulses) = ([],[])
 
     h5f.close()
 
     return
 
+def imgsegoperator(cachepath=None,streakamp=50.,ewidth=.75,nangles=64,nenergies=64,emin=0,emax=128,de=1.,nphases=256):
+    # forward operator for the photo lines of writefile(), the carrier phase folds into the pulse phase as phase-carrier
+    # the energy grid covers esase ~ N(ECENTRAL,ETOTALWIDTH) out to 5 sigma in de steps, forwardop lists the
+    # interpolation error and size for de and nphases
+    photofeatures = {**carboncenters,**nitrogencenters,**oxygencenters}
+    centers = np.array(list(photofeatures.keys()),dtype=float)
+    (widths,xsecs) = np.array(list(photofeatures.values()),dtype=float).T
+    egrid = np.linspace(ECENTRAL-5.*ETOTALWIDTH,ECENTRAL+5.*ETOTALWIDTH,int(round(10.*ETOTALWIDTH/de))+1)
+    pgrid = np.linspace(0.,2.*np.pi,int(nphases),endpoint=False)
+    return ForwardOperator(np.linspace(emin,emax,nenergies+1),np.linspace(0,np.pi*2.,nangles+1),centers,widths,xsecs
+            ,egrid=egrid,pgrid=pgrid,streakamp=streakamp,ewidth=ewidth,cachepath=cachepath)
+
+def writeshard(chunkid,nimages,rng,outdir,streakamp,scale,chunksize,mode='sample'):
+    # one shard per worker, image numbering continues across shards so image keys are unique in the index
+    fname = '%simgseg.%03i.ImgSegSim.h5'%(outdir,chunkid)
+    writefile(fname + '.tmp',nimages,streakamp=streakamp,scale=scale,rng=rng,firstimage=chunkid*chunksize,mode=mode)
+    os.replace(fname + '.tmp',fname)
+    return os.path.basename(fname)
+
+def writeindex(outdir,manifestname):
+    # merged index of all shards, one line per image: shard, image number, npulses
+    # and imgseg.h5, a virtual file presenting every shard as one set of arrays
+    (entropy,chunksize,done) = readmanifest(manifestname)
+    shardnames = [done[c][3] for c in sorted(done.keys())]
+    with open('%simgseg.index'%outdir,'w') as fo:
+        for shardname in shardnames:
+            with h5py.File(outdir + shardname,'r') as f:
+                for (im,n) in zip(f['image'][()],f['npulses'][()]):
+                    fo.write('{}\t{}\t{}\n'.format(shardname,im,n))
+    if len(shardnames):
+        mergeshards('%simgseg.h5'%outdir,[outdir + shardname for shardname in shardnames])
+    return
+
+def runparallel(outdir,nimages,nworkers,streakamp=50.,scale=10,mode='sample'):
+    # nimages split evenly over nworkers, each worker seeded from its own SeedSequence child
+    # rerunning with the same arguments resumes from the manifest in outdir
+    # a resumed run keeps the chunksize of its manifest, whatever nworkers is now
+    os.makedirs(outdir,exist_ok=True)
+    manifestname = '%simgseg.manifest'%outdir
+    (entropy,chunksize,done) = readmanifest(manifestname)
+    if chunksize is None:
+        chunksize = (nimages+nworkers-1)//nworkers
+    runchunks(writeshard,nimages,chunksize,nworkers,manifestname,args=(outdir,streakamp,scale,chunksize,mode))
+    (entropy,chunksize,done) = readmanifest(manifestname)
+    nchunks = (nimages+chunksize-1)//chunksize
+    if len([c for c in done.keys() if c < nchunks]) < nchunks:
+        print('failed, {} of {} chunks in {}, not writing the index'.format(len(done),nchunks,manifestname))
+        return
+    writeindex(outdir,manifestname)
+    return
+
+def main():
+    if len(sys.argv)>1 and sys.argv[1]=='-j':
+        if len(sys.argv)<5:
+            print('syntax:\t%s -j <nworkers> <outputdir> <nimages> <streakamp optional> <nelectrons scale optional> <sample|density optional>'%(sys.argv[0]))
+            return
+        (streakamp,scale,mode) = (50.,10,'sample')
+        if len(sys.argv)>5:
+            streakamp = float(sys.argv[5])
+        if len(sys.argv)>6:
+            scale = int(sys.argv[6])
+        if len(sys.argv)>7:
+            mode = sys.argv[7]
+        runparallel(os.path.join(sys.argv[3],''),int(sys.argv[4]),int(sys.argv[2]),streakamp=streakamp,scale=scale,mode=mode)
+        return
+    if len(sys.argv)<2:
+        print('syntax:\t%s <outputfilehead> <nimages> <streakamp optional> <nelectrons scale optional> <sample|density optional>'%(sys.argv[0]))
+        print('\t%s -j <nworkers> <outputdir> <nimages> <streakamp optional> <nelectrons scale optional> <sample|density optional>'%(sys.argv[0]))
+        return
+    streakamp = 50.
+    nimages = 10
+    scale = 10
+    mode = 'sample'
+    if len(sys.argv)>2:
+        nimages = int(sys.argv[2])
+    if len(sys.argv)>3:
+        streakamp = float(sys.argv[3])
+    if len(sys.argv)>4:
+        scale = int(sys.argv[4])
+    if len(sys.argv)>5:
+        mode = sys.argv[5]
+
+    writefile('%s.ImgSegSim.h5'%(sys.argv[1]),nimages,streakamp=streakamp,scale=scale,mode=mode)
+    return
+
 
 if __name__ == '__main__':
     main()
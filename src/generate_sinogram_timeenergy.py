@@ -2,8 +2,11 @@
 
 import sys
 import numpy as np
+import h5py
 from scipy.sparse import coo_matrix
 
+from linedensity import gaussbins,poissonhist
+
 class electron():
     def __init__(self):
         self.center = 512.
@@ -65,23 +68,119 @@ def phi2ind(p,pmin,pmax,n):
         return int(n-1)
     return int(phase)
 
+def e2inds(e,emin,emax,n):
+    v = ((np.asarray(e,dtype=float)-emin)*float(n)/float(emax-emin)).astype(int)
+    return np.clip(v,0,n-1)
+
+def phi2inds(p,pmin,pmax,n):
+    return e2inds(p,pmin,pmax,n)
+
 def coordout(mat):
     inds = np.where(mat)
     return np.c_[np.c_[inds],mat[inds]]
 
+## sparse image store, every product is a group of appended COO triplets with per image offsets
+##   <name>/rows, <name>/cols, <name>/vals   image i is entries offsets[i]:offsets[i+1]
+##   <name>/offsets                          nimages+1
+## the dense shape is held in the group attrs
+
+def appendcoo(grp,mat):
+    (rows,cols) = np.nonzero(mat)
+    vals = mat[rows,cols]
+    if 'offsets' not in grp:
+        grp.attrs['shape'] = mat.shape
+        for name,dtype in (('rows',np.int32),('cols',np.int32),('vals',np.int32)):
+            grp.create_dataset(name,shape=(0,),maxshape=(None,),dtype=dtype,chunks=(2**14,),compression='gzip')
+        grp.create_dataset('offsets',data=np.zeros((1,),dtype=np.int64),maxshape=(None,),chunks=(2**10,))
+    start = grp['rows'].shape[0]
+    for name,v in (('rows',rows),('cols',cols),('vals',vals)):
+        grp[name].resize((start+v.shape[0],))
+        grp[name][start:] = v
+    n = grp['offsets'].shape[0]
+    grp['offsets'].resize((n+1,))
+    grp['offsets'][n] = start+rows.shape[0]
+
+def readcoo(grp,i):
+    (a,b) = grp['offsets'][i:i+2]
+    return coo_matrix((grp['vals'][a:b],(grp['rows'][a:b],grp['cols'][a:b])),shape=tuple(grp.attrs['shape']))
+
+def exporttext(fname,outhead,i):
+    # the old text triplets, for the gnuplot scripts
+    outname = '%s.%02i'%(outhead,i)
+    with h5py.File(fname,'r') as f:
+        for name in ('timeenergy_NNO','timeenergy_OCO','full_NNO','full_OCO'):
+            np.savetxt('%s.%s'%(outname,name),coordout(readcoo(f[name],i).toarray()),fmt='%i')
+
+def simulateimage(rng,angles,energies,nphases,streakamp,scalein,ecentral,etotalwidth,mode='sample'):
+    ## one image, every pulse and angle at once
+    ## legendre weights and streaks are (npulses x nangles), counts for both molecules come from one normal draw
+    ## and each histogram from one bincount over flattened energy*nangles + angle
+    ## mode='density' replaces the electron draw with poisson counts around the expected (nenergies x nangles) histograms
+    nangles = angles.shape[0]-1
+    nenergies = energies.shape[0]-1
+    (emin,emax) = (energies[0],energies[-1])
+    npulses = int(rng.uniform(3,8))
+    ecenters = rng.normal(ecentral,etotalwidth,(npulses,))
+    ewidths = rng.gamma(3.5,.125,(npulses,))+.5
+    ephases= rng.uniform(0.,2.*np.pi,(npulses,))
+    scale = rng.normal(scalein,scalein/10.,npulses).astype(int)
+    nitrogencenters = ecenters - 409.9
+    carboncenters = ecenters - 284.2
+
+    timeenergy_NNO = np.zeros((nenergies,nphases),dtype=int)
+    timeenergy_OCO = np.zeros((nenergies,nphases),dtype=int)
+    np.add.at(timeenergy_NNO,(e2inds(nitrogencenters,emin,emax,nenergies),phi2inds(ephases,0,2*np.pi,nphases)),scale)
+    np.add.at(timeenergy_OCO,(e2inds(carboncenters,emin,emax,nenergies),phi2inds(ephases,0,2*np.pi,nphases)),scale)
+
+    c0 = 1.
+    c2 = -1.
+    c4 = 0.
+    legcoeffs = np.tile([c0,0,c2,0,c4],(npulses,1))
+    poldist = np.polynomial.legendre.legval(np.cos(angles[:-1]),legcoeffs.T) # (npulses x nangles)
+    ncounts = (poldist * scale[:,None]).astype(int)
+    ncounts[ncounts<0] = 0
+    streaks = streakamp*np.cos(angles[None,:-1]-ephases[:,None])
+    result = {'timeenergy_NNO':timeenergy_NNO,'timeenergy_OCO':timeenergy_OCO}
+
+    if mode == 'density':
+        for name,c in (('full_NNO',nitrogencenters),('full_OCO',carboncenters)):
+            probs = gaussbins(energies,c[:,None] + streaks,ewidths[:,None]) # (nenergies x npulses x nangles)
+            result[name] = poissonhist(rng,np.sum(probs*ncounts[None,:,:],axis=1))
+        return result
+
+    counts = ncounts.ravel()
+    (pulseinds,angleinds) = np.divmod(np.repeat(np.arange(npulses*nangles),counts),nangles)
+    nhits = pulseinds.shape[0]
+    centers = np.concatenate((nitrogencenters[pulseinds],carboncenters[pulseinds]))
+    ens = rng.normal(centers + np.tile(streaks[pulseinds,angleinds],2),np.tile(ewidths[pulseinds],2))
+    for name,e in (('full_NNO',ens[:nhits]),('full_OCO',ens[nhits:])):
+        result[name] = hist2d(e,angleinds,energies,nangles)
+    return result
+
+def hist2d(e,angleinds,energies,nangles):
+    # np.histogram binning along energy (last edge inclusive), then one bincount over the flattened (energy,angle) index
+    nenergies = energies.shape[0]-1
+    einds = np.searchsorted(energies,e,side='right')-1
+    einds[e==energies[-1]] = nenergies-1
+    m = (einds>=0) * (einds<nenergies)
+    return np.bincount(einds[m]*nangles + angleinds[m],minlength=nenergies*nangles).reshape((nenergies,nangles))
+
 def main():
     if len(sys.argv)<3:
-        print('syntax:\t%s <outputfilehead> <nimages> <streakamp optional> <nelectrons scale optional>'%(sys.argv[0]))
+        print('syntax:\t%s <outputfilehead> <nimages> <streakamp optional> <nelectrons scale optional> <sample|density optional>'%(sys.argv[0]))
         return
     streakamp = 20.
     nimages = 10
     scalein = 100
+    mode = 'sample'
     if len(sys.argv)>2:
         nimages = int(sys.argv[2])
     if len(sys.argv)>3:
         streakamp = float(sys.argv[3])
     if len(sys.argv)>4:
         scalein = int(sys.argv[4])
+    if len(sys.argv)>5:
+        mode = sys.argv[5]
 
     outhead = sys.argv[1]
     nangles = 64 
@@ -93,106 +192,20 @@ def main():
     ecentral = 534.5
     angles = np.linspace(0,np.pi*2.,nangles+1)
     energies = np.linspace(emin,emax,nenergies+1)
-
-    nitrogenaugers = [Auger() for i in range(3)]
-    nitrogenaugers[0].setcenterwidthdelay(365,1.5,.5)
-    nitrogenaugers[1].setcenterwidthdelay(369,1.5,.25)
-    nitrogenaugers[2].setcenterwidthdelay(372,1.5,.25)
-
-    carbonaugers = [Auger() for i in range(3)]
-    carbonaugers[0].setcenterwidthdelay(255,2.5,.5)
-    carbonaugers[1].setcenterwidthdelay(260,2.5,.25)
-    carbonaugers[2].setcenterwidthdelay(252,1.5,.75)
-
-    oxygenaugers = [Auger() for i in range(6)]
-    oxygenaugers[0].setcenterwidthdelay(495,2.5,.125)
-    oxygenaugers[1].setcenterwidthdelay(480,2.5,.25)
-    oxygenaugers[2].setcenterwidthdelay(482,1.5,.25)
-    oxygenaugers[3].setcenterwidthdelay(502,1.5,.5)
-    oxygenaugers[4].setcenterwidthdelay(507,1.0,.5)
-    oxygenaugers[5].setcenterwidthdelay(507,0.5,1.75)
-
     nphases = int(64)
-    
-
-    
-    for img in range(nimages):
-        timeenergy_NNO = np.zeros((nenergies,nphases),dtype=int)
-        timeenergy_OCO = np.zeros((nenergies,nphases),dtype=int)
-        hist_ens_NNO = np.zeros((nenergies,nangles),dtype=int)
-        hist_ens_OCO = np.zeros((nenergies,nangles),dtype=int)
-        hist_ens_auger_NNO = np.zeros((nenergies,nangles),dtype=int)
-        hist_ens_auger_OCO = np.zeros((nenergies,nangles),dtype=int)
-        outname = '%s.%02i'%(outhead,img)
-        npulses = int(np.random.uniform(3,8))
-        ecenters = np.random.normal(ecentral,etotalwidth,(npulses,))
-        ewidths = np.random.gamma(3.5,.125,(npulses,))+.5
-        ephases= np.random.uniform(0.,2.*np.pi,(npulses,))
-        # rather than this, let's eventually switch to using a dict for the AUger features and then for every ncounts photoelectron, we pick from this distribution an Auger electron.
-        augerfeatures_NNO = {505:2.5,497:1.,492:1.,365:1.5,369:1.5,372:1.5}
-        augerfeatures_OCO = {505:2.5,497:1.,492:1.,250.:3.,255.:2.5,260.:2.5}
-        #augerfeatures = {505:1.5,492:1.,365:1.5,372:1.5,250.:1.,260.:1.5}
-        nitrogencenters = ecenters+535.-410.
-        carboncenters = ecenters+535.-285.
-
-        oxygenphotos = [Photo().setbinding(543.1).setcenterwidthdelay(ecenters[i],ewidths[i],ephases[i]) for i in range(npulses)]
-        oxygenvalencephotos = [Photo().setbinding(41.6).setcenterwidthdelay(ecenters[i],ewidths[i],ephases[i]) for i in range(npulses)]
-        nitrogenphotos = [Photo().setbinding(409.9).setcenterwidthdelay(ecenters[i],ewidths[i],ephases[i]) for i in range(npulses)]
-        nitrogenvalencephotos = [Photo().setbinding(37.3).setcenterwidthdelay(ecenters[i],ewidths[i],ephases[i]) for i in range(npulses)]
-        carbonphotos = [Photo().setbinding(284.2).setcenterwidthdelay(ecenters[i],ewidths[i],ephases[i]) for i in range(npulses)]
-        scale = [int(v) for v in np.random.normal(scalein,scalein/10.,npulses)]
-        for i in range(npulses):
-            c0 = 1.
-            c2 = np.random.uniform(-1,1)
-            c2 = -1.
-            c4 = np.random.uniform(-(c0+c2),c0+c2)
-            c4 = 0.
-            poldist = np.polynomial.legendre.Legendre([c0,0,c2,0,c4])(np.cos(angles[:-1]))
-            c,w,p = nitrogenphotos[i]()
-            timeenergy_NNO[e2ind(c,emin,emax,nenergies) , phi2ind(p,0,2*np.pi,nphases)] += scale[i]
-            c,w,p = carbonphotos[i]()
-            timeenergy_OCO[e2ind(c,emin,emax,nenergies) , phi2ind(p,0,2*np.pi,nphases)] += scale[i]
-
-            for a in range(nangles):
-                ncounts = int(poldist[a] * scale[i])
-                augercounts = scale[i]
-                if ncounts > 0:
-
-                    #hist_ens_NNO[:,a] += np.histogram(np.random.normal(ecenters[i]+streak,ewidths[i],(ncounts,)),energies)[0]
-                    c,w,p = nitrogenphotos[i]()
-                    streak = streakamp*np.cos(angles[a]-p)
-                    hist_ens_NNO[:,a] += np.histogram(np.random.normal(c+streak,w,(ncounts,)),energies)[0]
-                    #augercenters_NNO = np.random.choice(list(augerfeatures_NNO.keys()),(augercounts,))
-                    #ens_auger_NNO = [np.random.normal(c,augerfeatures_NNO[c])+streak for c in augercenters_NNO]
-                    #hist_ens_auger_NNO[:,a] += np.histogram(ens_auger_NNO,energies)[0]
-                    #hist_ens_OCO[:,a] += np.histogram(np.random.normal(ecenters[i]+streak,ewidths[i],(ncounts,)),energies)[0]
-                    c,w,p = carbonphotos[i]()
-                    hist_ens_OCO[:,a] += np.histogram(np.random.normal(c+streak,w,(ncounts,)),energies)[0]
-                    #augercenters_OCO = np.random.choice(list(augerfeatures_OCO.keys()),(augercounts,))
-                    #ens_auger_OCO = [np.random.normal(c,augerfeatures_OCO[c])+streak for c in augercenters_OCO]
-                    #hist_ens_auger_OCO[:,a] += np.histogram(ens_auger_OCO,energies)[0]
-
-        #np.savetxt(outname,hist_ens,fmt='%i')
-        #np.savetxt('%s.%s'%(outname,'augers'),hist_ens_auger,fmt='%i')
-        np.savetxt('%s.%s'%(outname,'timeenergy_NNO'),coordout(timeenergy_NNO),fmt='%i')
-        np.savetxt('%s.%s'%(outname,'timeenergy_OCO'),coordout(timeenergy_OCO),fmt='%i')
-        #np.savetxt('%s.%s'%(outname,'full_NNO'),hist_ens_NNO.T,fmt='%i')
-        #np.savetxt('%s.%s'%(outname,'full_OCO'),hist_ens_OCO.T,fmt='%i')
-        np.savetxt('%s.%s'%(outname,'full_NNO'),coordout(hist_ens_NNO),fmt='%i')
-        np.savetxt('%s.%s'%(outname,'full_OCO'),coordout(hist_ens_OCO),fmt='%i')
-    '''
-    fig, ax = plt.subplots()#subplot_kw={"projection": "3d"})
-    X,Y = np.meshgrid(angles,energies)
-    Z = hist_ens.copy()
-    surf = ax.plot_surface(X, Y, Z, cmap=cm.coolwarm,
-                       linewidth=0, antialiased=False)
-
-    fig.colorbar(surf, shrink=0.5, aspect=5)
-
-    plt.show()
-    '''
-
-    
+
+    rng = np.random.default_rng()
+    with h5py.File('%s.timeenergy.h5'%outhead,'w') as f:
+        f.attrs['streakamp'] = streakamp
+        f.attrs['scale'] = scalein
+        f.attrs['energies'] = energies
+        f.attrs['angles'] = angles
+        f.attrs['mode'] = mode
+        for img in range(nimages):
+            mats = simulateimage(rng,angles,energies,nphases,streakamp,scalein,ecentral,etotalwidth,mode=mode)
+            for name in ('timeenergy_NNO','timeenergy_OCO','full_NNO','full_OCO'):
+                appendcoo(f.require_group(name),mats[name])
+        f.attrs['nimages'] = nimages
     return
 
 
@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import numpy as np
+import h5py
+from hashlib import sha256
+from functools import lru_cache
+from multiprocessing import Pool
+
+from simdriver import runchunks,readmanifest
+from hitfinder import findhits,derivatives
+from ramptable import ramptable
+from scopeingest import scanfile,readscopefile,tracesmemmap
+
+## map reduce hit histogramming over calibration runs
+## the traces, rows of a scopeingest store or the segments of a list of scope text files, are cut into chunks and
+## every chunk is reduced by a worker to a partial written as .npz into the parts directory
+##   held     bins where the sample and hold trace histogram exceeds the ramp jacobian, summed over traces (hitfind)
+##   hits     histogram of the ramp value at every interpolated hit time
+##   wfsum    sum of the traces (accumulatehits), ntraces
+## the ramp and its jacobian come from a ramptable cached in the parts directory, shared by all workers
+## chunks go through simdriver.runchunks, so the manifest in the parts directory makes an interrupted run resume
+## with only the missing chunks. the parts directory is named for a hash of the inputs, the chunksize and the
+## configuration, changing edges or thresholds, or re-ingesting the store, starts a fresh set of partials.
+## partials are merged pairwise in a tree at the end, only once every chunk is done.
+
+DEFAULTS = {'nbins':1024,'elow':0.25,'ehigh':11.25,'thresh':-.05,'dead':.5,'deriv':0,'bwd':2.4
+        ,'ramp0':250,'rampstart':300.,'rampstop':1300.}
+
+def histedges(config):
+    if 'edges' in config:
+        return np.asarray(config['edges'],dtype=float)
+    return np.linspace(config['elow'],config['ehigh'],int(config['nbins'])+1)
+
+def reducetraces(y,dt,config,edges,cachepath=None):
+    # partial of one block of (ntraces x nsamples) traces, dt in ns
+    table = ramptable(y.shape[1],dt,config['ramp0'],config['rampstart'],config['rampstop'],edges,cachepath)
+    dead = int(config['dead']/dt+.5)
+    sig = derivatives(y,dt,config['bwd'],orders=(1,))[0] if config['deriv'] else y
+    (times,indptr) = findhits(sig,config['thresh'],dead)
+    return {'held':table.heldhist(times,indptr,dead),'hits':table.valuehist(times),'jac':np.array(table.jac)
+            ,'wfsum':np.sum(y,axis=0,dtype=float),'ntraces':np.array(y.shape[0])}
+
+@lru_cache(maxsize=2)
+def readfilelist(listname):
+    with open(listname,'r') as fi:
+        return [line.rstrip('\n') for line in fi if line.strip()]
+
+def chunktraces(source,first,n):
+    # yields (traces,dt in ns) blocks for items first:first+n, store rows or text files
+    if source.endswith('.h5'):
+        with h5py.File(source,'r') as f:
+            dt = f.attrs['dt'] if 'dt' in f.attrs else f['dt'][first]
+        yield (np.asarray(tracesmemmap(source)[first:first+n],dtype=float),dt*1e9)
+        return
+    for fname in readfilelist(source)[first:first+n]:
+        (nsegments,nsamples,trigtimes) = scanfile(fname)
+        (t0,dt,v) = readscopefile(fname,nsegments,nsamples)
+        yield (v.astype(float),dt[0]*1e9)
+
+def mergeparts(a,b):
+    if a is None:
+        return b
+    return {k:a[k]+b[k] if k != 'jac' else a[k] for k in a.keys()}
+
+def reducechunk(chunkid,n,rng,source,chunksize,config,partsdir):
+    edges = histedges(config)
+    part = None
+    for (y,dt) in chunktraces(source,chunkid*chunksize,n):
+        part = mergeparts(part,reducetraces(y,dt,config,edges,partsdir))
+    fname = '%spart.%05i.npz'%(partsdir,chunkid)
+    np.savez(fname + '.tmp.npz',**part)
+    os.replace(fname + '.tmp.npz',fname)
+    return os.path.basename(fname)
+
+def loadpart(fname):
+    with np.load(fname) as d:
+        return {k:d[k] for k in d.files}
+
+def mergepair(pair):
+    return mergeparts(*[loadpart(p) if isinstance(p,str) else p for p in pair])
+
+def treemerge(parts,nworkers=1):
+    # pairwise rounds, each round's merges run in the pool
+    if len(parts) == 0:
+        return None
+    with Pool(nworkers) as pool:
+        while len(parts) > 1:
+            pairs = [tuple(parts[i:i+2]) for i in range(0,len(parts)-1,2)]
+            merged = pool.map(mergepair,pairs)
+            parts = merged + parts[2*len(pairs):]
+    return loadpart(parts[0]) if isinstance(parts[0],str) else parts[0]
+
+def sourcekey(source):
+    # what the partials depend on, the store's file list, size and mtime or the head of the file list
+    if not source.endswith('.h5'):
+        with open(source,'rb') as fi:
+            return fi.read(2**20)
+    with h5py.File(source,'r') as f:
+        files = f['files'][()].tobytes() if 'files' in f else b''
+        ntraces = f['traces'].shape[0]
+    st = os.stat(source)
+    return files + str.encode('{}\t{}\t{}\t{}'.format(os.path.abspath(source),ntraces,st.st_size,st.st_mtime_ns))
+
+def configdir(outhead,source,chunksize,config):
+    keyhash = sha256(str.encode(json.dumps({**config,'chunksize':int(chunksize)},sort_keys=True)))
+    keyhash.update(sourcekey(source))
+    return '%s.parts.%s/'%(outhead,keyhash.hexdigest()[:16])
+
+def accumulate(outhead,inputs,nworkers=4,chunksize=64,config=None):
+    # inputs is a scopeingest store or a list of scope text files, chunksize counts traces or files
+    config = {**DEFAULTS,**(config or {})}
+    if len(inputs) == 1 and inputs[0].endswith('.h5'):
+        source = inputs[0]
+        with h5py.File(source,'r') as f:
+            nitems = f['traces'].shape[0]
+    else:
+        source = outhead + '.files'
+        with open(source,'w') as fo:
+            fo.write(''.join([fname + '\n' for fname in inputs]))
+        nitems = len(inputs)
+    if nitems == 0:
+        print('failed, no traces in {}'.format(inputs))
+        return None
+    partsdir = configdir(outhead,source,chunksize,config)
+    os.makedirs(partsdir,exist_ok=True)
+    manifestname = partsdir + 'manifest'
+    runchunks(reducechunk,nitems,chunksize,nworkers,manifestname,args=(source,chunksize,config,partsdir))
+    (entropy,oldchunksize,done) = readmanifest(manifestname)
+    nchunks = (nitems+chunksize-1)//chunksize
+    if oldchunksize != chunksize or len([c for c in done.keys() if c < nchunks]) < nchunks:
+        print('failed, {} of {} chunks in {}, not writing {}.hist.out'.format(len(done),nchunks,manifestname,outhead))
+        return None
+    result = treemerge([partsdir + done[c][3] for c in range(nchunks)],nworkers)
+    edges = histedges(config)
+    np.savetxt(outhead + '.hist.out',np.column_stack((edges[:-1],result['held'],result['hits'],result['jac']))
+            ,header='ntraces {}\tbins\theld\thits\tjac'.format(int(result['ntraces'])))
+    np.savetxt(outhead + '.accum.dat',result['wfsum']/max(int(result['ntraces']),1),fmt='%.3e')
+    return result
+
+def main():
+    if len(sys.argv)<5:
+        print('syntax: %s <outputhead> <nworkers> <chunksize> <scopeingest store.h5 | scope text files ...> <key=value ...>'%sys.argv[0])
+        print('\tkeys and defaults: {}, edges=<file of bin edges>'.format(' '.join(['%s=%s'%(k,v) for k,v in DEFAULTS.items()])))
+        return
+    config = {}
+    inputs = []
+    for arg in sys.argv[4:]:
+        if '=' in arg and not os.path.exists(arg):
+            (k,v) = arg.split('=',1)
+            config[k] = np.loadtxt(v).tolist() if k == 'edges' else float(v)
+        else:
+            inputs += [arg]
+    accumulate(sys.argv[1],inputs,int(sys.argv[2]),int(sys.argv[3]),config)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+from spectral import rfft,irfft,rfreqs,filterkernel
+
+try:
+    from numba import njit
+    havenumba = True
+except ImportError:
+    havenumba = False
+
+## hit finding on (nwaveforms x nsamples) batches, scope segments or buildwaveforms channels alike
+## pulses are negative going. a negative lobe arms once it dips below thresh (< 0) and the hit is where it
+## crosses back up through zero, linearly interpolated between the samples around the crossing, so on the
+## derivative dy the hit is the turning point of the pulse (the straightfind path).
+## dead time: after a hit at crossing sample c the hold covers [c,c+dead) and the walk of the original sampleandhold
+## resumes at c+dead+1, so a lobe only fires if it still has a sample below thresh at or after c+dead+1, or after c
+## when the hold would run past the end of the record. lobes only depend on their own samples, so every candidate is found with array ops, the
+## dead time chain is followed for all waveforms at once, one step per hit of the busiest waveform.
+## hits come back CSR, times[indptr[w]:indptr[w+1]] are the hits of waveform w in samples (or dt*samples+t0)
+
+def derivatives(y,dt,bwd,orders=(1,2)):
+    # band limited d^k y/dt^k (up to the 2pi the scripts never carried) with the cos^2 window, batched along the last axis
+    n = y.shape[-1]
+    Y = rfft(y,axis=-1)*filterkernel(n,float(dt),float(bwd),'cos2')
+    f = rfreqs(n,float(dt))
+    return [irfft(Y*np.power(1j*f,k),n,axis=-1) for k in orders]
+
+def hitcandidates(y,thresh):
+    # rising zero crossings c of lobes that went below thresh, with the last below thresh sample l of the lobe
+    # returned as flat positions row*nsamples + column
+    n = y.shape[1]
+    flat = y.ravel()
+    neg = flat < 0
+    pos = np.arange(flat.shape[0])
+    cross = pos[1:][neg[:-1] & ~neg[1:]]
+    cross = cross[cross % n != 0]
+    starts = pos[neg & ~np.concatenate(([False],neg[:-1]))]
+    starts = np.union1d(starts,pos[::n][neg[::n]])
+    below = pos[flat < thresh]
+    if cross.shape[0] == 0 or below.shape[0] == 0:
+        return (cross[:0],cross[:0])
+    s = starts[np.searchsorted(starts,cross,side='right')-1]
+    l = below[np.maximum(np.searchsorted(below,cross)-1,0)]
+    armed = (l >= s) & (np.searchsorted(below,cross) > 0)
+    return (cross[armed],l[armed])
+
+def deadtimemask(cross,last,rows,nrows,reach):
+    # greedy dead time: keep a hit if its lobe has a below thresh sample at or after the previous kept crossing + reach
+    keep = np.zeros(cross.shape[0],dtype=bool)
+    if cross.shape[0] == 0:
+        return keep
+    nxt = np.searchsorted(last,cross + reach) # last is increasing, rows are separated in flat positions by more than reach
+    rowend = np.searchsorted(rows,np.arange(nrows),side='right')
+    cur = np.searchsorted(rows,np.arange(nrows))
+    cur = cur[cur < rowend]
+    while cur.shape[0] > 0:
+        keep[cur] = True
+        ends = rowend[rows[cur]]
+        cur = nxt[cur]
+        cur = cur[cur < ends]
+    return keep
+
+def findhits_numpy(y,thresh,dead=0):
+    n = y.shape[1]
+    (cross,last) = hitcandidates(y,thresh)
+    rows = cross // n
+    if dead > 0:
+        # hits never reach across rows, space the rows so a dead window can not either
+        stride = n + int(dead) + 2
+        reach = np.where(cross % n + dead < n,dead + 1,1)
+        keep = deadtimemask(rows*stride + cross % n,rows*stride + last % n,rows,y.shape[0],reach)
+        (cross,rows) = (cross[keep],rows[keep])
+    flat = y.ravel()
+    times = (cross % n) - 1 + flat[cross-1]/(flat[cross-1]-flat[cross])
+    indptr = np.concatenate(([0],np.cumsum(np.bincount(rows,minlength=y.shape[0]))))
+    return (times,indptr)
+
+if havenumba:
+    @njit(cache=True)
+    def _findhits_numba(y,thresh,dead):
+        times = np.zeros(y.shape[0]*y.shape[1]//2+1,dtype=np.float64)
+        counts = np.zeros(y.shape[0],dtype=np.int64)
+        h = 0
+        for w in range(y.shape[0]):
+            lastc = -1
+            reach = 0
+            lastbelow = -1
+            lastnonneg = -1
+            for i in range(y.shape[1]):
+                if y[w,i] < thresh:
+                    lastbelow = i
+                if i > 0 and y[w,i-1] < 0 and y[w,i] >= 0:
+                    if lastbelow > lastnonneg and lastbelow >= lastc + reach:
+                        times[h] = i - 1 + y[w,i-1]/(y[w,i-1]-y[w,i])
+                        h += 1
+                        counts[w] += 1
+                        lastc = i
+                        reach = dead + 1 if i + dead < y.shape[1] else 1
+                if y[w,i] >= 0:
+                    lastnonneg = i
+        return (times[:h],counts)
+
+def findhits(y,thresh,dead=0,dt=1.,t0=0.,backend='numpy'):
+    # y is (nwaveforms x nsamples) or a single waveform, dead in samples
+    y = np.atleast_2d(np.asarray(y,dtype=float))
+    if backend == 'numba' and havenumba:
+        (times,counts) = _findhits_numba(y,float(thresh),int(dead))
+        indptr = np.concatenate(([0],np.cumsum(counts)))
+    else:
+        (times,indptr) = findhits_numpy(y,thresh,int(dead))
+    return (times*dt + t0,indptr)
+
+def holdtrace(e,times,indptr,dead):
+    # the sample and hold output, e everywhere except e[c-1] held over [c,c+dead) after every hit crossing c
+    # times in samples as findhits() returns them with dt=1, t0=0
+    nrows = indptr.shape[0]-1
+    result = np.tile(np.asarray(e,dtype=float),(nrows,1))
+    if times.shape[0] == 0 or dead <= 0:
+        return result
+    cross = np.floor(times).astype(int) + 1
+    rows = np.repeat(np.arange(nrows),np.diff(indptr))
+    cols = cross[:,None] + np.arange(int(dead))[None,:]
+    vals = np.broadcast_to(result[rows,cross-1][:,None],cols.shape)
+    m = cols < result.shape[1]
+    result[np.broadcast_to(rows[:,None],cols.shape)[m],cols[m]] = vals[m]
+    return result
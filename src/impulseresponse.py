@@ -3,6 +3,8 @@
 import numpy as np
 import sys
 
+from spectral import rfft,irfft,rfreqs
+
 def main():
     if len(sys.argv)<2:
         print('add files to process on command line')
@@ -40,23 +42,20 @@ def main():
 
     outfile = './data_fs/processed/rolledout.dat'
     np.savetxt(outfile,signals,fmt='%.2f')
-    SIGNALS = np.fft.fft(signals,axis=1)
-    f = np.fft.fftfreq(SIGNALS.shape[1],dt)
+    # real traces, the phases only live on the rfft half and the linear phase correction keeps the spectra hermitian
+    L = signals.shape[1]
+    SIGNALS = rfft(signals,axis=1)
+    f = rfreqs(L,dt)
     AMPS=np.array(np.abs(SIGNALS))
     PHASES = np.angle(SIGNALS)
-    PHASES_ = np.copy(PHASES)
     R = SIGNALS.shape[0]
-    L = SIGNALS.shape[1]
-    P = np.zeros(L,dtype=float)
-    P[:L//2] = np.mean(np.unwrap(PHASES_[:,:L//2],axis=1),axis=0)-np.pi
-    P[L//2:] = np.mean(np.fliplr(np.unwrap(np.fliplr(PHASES_[:,L//2:]),axis=1)),axis=0)+np.pi
+    P = np.mean(np.unwrap(PHASES,axis=1),axis=0)-np.pi
     outfile = './data_fs/processed/phasesout.dat'
     np.savetxt(outfile,P,fmt='%.2f')
     slope = np.mean(np.diff(P[:150]))/(f[1]-f[0])
-    P = np.tile(slope*f,R)
-    P.shape = AMPS.shape
+    P = np.tile(slope*f,(R,1))
     SIGNALSOUT = AMPS * np.exp(1j*(PHASES-P))
-    signalsout = np.fft.ifft(SIGNALSOUT).real
+    signalsout = irfft(SIGNALSOUT,L,axis=1)
     signalsout = np.roll(signalsout,L//5,axis=1)
     outfile = './data_fs/processed/signalsout.dat'
     np.savetxt(outfile,signalsout,fmt='%.2f')
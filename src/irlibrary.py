@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+import os
+import glob
+import numpy as np
+from hashlib import sha256
+
+from waveformsynth import noisepsd
+
+## impulse response library
+## the scope traces are parsed once and the Fourier collections written as .npy into a directory
+## named for the library version and a content hash of the input traces, workers then np.load(mmap_mode='r')
+## so every Pool process shares the same pages instead of holding its own copy.
+## collections are stored Fortran ordered so that gathering columns (one impulse response each) is contiguous
+## noise_psd.npy holds the rfft power spectrum estimated from the noise collection, libraries written before it
+## existed get it on first read, so synthesis never has to touch the noise collection itself
+
+LIBRARYVERSION = 1
+LIBRARYNAMES = ('signal_collection_ft','noise_collection_ft','frequencies_collection','times_collection')
+
+def readtrace(fname,skiprows=6):
+    # LeCroy ascii export, 6 header lines then whitespace separated time[s] value columns
+    d = np.loadtxt(fname,skiprows=skiprows,dtype=float,ndmin=2)
+    t_vec = d[:,:1]*1.e9
+    v_vec = d[:,1:2]
+    return (t_vec,v_vec)
+
+def inputhash(filelist):
+    keyhash = sha256(str.encode('irlibrary.v%i'%LIBRARYVERSION))
+    for fname in sorted(filelist):
+        keyhash.update(str.encode(os.path.basename(fname)))
+        with open(fname,'rb') as fi:
+            keyhash.update(fi.read())
+    return keyhash.hexdigest()
+
+def librarypath(outpath,hashstring):
+    return '%sirlibrary.v%i.%s/'%(outpath,LIBRARYVERSION,hashstring[:16])
+
+def latestlibrary(outpath):
+    liblist = glob.glob('%sirlibrary.v%i.*/'%(outpath,LIBRARYVERSION))
+    if len(liblist)==0:
+        return None
+    return max(liblist,key=os.path.getmtime)
+
+def writelibrary(libpath,s,n,f,t,hashstring,filelist):
+    os.makedirs(libpath,exist_ok=True)
+    for name,arr in zip(LIBRARYNAMES,(s,n,f,t)):
+        np.save(libpath + name,np.asfortranarray(arr))
+    np.save(libpath + 'noise_psd',noisepsd(n))
+    with open(libpath + 'inputs.sha256','w') as fo:
+        fo.write('{}\t{}\n'.format(hashstring,len(filelist)))
+        for fname in sorted(filelist):
+            fo.write('{}\n'.format(fname))
+    return libpath
+
+def readlibrary(libpath,mmap_mode='r'):
+    return tuple([np.load(libpath + name + '.npy',mmap_mode=mmap_mode) for name in LIBRARYNAMES])
+
+def readnoisepsd(libpath):
+    if not os.path.exists(libpath + 'noise_psd.npy'):
+        psd = noisepsd(np.load(libpath + LIBRARYNAMES[1] + '.npy',mmap_mode='r'))
+        np.save(libpath + 'noise_psd.tmp.npy',psd)
+        os.replace(libpath + 'noise_psd.tmp.npy',libpath + 'noise_psd.npy')
+    return np.load(libpath + 'noise_psd.npy')
@@ -0,0 +1,17 @@
+#!/usr/bin/python3
+
+import numpy as np
+from scipy.special import ndtr
+
+## expected density sampling for the histogram only outputs of the sinogram generators
+## rather than drawing every electron and histogramming, the expected counts per bin come from CDF differences
+## of the line shape on the bin edges, then one poisson draw per bin, so the cost scales with bins and not electrons
+
+def gaussbins(edges,centers,widths):
+    # probability of a normal(centers,widths) draw landing in each bin, shape (nbins,)+centers.shape
+    (centers,widths) = np.broadcast_arrays(np.asarray(centers,dtype=float),np.asarray(widths,dtype=float))
+    z = (edges.reshape((-1,)+(1,)*centers.ndim) - centers)/widths
+    return np.diff(ndtr(z),axis=0)
+
+def poissonhist(rng,expected,dtype=int):
+    return rng.poisson(np.maximum(expected,0.)).astype(dtype)
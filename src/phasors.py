@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+## native complex exponential kernels, replaces np.vectorize(cmath.rect)
+## cos and sin are written straight into the real and imag views of the output buffer
+## so no complex temporaries are made, dtype=np.complex64 runs the whole thing in float32
+
+def realtype(dtype):
+    return np.finfo(dtype).dtype
+
+def rect(r,phi,out=None,dtype=complex):
+    phi = np.asarray(phi)
+    if out is None:
+        out = np.empty(np.broadcast(np.asarray(r),phi).shape,dtype=dtype)
+    np.cos(phi,out=out.real)
+    np.sin(phi,out=out.imag)
+    out *= r
+    return out
+
+def expi(phi,out=None,dtype=complex):
+    phi = np.asarray(phi)
+    if out is None:
+        out = np.empty(phi.shape,dtype=dtype)
+    np.cos(phi,out=out.real)
+    np.sin(phi,out=out.imag)
+    return out
+
+def phaseramp(f,t,out=None,dtype=complex):
+    ## exp(-i*2*pi*f*t)
+    ## scalar t gives a vector over f, a vector of t gives the (nfreq x nt) matrix
+    rtype = realtype(dtype)
+    if np.ndim(t) == 0:
+        phi = np.multiply(f,-2.*np.pi*float(t),dtype=rtype)
+    else:
+        phi = np.multiply.outer(np.asarray(f,dtype=rtype),np.asarray(t,dtype=rtype))
+        phi *= -2.*np.pi
+    return expi(phi,out=out,dtype=dtype)
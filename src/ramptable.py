@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+import os
+import numpy as np
+from hashlib import sha256
+from functools import lru_cache
+
+from hitfinder import holdtrace
+
+## ramp and jacobian tables for sample and hold histogramming
+## a sample and hold front end reads out the ramp value at every sample and holds the value at a hit for the dead
+## time, so the histogram of the held trace is the ramp jacobian (histogram of the ramp itself) plus, per hit,
+## dead copies of the held value minus the ramp samples the hold covered. RampTable keeps the ramp, the bin of every
+## sample and the jacobian, and heldcounts() builds that difference straight from the hit list, without the trace.
+## the analysis ramp of figs/hitfind.py is cached per (nsamples, dt, ramp0, rampstart, rampstop, edges) in memory
+## and as .npz under a name hashed from those parameters, simulated ramps are wrapped with RampTable(ramp,edges)
+## and their held traces decoded with tracecounts()
+
+RAMPVERSION = 1
+
+def energyramp(t,ramp0,rampstart,rampstop):
+    # energy the analysis ramp maps every sample time (ns) to, zero outside (rampstart,rampstop)
+    en = np.zeros(t.shape[0],dtype=float)
+    inds = np.where((t>rampstart)*(t<rampstop))
+    en[inds] = 2e4 * float(rampstart-ramp0)*np.power(t[inds]-t[int(ramp0)],int(-2))
+    return en
+
+def valuebins(vals,edges):
+    # bin of every value, -1 outside, the last edge is inclusive as in np.histogram
+    nbins = edges.shape[0]-1
+    b = np.searchsorted(edges,vals,side='right')-1
+    b[vals == edges[-1]] = nbins-1
+    b[(b < 0) | (b >= nbins)] = -1
+    return b
+
+class RampTable:
+    def __init__(self,ramp,edges,binof=None,jac=None,func=None):
+        # func(t) evaluates the ramp between samples when the ramp has a closed form, it is not saved
+        self.func = func
+        self.ramp = np.asarray(ramp)
+        self.edges = np.asarray(edges,dtype=float)
+        self.nbins = self.edges.shape[0]-1
+        self.binof = valuebins(self.ramp,self.edges) if binof is None else binof
+        self.jac = np.bincount(self.binof[self.binof >= 0],minlength=self.nbins) if jac is None else jac
+        for arr in (self.ramp,self.edges,self.binof,self.jac):
+            arr.flags.writeable = False
+
+    def save(self,fname):
+        tmpname = '%s.%i.tmp.npz'%(fname,os.getpid()) # workers may build the same table at once
+        np.savez(tmpname,ramp=self.ramp,edges=self.edges,binof=self.binof,jac=self.jac)
+        os.replace(tmpname,fname)
+
+    @classmethod
+    def load(cls,fname):
+        with np.load(fname) as d:
+            return cls(d['ramp'],d['edges'],d['binof'],d['jac'])
+
+    def valueat(self,t):
+        # ramp value at arbitrary times in samples, or in the units func takes
+        if self.func is not None:
+            return self.func(t)
+        return np.interp(t,np.arange(self.ramp.shape[0]),self.ramp)
+
+    def holdtrace(self,times,indptr,dead):
+        return holdtrace(self.ramp,times,indptr,dead)
+
+    def heldcounts(self,times,indptr,dead):
+        # (nrows x nbins) histogram of the held trace minus the jacobian, times in samples as findhits() returns them
+        nrows = indptr.shape[0]-1
+        n = self.ramp.shape[0]
+        cross = np.floor(times).astype(int) + 1
+        rows = np.repeat(np.arange(nrows),np.diff(indptr))
+        cols = cross[:,None] + np.arange(int(dead))[None,:]
+        covered = cols < n
+        held = self.binof[cross-1]
+        lost = self.binof[np.minimum(cols,n-1)]
+        (hrows,hbins,hw) = (rows,held,np.sum(covered,axis=1))
+        (lrows,lbins) = (np.broadcast_to(rows[:,None],cols.shape)[covered],lost[covered])
+        inds = np.concatenate((hrows*self.nbins + hbins,lrows*self.nbins + lbins))
+        weights = np.concatenate((hw,-np.ones(lbins.shape[0],dtype=int)))
+        m = np.concatenate((hbins,lbins)) >= 0
+        return np.bincount(inds[m],weights=weights[m],minlength=nrows*self.nbins).reshape((nrows,self.nbins)).astype(int)
+
+    def tracecounts(self,traces):
+        # (nrows x nbins) histogram of every row of already held traces minus the jacobian, heldcounts() for traces
+        traces = np.atleast_2d(traces)
+        b = valuebins(traces.ravel(),self.edges).reshape(traces.shape)
+        rows = np.broadcast_to(np.arange(traces.shape[0])[:,None],traces.shape)
+        m = b >= 0
+        counts = np.bincount(rows[m]*self.nbins + b[m],minlength=traces.shape[0]*self.nbins)
+        return counts.reshape((traces.shape[0],self.nbins)) - self.jac[None,:]
+
+    def heldhist(self,times,indptr,dead):
+        # number of rows whose held trace histogram exceeds the jacobian, per bin (figs/hitfind.py hist)
+        return np.sum(self.heldcounts(times,indptr,dead) > 0,axis=0)
+
+    def valuehist(self,times):
+        # histogram of the ramp linearly interpolated at the hit times
+        return np.histogram(np.interp(times,np.arange(self.ramp.shape[0]),self.ramp),bins=self.edges)[0]
+
+def ramphash(nsamples,dt,ramp0,rampstart,rampstop,edges):
+    keyhash = sha256(str.encode('ramptable.v%i'%RAMPVERSION))
+    for v in (nsamples,dt,ramp0,rampstart,rampstop,edges):
+        keyhash.update(np.ascontiguousarray(v,dtype=float).tobytes())
+    return keyhash.hexdigest()
+
+def ramptablename(cachepath,hashstring):
+    return '%sramptable.v%i.%s.npz'%(cachepath,RAMPVERSION,hashstring[:16])
+
+def ramptable(nsamples,dt,ramp0=250,rampstart=300.,rampstop=1300.,edges=None,cachepath=None):
+    # analysis ramp table, dt in ns, edges default to the 1024 bins from .25 to 11.25 of figs/hitfind.py
+    if edges is None:
+        edges = np.linspace(0.25,11.25,1025)
+    return cachedramptable(int(nsamples),float(dt),float(ramp0),float(rampstart),float(rampstop)
+            ,tuple(np.asarray(edges,dtype=float)),cachepath)
+
+@lru_cache(maxsize=16)
+def cachedramptable(nsamples,dt,ramp0,rampstart,rampstop,edges,cachepath):
+    edges = np.array(edges)
+    fname = None if cachepath is None else ramptablename(cachepath,ramphash(nsamples,dt,ramp0,rampstart,rampstop,edges))
+    if fname is not None and os.path.exists(fname):
+        return RampTable.load(fname)
+    table = RampTable(energyramp(np.arange(nsamples)*dt,ramp0,rampstart,rampstop),edges)
+    if fname is not None:
+        os.makedirs(cachepath,exist_ok=True)
+        table.save(fname)
+    return table
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import numpy as np
+import h5py
+from multiprocessing import Pool
+
+## scope text export ingest
+## a directory of LeCroy ascii files is converted once into a single HDF5 store, the headers are scanned first so
+## the store is laid out at its final size, then the files are parsed in a process pool and every worker result is
+## written straight into its rows. store layout
+##   traces          (ntraces x nsamples) float32, contiguous so tracesmemmap() can np.memmap it
+##   t0, dt          (ntraces,) first sample time and sample step in s, trace i is t0[i] + dt[i]*arange(nsamples)
+##   segment         (ntraces,) segment number of the trace within its file
+##   trigtimes       (ntraces,) TimeSinceSegment1 from the header, nan when the export does not carry it
+##   files           source file names, traces of file k are rows files_offsets[k]:files_offsets[k+1]
+## attrs nsamples, ntraces, and dt when every trace shares it
+## two export flavours are read, comma separated with the Segments,<n>,SegmentSize,<m> header (the figs scripts)
+## and whitespace separated single segment traces after 6 header lines (the impulse response files)
+
+def readheader(infile):
+    # LeCroy comma separated header, leaves infile at the first data line
+    line = infile.readline()
+    listvals = [x.strip() for x in line.split(',')]
+    (scopename,scopemodel,arraytype) = (listvals[0],listvals[1],listvals[2])
+    line = infile.readline()
+    listvals = [x.strip() for x in line.split(',')]
+    (nsegments,nsamples) = (int(listvals[1]),int(listvals[3]))
+    line = infile.readline() # Segment,TrigTime,TimeSinceSegment1
+    trigtimes = np.full(nsegments,np.nan)
+    line = infile.readline()
+    s = 0
+    while line.startswith('#'):
+        listvals = [x.strip() for x in line.split(',')]
+        try:
+            trigtimes[s] = float(listvals[-1])
+        except (ValueError,IndexError):
+            pass
+        s += 1
+        line = infile.readline()
+    (xlabel,ylabel) = [x.strip() for x in line.split(',')][:2]
+    return (scopename,scopemodel,arraytype,nsegments,nsamples,xlabel,ylabel,trigtimes[:nsegments])
+
+def iscsv(fname):
+    with open(fname,'rt') as fi:
+        return ',' in fi.readline()
+
+def scanfile(fname,skiprows=6):
+    # (nsegments,nsamples,trigtimes) without reading the data
+    if iscsv(fname):
+        with open(fname,'rt') as fi:
+            header = readheader(fi)
+        return (header[3],header[4],header[7])
+    with open(fname,'rt') as fi:
+        nlines = sum(1 for line in fi if line.strip())
+    return (1,nlines-skiprows,np.full(1,np.nan))
+
+def readscopefile(fname,nsegments,nsamples,skiprows=6):
+    # (t0,dt,traces) with traces (nsegments x nsamples) float32
+    if iscsv(fname):
+        with open(fname,'rt') as fi:
+            readheader(fi)
+            d = np.loadtxt(fi,dtype=float,delimiter=',',ndmin=2)
+    else:
+        d = np.loadtxt(fname,skiprows=skiprows,dtype=float,ndmin=2)
+    t = d[:nsegments*nsamples,0].reshape((nsegments,nsamples))
+    v = d[:nsegments*nsamples,1].reshape((nsegments,nsamples)).astype(np.float32)
+    return (t[:,0],(t[:,-1]-t[:,0])/max(nsamples-1,1),v)
+
+def readtask(task):
+    (k,fname,nsegments,nsamples) = task
+    return (k,) + readscopefile(fname,nsegments,nsamples)
+
+def ingest(filelist,outname,nworkers=4):
+    headers = [scanfile(fname) for fname in filelist]
+    if len(headers)==0:
+        print('no scope files to ingest')
+        return None
+    nsamples = headers[0][1]
+    keep = []
+    for fname,h in zip(filelist,headers):
+        if h[1] != nsamples:
+            print("failed, {} is unequal nsamples for file {}".format(nsamples,fname))
+            continue
+        keep += [(fname,h)]
+    counts = np.array([h[0] for (fname,h) in keep],dtype=np.int64)
+    offsets = np.concatenate(([0],np.cumsum(counts)))
+    ntraces = int(offsets[-1])
+
+    tmpname = outname + '.tmp'
+    with h5py.File(tmpname,'w') as f:
+        f.attrs['nsamples'] = nsamples
+        f.attrs['ntraces'] = ntraces
+        traces = f.create_dataset('traces',shape=(ntraces,nsamples),dtype=np.float32)
+        t0 = f.create_dataset('t0',shape=(ntraces,),dtype=float)
+        dt = f.create_dataset('dt',shape=(ntraces,),dtype=float)
+        f.create_dataset('segment',data=np.concatenate([np.arange(c) for c in counts]).astype(np.int32))
+        f.create_dataset('trigtimes',data=np.concatenate([h[2] for (fname,h) in keep]))
+        f.create_dataset('files',data=np.array([os.path.basename(fname) for (fname,h) in keep],dtype='S'))
+        f.create_dataset('files_offsets',data=offsets).attrs['target'] = 'traces'
+        tasks = [(k,fname,h[0],nsamples) for k,(fname,h) in enumerate(keep)]
+        with Pool(nworkers) as pool:
+            for (k,t0s,dts,v) in pool.imap_unordered(readtask,tasks,chunksize=max(1,len(tasks)//(8*nworkers))):
+                rows = slice(offsets[k],offsets[k+1])
+                traces[rows] = v
+                t0[rows] = t0s
+                dt[rows] = dts
+        dts = dt[()]
+        if ntraces > 0 and np.allclose(dts,dts[0],rtol=1e-6,atol=0):
+            f.attrs['dt'] = dts[0]
+    os.replace(tmpname,outname)
+    print('ingested {} traces of {} samples from {} files into {}'.format(ntraces,nsamples,len(keep),outname))
+    return outname
+
+def tracesmemmap(h5name,name='traces'):
+    # read only view of a contiguous dataset without going through h5py, falls back to reading it
+    with h5py.File(h5name,'r') as f:
+        ds = f[name]
+        offset = ds.id.get_offset()
+        if offset is None or ds.compression is not None:
+            return ds[()]
+        (shape,dtype) = (ds.shape,ds.dtype)
+    return np.memmap(h5name,mode='r',dtype=dtype,shape=shape,offset=offset)
+
+def main():
+    if len(sys.argv)<4:
+        print('syntax: %s <outfile.h5> <nworkers> <scope text files ...>'%sys.argv[0])
+        return
+    ingest(sorted(sys.argv[3:]),sys.argv[1],int(sys.argv[2]))
+    return
+
+if __name__ == '__main__':
+    main()
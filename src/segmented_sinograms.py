@@ -6,6 +6,19 @@ import sys
 import h5py
 import cv2
 
+def imagepulses(f):
+    # per image list of pulse hists, from the stacked shard layout of generate_sinogram_imgseg
+    # (pulses of image i are rows pulses_offsets[i]:pulses_offsets[i+1]) or the older img<n>/<pulse>/hist groups
+    if 'pulses_offsets' in f:
+        offsets = f['pulses_offsets'][()]
+        for i in range(offsets.shape[0]-1):
+            yield f['hist'][offsets[i]:offsets[i+1]]
+        return
+    for key in list(f.keys()):
+        if re.search(r'^img\d+',key) is not None:
+            image = f[key]
+            yield [image[p]['hist'][()] for p in list(image.keys())]
+
 def main():
     fnames = ['./data_sinograms/debug.ImgSegSim.h5']
     wrappings = 3
@@ -16,31 +29,23 @@ def main():
     for fname in fnames:
         f = h5py.File(fname,'r')
 
-        imkeys = []
-        for key in list(f.keys()):
-            m = re.search('^img\d+',key)
-            if m != None:
-                imkeys += [key]
-
-        images = [f[k] for k in imkeys]
         imnum = 0
-        for image in images:
-            pulses = [image[p] for p in list(image.keys())]
+        for pulses in imagepulses(f):
             chan = 0
-            h,w = pulses[0]['hist'][()].shape
+            h,w = pulses[0].shape
             c = 3
-            outimg = np.zeros((h,wrappings*w,c),dtype=np.uint8)
+            outimg = np.zeros((h,wrappings*w,c),dtype=np.float32) # hists are uint16, scaled to 8 bit by normalize
             wrapmask = .5*(1-np.cos(np.arange(w)/w*np.pi))
 
             for pulse in pulses:
                 if chan < 3:
-                    mat = np.tile(pulse['hist'][()],(wrappings,))
+                    mat = np.tile(pulse,(wrappings,))
                     for j in range(mat.shape[0]):
                         mat[j,:w] = (256*(1-np.cos(np.arange(w)/w*np.pi)) * mat[j,:w])//256
                         mat[j,-w:] = (256*(1+np.cos(np.arange(1,w+1)/w*np.pi)) * mat[j,-w:])//256
                     outimg[:,:,chan] = mat
                 chan += 1
-            outimg = cv2.normalize(outimg,  None, 0, 255, cv2.NORM_MINMAX)
+            outimg = cv2.normalize(outimg,  None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U)
             cv2.imshow('image%05i'%imnum,outimg)
             cv2.waitKey(0)
             cv2.destroyAllWindows()
@@ -0,0 +1,175 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import numpy as np
+import h5py
+
+## binary shard writer for buildwaveforms
+## every shot is appended as one record to chunked, compressed, resizable datasets
+##   tofs, ens            CSR style, values plus offsets over (shot,channel) rows, shot i channel c is
+##                        values[offsets[i*nchannels+c]:offsets[i*nchannels+c+1]]
+##   wf, hist             fixed width (nshots x nchannels x nsamples)
+##   npulses, invpurity, strength   one entry per shot
+## shard level metadata lives in the file attrs, and a text index lists the shards and their npulses
+##
+## every shard writer follows the same convention so mergeshards() can stitch any of them together:
+## datasets are stacked along axis 0, and <name>_offsets holds CSR row offsets starting at 0 into <name>,
+## or into the dataset named by its 'target' attr when the rows it splits are not its own values
+
+def appendrows(f,name,data,dtype,chunkrows=16,compression='gzip'):
+    # appends a block of rows, the dataset is created on first use with the row shape of data
+    data = np.asarray(data,dtype=dtype)
+    if name not in f:
+        f.create_dataset(name,shape=(0,)+data.shape[1:],maxshape=(None,)+data.shape[1:],dtype=dtype
+                ,chunks=(chunkrows,)+data.shape[1:],compression=compression)
+    ds = f[name]
+    start = ds.shape[0]
+    ds.resize((start+data.shape[0],)+ds.shape[1:])
+    ds[start:] = data
+    return ds
+
+def appendcounts(f,name,counts,target=None):
+    # extends <name>_offsets by rows of the given lengths
+    if name + '_offsets' not in f:
+        f.create_dataset(name + '_offsets',data=np.zeros((1,),dtype=np.int64),maxshape=(None,),chunks=(2**12,))
+        if target is not None:
+            f[name + '_offsets'].attrs['target'] = target
+    offs = f[name + '_offsets']
+    n = offs.shape[0]
+    offs.resize((n + len(counts),))
+    offs[n:] = offs[n-1] + np.cumsum(counts,dtype=np.int64)
+    return offs
+
+def appendcsr(f,name,values,counts,dtype=np.float32,compression='gzip'):
+    # values are the concatenated rows, counts their lengths
+    appendrows(f,name,np.asarray(values).reshape((-1,)),dtype,chunkrows=2**14,compression=compression)
+    appendcounts(f,name,counts)
+
+class ShardWriter:
+    def __init__(self,fname,nchannels,chunkshots=16,compression='gzip',attrs=None):
+        self.fname = fname
+        self.nchannels = int(nchannels)
+        self.chunkshots = int(chunkshots)
+        self.compression = compression
+        self.nshots = 0
+        self.npulses = []
+        self.f = h5py.File(fname,'w')
+        self.f.attrs['nchannels'] = self.nchannels
+        for k in (attrs or {}).keys():
+            self.f.attrs[k] = attrs[k]
+        for name in ('tofs','ens'):
+            appendcsr(self.f,name,np.zeros((0,)),[],compression=self.compression)
+        for name in ('npulses','invpurity','strength'):
+            self.f.create_dataset(name,shape=(0,),maxshape=(None,),dtype=np.int32,chunks=(2**10,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def _appendhits(self,name,hitlists):
+        nhits = [len(h) for h in hitlists]
+        values = np.concatenate([np.asarray(h,dtype=np.float32) for h in hitlists]) if sum(nhits)>0 else np.zeros((0,))
+        appendcsr(self.f,name,values,nhits,compression=self.compression)
+
+    def _appendfixed(self,name,data,dtype):
+        data = np.asarray(data,dtype=dtype)
+        appendrows(self.f,name,data[None,...],dtype,chunkrows=self.chunkshots,compression=self.compression)
+
+    def append(self,tofs,ens,wf,hist,npulses,invpurity,strength):
+        # tofs and ens are lists of per channel hit lists, wf and hist are (nchannels x n)
+        self._appendhits('tofs',tofs)
+        self._appendhits('ens',ens)
+        self._appendfixed('wf',wf,np.int32)
+        self._appendfixed('hist',hist,np.uint8)
+        for name,v in zip(('npulses','invpurity','strength'),(npulses,invpurity,strength)):
+            self.f[name].resize((self.nshots+1,))
+            self.f[name][self.nshots] = v
+        self.npulses += [int(npulses)]
+        self.nshots += 1
+
+    def close(self):
+        if self.f:
+            self.f.attrs['nshots'] = self.nshots
+            self.f.close()
+            self.f = None
+
+def appendindex(indexname,shardname,npulses):
+    # one line per shard, opened in append mode so concurrent workers each add a whole line
+    line = '{}\t{}\t{}\n'.format(os.path.basename(shardname),len(npulses),','.join(['%i'%n for n in npulses]))
+    with open(indexname,'a') as fo:
+        fo.write(line)
+
+def readindex(indexname):
+    result = []
+    with open(indexname,'r') as fi:
+        for line in fi:
+            (shardname,nshots,npulses) = line.strip().split('\t')
+            result += [(shardname,int(nshots),[int(n) for n in npulses.split(',') if len(n)])]
+    return result
+
+def readhits(f,name,shot,chan):
+    offs = f[name + '_offsets']
+    i = shot*f.attrs['nchannels'] + chan
+    return f[name][offs[i]:offs[i+1]]
+
+def mergeshards(mergedname,shardnames,sumattrs=('nshots','nimages')):
+    # one file presenting all shards as contiguous arrays without copying them, every dataset becomes a virtual dataset
+    # over the shards, only the small offset arrays are rewritten since each shard counts from 0.
+    # attrs that agree across all shards are kept and the counts in sumattrs are totalled,
+    # shard sources are stored relative to the merged file
+    shardnames = list(shardnames)
+    mergedir = os.path.dirname(os.path.abspath(mergedname))
+    shapes = {}
+    offsets = {}
+    attrs = None
+    totals = {}
+    for sname in shardnames:
+        with h5py.File(sname,'r') as f:
+            if attrs is None:
+                attrs = dict(f.attrs)
+                names = [k for k in f.keys() if isinstance(f[k],h5py.Dataset)]
+                dtypes = {k:f[k].dtype for k in names}
+                targets = {k:f[k].attrs.get('target',k[:-len('_offsets')]) for k in names if k.endswith('_offsets')}
+            attrs = {k:v for k,v in attrs.items() if k in f.attrs and np.array_equal(f.attrs[k],v)}
+            for k in sumattrs:
+                if k in f.attrs:
+                    totals[k] = totals.get(k,0) + int(f.attrs[k])
+            for k in names:
+                shapes.setdefault(k,[]).append(f[k].shape)
+                if k in targets:
+                    offsets.setdefault(k,[]).append(f[k][()])
+    with h5py.File(mergedname,'w') as fo:
+        for k in attrs.keys():
+            fo.attrs[k] = attrs[k]
+        for k in totals.keys():
+            fo.attrs[k] = totals[k]
+        fo.attrs['shards'] = [os.path.relpath(os.path.abspath(sname),mergedir) for sname in shardnames]
+        for k in names:
+            if k in targets:
+                starts = np.cumsum([0] + [shp[0] for shp in shapes[targets[k]]])
+                merged = [offsets[k][0]] + [o[1:] + starts[i] for i,o in enumerate(offsets[k]) if i>0]
+                fo.create_dataset(k,data=np.concatenate(merged))
+                fo[k].attrs['target'] = targets[k]
+                continue
+            n = sum([shp[0] for shp in shapes[k]])
+            layout = h5py.VirtualLayout(shape=(n,)+shapes[k][0][1:],dtype=dtypes[k])
+            start = 0
+            for sname,shp in zip(fo.attrs['shards'],shapes[k]):
+                if shp[0]>0:
+                    layout[start:start+shp[0]] = h5py.VirtualSource(sname,k,shape=shp)
+                start += shp[0]
+            fo.create_virtual_dataset(k,layout,fillvalue=0 if dtypes[k].kind in 'iuf' else None)
+    return mergedname
+
+def main():
+    if len(sys.argv)<3:
+        print('syntax:\t%s <merged.h5> <shard1.h5> <shard2.h5> ...'%(sys.argv[0]))
+        return
+    mergeshards(sys.argv[1],sys.argv[2:])
+    return
+
+if __name__ == '__main__':
+    main()
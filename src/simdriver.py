@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import random
+import numpy as np
+from multiprocessing import Pool
+from timeit import default_timer as timer
+
+## process pool driver for the simulations
+## a total shot budget is cut into fixed size chunks handed out with imap_unordered so a slow worker
+## never stalls the pool, every chunk is seeded from its own SeedSequence child so a chunk reproduces
+## regardless of which worker picks it up, and finished chunks are recorded in a manifest so a rerun
+## after preemption only does the missing work.
+## manifest format, first line holds the root entropy, then one line per finished chunk
+##   # entropy <int> chunksize <int>
+##   <chunkid>\t<nshots>\t<seconds>\t<pid>\t<output>
+
+def chunklist(nshots,chunksize):
+    return [(c,min(chunksize,nshots-c*chunksize)) for c in range((nshots+chunksize-1)//chunksize)]
+
+def readmanifest(manifestname):
+    (entropy,chunksize) = (None,None)
+    done = {}
+    if not os.path.exists(manifestname):
+        return (entropy,chunksize,done)
+    with open(manifestname,'r') as fi:
+        for line in fi:
+            if line.startswith('# entropy'):
+                vals = line.split()
+                (entropy,chunksize) = (int(vals[2]),int(vals[4]))
+                continue
+            vals = line.rstrip('\n').split('\t')
+            if not line.endswith('\n') or len(vals)<5:
+                continue # partially written line from an interrupted run
+            done[int(vals[0])] = (int(vals[1]),float(vals[2]),int(vals[3]),vals[4])
+    return (entropy,chunksize,done)
+
+def endsopen(fname):
+    with open(fname,'rb') as fi:
+        fi.seek(0,os.SEEK_END)
+        if fi.tell()==0:
+            return False
+        fi.seek(-1,os.SEEK_END)
+        return fi.read(1) != b'\n'
+
+def seedglobals(seedseq):
+    # the legacy simulation code draws from np.random and random module state
+    state = seedseq.generate_state(4)
+    np.random.seed(state)
+    random.seed(int(state[0]))
+    return np.random.default_rng(seedseq)
+
+def runchunk(task):
+    (chunkfunc,chunkid,nshots,seedseq,args) = task
+    rng = seedglobals(seedseq)
+    start = timer()
+    output = chunkfunc(chunkid,nshots,rng,*args)
+    return (chunkid,nshots,timer()-start,os.getpid(),output)
+
+def runchunks(chunkfunc,nshots,chunksize,nworkers,manifestname,args=(),entropy=None,collect=None):
+    # chunkfunc(chunkid,nshots,rng,*args) runs in the workers and returns a short string for the manifest
+    # collect(output) runs in the parent as every chunk finishes
+    (oldentropy,oldchunksize,done) = readmanifest(manifestname)
+    if oldentropy is not None:
+        if oldchunksize != chunksize:
+            print('failed, manifest {} was written with chunksize {}, not {}'.format(manifestname,oldchunksize,chunksize))
+            return {}
+        entropy = oldentropy
+    if entropy is None:
+        entropy = np.random.SeedSequence().entropy
+    seeds = np.random.SeedSequence(entropy).spawn((nshots+chunksize-1)//chunksize)
+    chunks = chunklist(nshots,chunksize)
+    tasks = [(chunkfunc,c,n,seeds[c],args) for (c,n) in chunks if c not in done]
+    print('### %i of %i chunks already done, running %i chunks of up to %i shots on %i workers' % (len(done),len(chunks),len(tasks),chunksize,nworkers))
+
+    rates = {}
+    nfinished = sum([done[c][0] for c in done])
+    start = timer()
+    with open(manifestname,'a') as manifest:
+        if endsopen(manifestname):
+            manifest.write('\n') # terminates a partially written line from an interrupted run
+        if oldentropy is None:
+            manifest.write('# entropy {} chunksize {}\n'.format(entropy,chunksize))
+            manifest.flush()
+        with Pool(nworkers) as pool:
+            for (chunkid,n,seconds,pid,output) in pool.imap_unordered(runchunk,tasks):
+                manifest.write('{}\t{}\t{:.3f}\t{}\t{}\n'.format(chunkid,n,seconds,pid,output))
+                manifest.flush()
+                if collect is not None:
+                    collect(output)
+                (s,t) = rates.get(pid,(0,0.))
+                rates[pid] = (s+n,t+seconds)
+                nfinished += n
+                print('chunk {} done by pid {} at {:.2f} shots/s, {} of {} shots'.format(chunkid,pid,n/max(seconds,1e-9),nfinished,nshots))
+                sys.stdout.flush()
+    stop = timer()
+    for pid in rates.keys():
+        print('pid {}\t{} shots\t{:.2f} shots/s'.format(pid,rates[pid][0],rates[pid][0]/max(rates[pid][1],1e-9)))
+    print('### %i shots in %.3f s' % (nfinished,stop-start))
+    return rates
@@ -0,0 +1,80 @@
+#!/usr/bin/python3
+
+import numpy as np
+from functools import lru_cache
+from scipy import fft as sfft
+
+from utilities import gauss,highpass,lowpass
+
+## shared spectral utilities
+## waveforms are real so the transforms are rfft/irfft over the last axis by default, an (nchannels x nsamples) stack
+## is transformed in one call. frequency grids and filter kernels are cached per (length, dt, bandwidth, kind) and
+## returned read only, so per waveform calls only pay for the transforms. pad=True transforms at next_fast_len and
+## cuts the result back, for filtering where the circular wrap at the record ends does not matter.
+## KERNELS maps a filter kind to f(freqs,bwd), modules add their own kinds with registerkernel()
+
+def fastlen(n):
+    return sfft.next_fast_len(int(n),real=True)
+
+def rfft(x,n=None,axis=-1):
+    return sfft.rfft(x,n=n,axis=axis)
+
+def irfft(X,n,axis=-1):
+    return sfft.irfft(X,n=n,axis=axis)
+
+def readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+@lru_cache(maxsize=64)
+def rfreqs(n,dt=1.):
+    return readonly(sfft.rfftfreq(n,dt))
+
+@lru_cache(maxsize=64)
+def freqs(n,dt=1.):
+    # full complex grid, for the paths that really are complex
+    return readonly(sfft.fftfreq(n,dt))
+
+def halfspectrum(x_ft,f):
+    # rfft part of a hermitian spectrum stored on the full fftfreq grid, rows are frequencies
+    nr = f.shape[0]//2+1
+    return (x_ft[:nr],np.abs(f[:nr]))
+
+def hermitianabs(X,n):
+    # |X| of a real signal's rfft laid out on the full fftfreq grid of length n, for output next to the time samples
+    nr = X.shape[-1]
+    A = np.abs(X)
+    return np.concatenate((A,A[...,n-nr:0:-1]),axis=-1)
+
+def cos2window(f,bwd):
+    return np.where(np.abs(f) < bwd,np.cos(np.abs(f)/bwd*np.pi/2.)**2,0.)
+
+KERNELS = {
+        'gauss' : lambda f,bwd: gauss(f,0,bwd),
+        'lowpass' : lambda f,bwd: lowpass(f,bwd,bwd/2.),
+        'highpass' : lambda f,bwd: highpass(f,2.*bwd,bwd/2.),
+        'cos2' : cos2window,
+        'deriv' : lambda f,bwd: 1j*f*gauss(f,0,bwd),
+        }
+
+def registerkernel(kind,func):
+    KERNELS[kind] = func
+    filterkernel.cache_clear()
+
+@lru_cache(maxsize=128)
+def filterkernel(n,dt,bwd,kind='gauss',full=False):
+    f = freqs(n,dt) if full else rfreqs(n,dt)
+    return readonly(np.asarray(KERNELS[kind](f,bwd)))
+
+def fftfilter(x,dt,bwd,kind='gauss',axis=-1,pad=False):
+    # real in, real out, same length along axis
+    n = x.shape[axis]
+    m = fastlen(n) if pad else n
+    X = rfft(x,n=m,axis=axis)
+    shape = [1]*X.ndim
+    shape[axis] = X.shape[axis]
+    X *= filterkernel(m,float(dt),float(bwd),kind).reshape(shape)
+    y = irfft(X,m,axis=axis)
+    if pad:
+        y = np.take(y,np.arange(n),axis=axis)
+    return y
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import numpy as np
+from functools import lru_cache
+from scipy.constants import c
+from scipy.constants import physical_constants as pc
+
+(e_mc2,unit,err) = pc["electron mass energy equivalent in MeV"]
+e_mc2 *= 1e6 # eV now
+C_cmPns = c*100.*1e-9
+
+## time of flight for Ave's 3 region retarding design
+## distances are in centimiters and energies are in eV and times are in ns
+## energy2time_full() keeps the input shape and writes nan where the electron does not make it (e<=0, or e<=r when retarded),
+## it works in the dtype of out, so passing out=e does the conversion in place on float32 or float64 arrays
+
+def tofdirect(en,r,d1,d2,d3):
+    if r==0:
+        return (d1+d2+d3)/C_cmPns * np.sqrt(e_mc2/(2.*en))
+    return d1/C_cmPns * np.sqrt(e_mc2/(2.*en)) + d3/C_cmPns * np.sqrt(e_mc2/(2.*(en-r))) + d2/C_cmPns * np.sqrt(2)*(e_mc2/r)*(np.sqrt(en/e_mc2) - np.sqrt((en-r)/e_mc2))
+
+def energy2time_full(e,r=0,d1=3.75,d2=5,d3=35,out=None,table=False):
+    e = np.asarray(e)
+    if out is None:
+        out = np.empty(e.shape,dtype = e.dtype if e.dtype.kind == 'f' else float)
+    mask = e > (0 if r==0 else r)
+    en = e[mask]
+    out[~mask] = np.nan
+    if table:
+        out[mask] = toftable(float(d1),float(d2),float(d3),rmax=max(100.,float(np.ceil(r))))(en,r)
+    else:
+        out[mask] = tofdirect(en,r,d1,d2,d3)
+    return out
+
+def energy2time(e,r=0,d1=3.75,d2=5,d3=35,table=False):
+    # only the electrons that make it to the detector, as a flat array
+    e = np.asarray(e)
+    t = energy2time_full(e,r=r,d1=d1,d2=d2,d3=d3,table=table)
+    return t[e > (0 if r==0 else r)]
+
+class TofTable:
+    ## log(t) sampled on a grid of retardation r and log excess energy x=e-r
+    ## along x this is smooth and strictly decreasing (slope -1/2 as x->0), linear interpolation keeps it monotone,
+    ## between two r rows the result is a convex combination of two monotone rows
+    def __init__(self,d1,d2,d3,rmax=100.,dr=1.,xmin=1e-3,xmax=1e5,nx=4096):
+        self.d1 = d1
+        self.d2 = d2
+        self.d3 = d3
+        self.rvals = np.arange(0.,rmax+dr,dr)
+        self.logx = np.linspace(np.log(xmin),np.log(xmax),nx)
+        x = np.exp(self.logx)
+        self.logt = np.zeros((self.rvals.shape[0],nx),dtype=float)
+        for i,r in enumerate(self.rvals):
+            self.logt[i,:] = np.log(tofdirect(x+r,r,d1,d2,d3))
+
+    def row(self,logx,i):
+        return np.interp(logx,self.logx,self.logt[i,:])
+
+    def __call__(self,e,r=0):
+        # r outside the table rows or e-r outside the x grid fall back to tofdirect, np.interp would clamp them
+        e = np.asarray(e,dtype=float)
+        if r < self.rvals[0] or r > self.rvals[-1]:
+            return tofdirect(e,r,self.d1,self.d2,self.d3)
+        logx = np.log(e-r)
+        w = np.interp(r,self.rvals,np.arange(self.rvals.shape[0],dtype=float))
+        i = min(int(w),self.rvals.shape[0]-2)
+        w -= i
+        if w == 0.:
+            result = np.exp(self.row(logx,i))
+        else:
+            result = np.exp((1.-w)*self.row(logx,i) + w*self.row(logx,i+1))
+        outside = (logx < self.logx[0]) | (logx > self.logx[-1])
+        if np.any(outside):
+            result = np.where(outside,tofdirect(np.where(outside,e,r+1.),r,self.d1,self.d2,self.d3),result)
+        return result
+
+@lru_cache(maxsize=16)
+def toftable(d1,d2,d3,rmax=100.):
+    return TofTable(d1,d2,d3,rmax=rmax)
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+
+import os
+import numpy as np
+from numpy.fft import ifft as IFFT
+
+from phasors import phaseramp
+from spectral import rfft as RFFT
+from spectral import irfft as IRFFT
+from spectral import rfreqs,halfspectrum
+
+## batched waveform synthesis
+## sum_i S[:,col_i] * exp(-i*2*pi*f*t_i) is evaluated as a (nfreq x nhits) phase matrix
+## times the gathered impulse response columns, then one IFFT per channel (batched along axis=1)
+## the impulse responses are real, so only the rfft half of the stored spectra is synthesized and inverted with irfft
+## maxbytes caps the size of the (nfreq x nhits) temporaries, hits are processed in blocks that fit, and the hits of a
+## block are summed per channel with np.add.reduceat over their CSR runs
+##
+## StampBank is the time domain alternative for sparse shots. the impulse responses are short next to the zero extended
+## record, so every column is delayed in Fourier by k/nphases of a sample for k in range(nphases), cut to the window
+## holding its energy, and a hit at t is stamped as the bank row nearest to its fractional delay added into
+## record[floor(t/dt) + start : ... + length], circularly like the Fourier path. cost is O(length) per hit
+## instead of O(nfreq), the error is the sub sample quantization, it falls as 1/nphases from a level set by the library's
+## bandwidth (0.1 to 1% relative rms at nphases=64 on the libraries tried), stampaccuracy() measures it
+
+def hitblocksize(nfreq,maxbytes=2**28,itemsize=16):
+    return max(1,int(maxbytes//(nfreq*itemsize)))
+
+def blocksegments(chans):
+    # (first hit, channel) of every channel run in a block of channel sorted hits, for np.add.reduceat
+    starts = np.flatnonzero(np.concatenate(([True],chans[1:] != chans[:-1])))
+    return (starts,chans[starts])
+
+def synthshot_ft(s_collection_ft,colinds,times,indptr,f,maxbytes=2**28,dtype=complex):
+    # times and colinds are CSR style over channels, channel c holds times[indptr[c]:indptr[c+1]]
+    # a block holds the phase ramps and the gathered columns, (nfreq x nblock) each, channels are summed by reduceat
+    nchannels = len(indptr)-1
+    result = np.zeros((s_collection_ft.shape[0],nchannels),dtype=dtype)
+    chans = np.repeat(np.arange(nchannels),np.diff(indptr))
+    nblock = hitblocksize(f.shape[0],maxbytes,np.dtype(dtype).itemsize + s_collection_ft.itemsize)
+    buf = np.empty((f.shape[0],min(nblock,times.shape[0])),dtype=dtype)
+    cols = np.empty(buf.shape,dtype=s_collection_ft.dtype)
+    for b in range(0,times.shape[0],nblock):
+        nb = min(nblock,times.shape[0]-b)
+        phases = phaseramp(f,times[b:b+nb],out=buf[:,:nb],dtype=dtype)
+        phases *= np.take(s_collection_ft,colinds[b:b+nb],axis=1,out=cols[:,:nb],mode='clip')
+        (starts,segchans) = blocksegments(chans[b:b+nb])
+        result[:,segchans] += np.add.reduceat(phases,starts,axis=1)
+    return result.T
+
+def synthshot(s_collection_ft,colinds,times,indptr,f,maxbytes=2**28,dtype=complex):
+    # s_collection_ft and f on the full fftfreq grid, as the library stores them
+    (s_half_ft,f_half) = halfspectrum(s_collection_ft,f)
+    v_simsum_ft = synthshot_ft(s_half_ft,colinds,times,indptr,f_half,maxbytes=maxbytes,dtype=dtype)
+    return IRFFT(v_simsum_ft,f.shape[0],axis=1)
+
+## digitizer noise is one stationary realization per channel per shot, independent of the hit count
+## the power spectrum is estimated once from the real noise traces the library columns make, E|rfft(x)|^2 per bin,
+## and every shot draws complex gaussian rfft coefficients with that power (real at DC and nyquist) and one irfft per channel
+
+def noisepsd(n_collection_ft):
+    # mean rfft power of the real traces real(IFFT(column)), length nsamples//2+1
+    psd = np.zeros(n_collection_ft.shape[0]//2+1,dtype=float)
+    for c in range(n_collection_ft.shape[1]):
+        psd += np.abs(RFFT(np.real(IFFT(n_collection_ft[:,c]))))**2
+    return psd/n_collection_ft.shape[1]
+
+def colorednoise(psd,nsamples,nchannels=1,rng=None,dtype=float):
+    # (nchannels x nsamples) gaussian noise with E|rfft(x)|^2 = psd
+    if rng is None:
+        rng = np.random.default_rng()
+    coeffs = np.empty((nchannels,psd.shape[0]),dtype=complex)
+    coeffs.real = rng.standard_normal((nchannels,psd.shape[0]))
+    coeffs.imag = rng.standard_normal((nchannels,psd.shape[0]))
+    coeffs *= np.sqrt(psd/2.)
+    coeffs[:,0] = coeffs[:,0].real*np.sqrt(2.)
+    if nsamples%2 == 0:
+        coeffs[:,-1] = coeffs[:,-1].real*np.sqrt(2.)
+    return IRFFT(coeffs,n=nsamples,axis=1).astype(dtype)
+
+def impulsewindow(s_collection,tol=1e-6):
+    # (start,length) of the shortest circular window holding every sample of any column above tol of the peak,
+    # found as the complement of the longest circular run of quiet samples
+    env = np.max(np.abs(s_collection),axis=1)
+    loud = np.flatnonzero(env > tol*np.max(env))
+    gaps = np.diff(np.concatenate((loud,[loud[0]+env.shape[0]])))
+    g = int(np.argmax(gaps))
+    start = int(loud[(g+1) % loud.shape[0]])
+    return (start,int(env.shape[0] - gaps[g] + 1))
+
+class StampBank:
+    def __init__(self,s_collection_ft,dt,nphases=64,tol=1e-6,dtype=float):
+        self.nsamples = s_collection_ft.shape[0]
+        self.dt = float(dt)
+        self.nphases = int(nphases)
+        f = rfreqs(self.nsamples,self.dt)
+        s_collection_ft = np.asarray(s_collection_ft[:f.shape[0]])
+        (self.start,length) = impulsewindow(IRFFT(s_collection_ft,self.nsamples,axis=0),tol)
+        self.length = min(length + 1,self.nsamples) # a delay below one sample moves the tail by at most one
+        inds = (self.start + np.arange(self.length)) % self.nsamples
+        self.bank = np.zeros((s_collection_ft.shape[1],self.nphases,self.length),dtype=dtype)
+        for k in range(self.nphases):
+            delayed = IRFFT(s_collection_ft*phaseramp(f,k*self.dt/self.nphases)[:,None],self.nsamples,axis=0)
+            self.bank[:,k,:] = delayed[inds,:].T
+
+    def save(self,fname):
+        # bank as .npy so workers can memory map it, the scalars in <fname>.meta.npy
+        tmpname = '%s.%i.tmp.npy'%(fname,os.getpid())
+        np.save(tmpname,self.bank)
+        np.save(tmpname + '.meta.npy',np.array([self.nsamples,self.dt,self.nphases,self.start,self.length],dtype=float))
+        os.replace(tmpname + '.meta.npy',fname + '.meta.npy')
+        os.replace(tmpname,fname)
+
+    @classmethod
+    def load(cls,fname,mmap_mode='r'):
+        bank = cls.__new__(cls)
+        (nsamples,dt,nphases,start,length) = np.load(fname + '.meta.npy')
+        (bank.nsamples,bank.dt,bank.nphases,bank.start,bank.length) = (int(nsamples),float(dt),int(nphases),int(start),int(length))
+        bank.bank = np.load(fname,mmap_mode=mmap_mode)
+        return bank
+
+    def hitsegments(self,colinds,times):
+        # bank rows and first sample of every hit
+        pos = np.asarray(times,dtype=float)/self.dt
+        n = np.floor(pos)
+        k = np.round((pos-n)*self.nphases).astype(int)
+        n += (k == self.nphases)
+        k %= self.nphases
+        return (self.bank[colinds,k,:],n.astype(np.int64) + self.start)
+
+    def synthshot(self,colinds,times,indptr,maxbytes=2**28):
+        # same CSR hit layout as synthshot(), returns (nchannels x nsamples)
+        nchannels = len(indptr)-1
+        chans = np.repeat(np.arange(nchannels),np.diff(indptr))
+        result = np.zeros(nchannels*self.nsamples,dtype=float)
+        nblock = hitblocksize(self.length,maxbytes,self.bank.itemsize*3)
+        j = np.arange(self.length)
+        for b in range(0,chans.shape[0],nblock):
+            nb = min(nblock,chans.shape[0]-b)
+            (segs,first) = self.hitsegments(colinds[b:b+nb],times[b:b+nb])
+            inds = (first[:,None] + j[None,:]) % self.nsamples + (chans[b:b+nb]*self.nsamples)[:,None]
+            result += np.bincount(inds.ravel(),weights=segs.ravel(),minlength=result.shape[0])
+        return result.reshape((nchannels,self.nsamples))
+
+def stampaccuracy(bank,s_collection_ft,f,nhits=256,tmax=None,rng=None):
+    # relative rms and peak error of the stamped waveform against the Fourier path, for random hits on one channel
+    if rng is None:
+        rng = np.random.default_rng()
+    if tmax is None:
+        tmax = bank.nsamples*bank.dt
+    times = rng.random(nhits)*tmax
+    colinds = rng.integers(s_collection_ft.shape[1],size=nhits)
+    indptr = np.array([0,nhits])
+    ref = synthshot(s_collection_ft,colinds,times,indptr,f)
+    err = bank.synthshot(colinds,times,indptr) - ref
+    return (np.sqrt(np.mean(err**2)/np.mean(ref**2)),np.max(np.abs(err))/np.max(np.abs(ref)))
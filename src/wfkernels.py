@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+try:
+    from numba import njit
+    havenumba = True
+except ImportError:
+    havenumba = False
+
+## array kernels for the per channel waveform mapping in buildwaveforms
+## the original walk over the time of flight list
+##      while t>tvec[i]: i += 1
+##      result[i:i+width] = value(t)
+##      i += width-1
+## puts hit k at index_k = max(searchsorted(tvec,t_k), index_{k-1}+width-1),
+## which unrolls to index_k = (width-1)*k + cummax(searchsorted(tvec,t_k) - (width-1)*k)
+## the walk stops at the first hit that falls past the end, index is nondecreasing so the kept hits are a prefix
+
+def hitindices_numpy(tvec,toflist,width=3):
+    ss = np.searchsorted(tvec,np.asarray(toflist,dtype=float),side='left')
+    if ss.shape[0]==0:
+        return ss
+    step = (width-1)*np.arange(ss.shape[0])
+    inds = step + np.maximum.accumulate(ss - step)
+    return inds[inds < tvec.shape[0]]
+
+if havenumba:
+    @njit(cache=True)
+    def _hitindices_numba(tvec,toflist,width):
+        inds = np.zeros(toflist.shape[0],dtype=np.int64)
+        i = 0
+        n = 0
+        for k in range(toflist.shape[0]):
+            while i < tvec.shape[0] and toflist[k] > tvec[i]:
+                i += 1
+            if i > tvec.shape[0]-1:
+                break
+            inds[n] = i
+            n += 1
+            i += width-1
+        return inds[:n]
+
+    @njit(cache=True)
+    def _holdhist_numba(wf,nbins):
+        result = np.zeros(nbins,dtype=np.int64)
+        for i in range(2,wf.shape[0]):
+            if wf[i] == wf[i-1] and wf[i-1] == wf[i-2] and wf[i] > 0 and wf[i] < nbins:
+                result[int(wf[i])] = 1
+        return result
+
+def hitindices(tvec,toflist,width=3,backend='numpy'):
+    if backend == 'numba' and havenumba:
+        return _hitindices_numba(tvec,np.asarray(toflist,dtype=float),width)
+    return hitindices_numpy(tvec,toflist,width)
+
+def stamphits(result,tvec,toflist,valfunc,width=3,backend='numpy'):
+    # overwrites result[index_k:index_k+width] with valfunc(t_k,position)
+    # writing the offsets last to first reproduces the sequential overwrite order, within one offset indices never repeat
+    toflist = np.asarray(toflist,dtype=float)
+    inds = hitindices(tvec,toflist,width,backend)
+    t = toflist[:inds.shape[0]]
+    for j in range(width-1,-1,-1):
+        pos = inds + j
+        m = pos < result.shape[0]
+        result[pos[m]] = valfunc(t[m],pos[m])
+    return result
+
+def hitindices_csr(tvec,toflist,indptr,width=3):
+    # hitindices_numpy for every channel of a CSR hit list at once, channel c holds toflist[indptr[c]:indptr[c+1]]
+    # offsetting channel c by c*big keeps the running max from carrying over between channels
+    # returns (indices, channels, mask of the hits the per channel walk keeps)
+    ss = np.searchsorted(tvec,np.asarray(toflist,dtype=float),side='left')
+    counts = np.diff(indptr)
+    chans = np.repeat(np.arange(counts.shape[0]),counts)
+    step = (width-1)*(np.arange(ss.shape[0]) - np.repeat(indptr[:-1],counts))
+    big = tvec.shape[0] + (width-1)*(int(np.max(counts)) if counts.shape[0] else 0) + 1
+    inds = step + np.maximum.accumulate(ss - step + chans*big) - chans*big
+    return (inds,chans,inds < tvec.shape[0])
+
+def stamphits_csr(result,tvec,toflist,indptr,valfunc,width=3):
+    # stamphits over the rows of a (nchannels x nsamples) result, one row per channel
+    toflist = np.asarray(toflist,dtype=float)
+    (inds,chans,keep) = hitindices_csr(tvec,toflist,indptr,width)
+    (inds,chans,t) = (inds[keep],chans[keep],toflist[keep])
+    for j in range(width-1,-1,-1):
+        pos = inds + j
+        m = pos < result.shape[1]
+        result[chans[m],pos[m]] = valfunc(t[m],pos[m])
+    return result
+
+def holdhist(wf,nbins=2**12,backend='numpy'):
+    # 1 in every bin where the waveform holds the same value for 3 consecutive samples
+    wf = np.asarray(wf)
+    if backend == 'numba' and havenumba:
+        return _holdhist_numba(wf,nbins)
+    v = wf[2:]
+    m = (v == wf[1:-1]) * (wf[1:-1] == wf[:-2]) * (v > 0) * (v < nbins)
+    return (np.bincount(v[m].astype(int),minlength=nbins) > 0).astype(int)